@@ -0,0 +1,106 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from django.db import connection, reset_queries
+
+
+# The numbers in an entry that are added up in a report's totals.
+TOTALED_FIELDS = ('time', 'queries', 'query_time', 'bytes')
+
+
+class BuildProfile(object):
+    """
+    Records how long each part of a build took, how many SQL queries it made
+    and how long they took, and how much it wrote.
+
+    Each entry has a `kind` (e.g. 'zone', 'view', 'check' or 'git'), a
+    `name`, and whatever else was measured. If the profile is disabled,
+    nothing is recorded and SQL queries aren't logged.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.entries = []
+        self.new_entries = []
+        self.start_time = None
+        self.old_use_debug_cursor = None
+
+    def start(self):
+        self.start_time = time.time()
+        if self.enabled:
+            # Django only logs queries in DEBUG mode unless it's told to.
+            self.old_use_debug_cursor = connection.use_debug_cursor
+            connection.use_debug_cursor = True
+            reset_queries()
+
+    def stop(self):
+        if self.enabled:
+            connection.use_debug_cursor = self.old_use_debug_cursor
+            reset_queries()
+
+    def add(self, kind, name, **fields):
+        if self.enabled:
+            entry = dict(fields, kind=kind, name=name)
+            self.entries.append(entry)
+            self.new_entries.append(entry)
+
+    @contextmanager
+    def measure(self, kind, name, **fields):
+        """
+        Time the body of the `with` statement and count its queries. The
+        body can add to the entry (e.g. `bytes`) through the dict that's
+        bound by `as`.
+        """
+        if not self.enabled:
+            yield {}
+            return
+
+        queries_before = len(connection.queries)
+        start = time.time()
+        try:
+            yield fields
+        finally:
+            queries = connection.queries[queries_before:]
+            self.add(kind, name, time=time.time() - start,
+                     queries=len(queries),
+                     query_time=sum(float(q['time']) for q in queries),
+                     **fields)
+
+    def pop_new_entries(self):
+        """
+        Return the entries added since the last call and forget that they
+        were new. Used to send entries from worker processes to the parent.
+        """
+        new_entries, self.new_entries = self.new_entries, []
+        return new_entries
+
+    def update(self, entries):
+        self.entries.extend(entries)
+
+    def report(self):
+        totals = {}
+        for entry in self.entries:
+            total = totals.setdefault(entry['kind'], {'count': 0})
+            total['count'] += 1
+            for field in TOTALED_FIELDS:
+                if field in entry:
+                    total[field] = total.get(field, 0) + entry[field]
+
+        return {
+            'start': (datetime.fromtimestamp(self.start_time).isoformat()
+                      if self.start_time is not None else None),
+            'time': (time.time() - self.start_time
+                     if self.start_time is not None else None),
+            'totals': totals,
+            'entries': self.entries,
+        }
+
+    def save(self, path):
+        """Write the report to `path` as JSON."""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.report(), f, indent=4, sort_keys=True)
+        os.rename(tmp_path, path)
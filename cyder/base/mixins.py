@@ -6,7 +6,7 @@ from django.core.urlresolvers import NoReverseMatch, reverse
 from django.db.models.loading import get_model
 from django.forms import ModelChoiceField, HiddenInput
 
-from cyder.base.utils import filter_by_ctnr
+from cyder.base.utils import filter_by_ctnr, LockHeld
 
 
 class DisplayMixin(object):
@@ -163,6 +163,10 @@ class UsabilityFormMixin(object):
 
 
 class MutexMixin(object):
+    # Whether failing to get the lock is reported (see `_lock_failure`).
+    # If it isn't, LockHeld is raised instead.
+    report_lock_failure = True
+
     def __enter__(self):
         self.lock()
         return self
@@ -184,6 +188,8 @@ class MutexMixin(object):
             self.lock_fd.close()
             # IOError: [Errno 11] Resource temporarily unavailable
             if exc_value[0] == 11:
+                if not self.report_lock_failure:
+                    raise LockHeld(self.lock_file)
                 with open(self.pid_file, 'r') as pid_fd:
                     self._lock_failure(pid_fd.read())
             else:
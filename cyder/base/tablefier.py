@@ -1,6 +1,8 @@
 from django.core.urlresolvers import reverse, NoReverseMatch
 from django.db.models.query import QuerySet
 
+import ipaddr
+
 from cyder.base.constants import ACTION_UPDATE
 from cyder.base.helpers import cached_property
 
@@ -24,6 +26,7 @@ class Tablefier:
         self.custom = custom
         self.detail_view = detail_view
         self.excluded = excluded
+        self.ranges = {}
         if self.custom:
             self.extra_cols = None
             self.update = False
@@ -131,16 +134,32 @@ class Tablefier:
     def add_info(self):
         return self.grab_url(self.first_obj) and not self.detail_view
 
-    @staticmethod
-    def grab_url(value):
+    def grab_url(self, value):
         try:
             if type(value) in [str, unicode]:
-                from cyder.cydhcp.range.utils import find_range
-                value = find_range(value)
+                value = self.ranges.get(value)
             return value.get_detail_url()
         except (AttributeError, ValueError):
             return None
 
+    @staticmethod
+    def find_ranges(values):
+        """
+        Return a dict mapping the strings in `values` that are IP addresses
+        to the ranges they're in, looked up in one batch.
+        """
+        from cyder.cydhcp.range.utils import find_ranges
+        ip_strs = set()
+        for value in values:
+            if type(value) in [str, unicode]:
+                try:
+                    ipaddr.IPAddress(value)
+                except ValueError:
+                    continue
+                ip_strs.add(value)
+        ip_strs = list(ip_strs)
+        return dict(zip(ip_strs, find_ranges(ip_strs)))
+
     def build_data(self, obj, value):
         if self.add_info and value == obj:
             col = {'value': [unicode(value)], 'url': [None]}
@@ -204,14 +223,19 @@ class Tablefier:
             extra_datas = zip(*[col['data'] for col in self.extra_cols])
         else:
             extra_datas = [[]] * len(self.objects)
-        for obj, extra_data in zip(self.objects, extra_datas):
+        all_details = [self.custom(obj) if self.custom else obj.details()
+                       for obj in self.objects]
+        self.ranges = self.find_ranges(
+            value for details in all_details
+            for _, _, value in details['data'])
+        for obj, details, extra_data in zip(self.objects, all_details,
+                                            extra_datas):
             row_data = []
             if self.add_info:
                 row_data.append({
                     'value': ['Info'], 'url': [self.grab_url(obj)],
                     'class': ['info'], 'img': ['/media/img/magnify.png']})
 
-            details = self.custom(obj) if self.custom else obj.details()
             columns = map(lambda x: x[0], details['data'])
             for field in self.excluded:
                 if field in columns:
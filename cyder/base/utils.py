@@ -1,10 +1,16 @@
 import distutils.dir_util
+import errno
+import hashlib
+import json
 import operator
 import os
 import shlex
 import shutil
 import subprocess
 import syslog
+import tempfile
+import time
+from contextlib import contextmanager
 from copy import copy
 from os import path
 from sys import stderr
@@ -24,11 +30,75 @@ class StopFileExists(Exception):
     pass
 
 
+class LockHeld(Exception):
+    """
+    Raised by :class:`MutexMixin` instead of reporting that another process
+    has the lock, if its `report_lock_failure` is False.
+    """
+    pass
+
+
 def copy_tree(*args, **kwargs):
     distutils.dir_util._path_created = {}
     distutils.dir_util.copy_tree(*args, **kwargs)
 
 
+def _same_contents(file1, file2):
+    # filecmp.cmp caches its results by size and mtime, which isn't good
+    # enough for files that are rewritten within a second.
+    if not path.isfile(file2) or (path.getsize(file1) !=
+                                  path.getsize(file2)):
+        return False
+    with open(file1, 'rb') as f1:
+        with open(file2, 'rb') as f2:
+            return f1.read() == f2.read()
+
+
+def copy_changed(src, dst):
+    """
+    Copy the files in the directory `src` that are missing from or different
+    in the directory `dst`. Files that are the same aren't touched. Return the
+    paths (relative to `dst`) of the files that were copied.
+    """
+    changed = []
+    for dirpath, _, filenames in os.walk(src):
+        for filename in filenames:
+            src_file = path.join(dirpath, filename)
+            rel_file = path.relpath(src_file, src)
+            dst_file = path.join(dst, rel_file)
+            if _same_contents(src_file, dst_file):
+                continue
+            if not path.isdir(path.dirname(dst_file)):
+                os.makedirs(path.dirname(dst_file))
+            shutil.copy2(src_file, dst_file)
+            changed.append(rel_file)
+    return changed
+
+
+@contextmanager
+def open_if_changed(fname):
+    """
+    Open a temporary file to write the new contents of `fname` to. When the
+    block ends, it replaces `fname` only if the contents differ, so a file
+    whose bytes didn't change isn't rewritten and keeps its mtime. Missing
+    directories are created.
+    """
+    if not path.isdir(path.dirname(fname)):
+        os.makedirs(path.dirname(fname))
+    tmp_fname = fname + '.tmp'
+    fd = open(tmp_fname, 'w')
+    try:
+        with fd:
+            yield fd
+    except:
+        os.remove(tmp_fname)
+        raise
+    if _same_contents(tmp_fname, fname):
+        os.remove(tmp_fname)
+    else:
+        os.rename(tmp_fname, fname)
+
+
 def shell_out(command, use_shlex=True):
     """
     A little helper function that will shell out and return stdout,
@@ -63,6 +133,17 @@ class Logger(object):
         raise Exception(msg)
 
 
+def command_failure_msg(command, out, err, failure_msg=None):
+    msg = '{}: '.format(failure_msg) if failure_msg else ''
+    msg += '`{}` failed in {}\n\n'.format(
+        command, os.getcwd())
+    if out:
+        msg += '=== stdout ===\n{0}\n'.format(out)
+    if err:
+        msg += '=== stderr ===\n{0}\n'.format(err)
+    return msg.rstrip('\n') + '\n'
+
+
 def run_command(command, logger=Logger(), ignore_failure=False,
                 failure_msg=None):
     # A single default Logger instance is shared between every call to this
@@ -70,18 +151,158 @@ def run_command(command, logger=Logger(), ignore_failure=False,
     logger.log_debug('Calling `{0}` in {1}'.format(command, os.getcwd()))
     out, err, returncode = shell_out(command)
     if returncode != 0 and not ignore_failure:
-        msg = '{}: '.format(failure_msg) if failure_msg else ''
-        msg += '`{}` failed in {}\n\n'.format(
-            command, os.getcwd())
-        if out:
-            msg += '=== stdout ===\n{0}\n'.format(out)
-        if err:
-            msg += '=== stderr ===\n{0}\n'.format(err)
-        msg = msg.rstrip('\n') + '\n'
-        logger.error(msg)
+        logger.error(command_failure_msg(command, out, err, failure_msg))
     return out, err, returncode
 
 
+class CommandPool(object):
+    """
+    Runs commands in the background, at most `size` at a time. A command that
+    fails is reported the same way :func:`run_command` reports it, as soon
+    as the pool notices, which is when another command is submitted or when
+    :func:`wait` is called.
+
+    If `profile` (a :class:`BuildProfile`) is given, each command is added to
+    it as a 'check' entry. The time is measured until the pool notices that
+    the command finished, so it's an upper bound.
+    """
+
+    def __init__(self, size=1, logger=Logger(), profile=None):
+        self.size = size
+        self.logger = logger
+        self.profile = profile
+        self.running = []
+
+    def submit(self, command, failure_msg=None, on_success=None,
+               on_failure=None):
+        """
+        Start `command`, first waiting for a free slot if the pool is full.
+        `on_success` or `on_failure` is called (without arguments) when the
+        command finishes.
+        """
+        self._reap()
+        while len(self.running) >= self.size:
+            self._finish(self.running[0])
+            self._reap()
+
+        self.logger.log_debug('Calling `{0}` in {1}'.format(
+            command, os.getcwd()))
+        # Output goes to temporary files so a chatty command can't fill a
+        # pipe and block while nobody is reading from it.
+        out, err = tempfile.TemporaryFile(), tempfile.TemporaryFile()
+        p = subprocess.Popen(shlex.split(command), stdout=out, stderr=err)
+        self.running.append((p, command, out, err, failure_msg, on_success,
+                             on_failure, time.time()))
+
+    def _reap(self):
+        for job in list(self.running):
+            if job[0].poll() is not None:
+                self._finish(job)
+
+    def _finish(self, job):
+        (p, command, out, err, failure_msg, on_success, on_failure,
+         start) = job
+        p.wait()
+        self.running.remove(job)
+        if self.profile is not None:
+            self.profile.add('check', command, time=time.time() - start,
+                             returncode=p.returncode)
+        out.seek(0)
+        err.seek(0)
+        out, err = out.read(), err.read()
+        if p.returncode == 0:
+            if on_success:
+                on_success()
+        else:
+            if on_failure:
+                on_failure()
+            self.logger.error(
+                command_failure_msg(command, out, err, failure_msg))
+
+    def wait(self):
+        """Wait for every command to finish."""
+        while self.running:
+            self._finish(self.running[0])
+
+    def terminate(self):
+        """Kill every command that's still running."""
+        for job in self.running:
+            if job[0].poll() is None:
+                job[0].kill()
+            job[0].wait()
+        self.running = []
+
+
+class ChecksumCache(object):
+    """
+    Remembers a checksum for each key, e.g. of the last version of a file
+    that passed a check, so that an identical file needn't be checked again.
+
+    If `path` is given, the cache can be loaded from and saved to that file
+    as JSON.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.checksums = {}
+        self.new_checksums = {}
+
+    @staticmethod
+    def checksum(*parts):
+        return hashlib.sha1(
+            '\0'.join(part.encode('utf-8') if isinstance(part, unicode)
+                       else part for part in parts)).hexdigest()
+
+    def load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path) as f:
+                self.checksums = json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            # The cache is corrupt, so start over.
+            pass
+
+    def save(self):
+        if not self.path:
+            return
+        dirname = path.dirname(self.path)
+        if dirname and not path.isdir(dirname):
+            os.makedirs(dirname)
+        # A unique name, so nothing planted at a predictable one (e.g. a
+        # symlink) gets written through.
+        fd, tmp_path = tempfile.mkstemp(dir=dirname or os.curdir,
+                                        prefix=path.basename(self.path))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.checksums, f)
+            os.rename(tmp_path, self.path)
+        except:
+            os.remove(tmp_path)
+            raise
+
+    def matches(self, key, checksum):
+        return self.checksums.get(key) == checksum
+
+    def set(self, key, checksum):
+        self.checksums[key] = self.new_checksums[key] = checksum
+
+    def pop_new_checksums(self):
+        """
+        Return the checksums set since the last call and forget that they
+        were new. Used to send checksums from worker processes to the
+        parent.
+        """
+        new_checksums, self.new_checksums = self.new_checksums, {}
+        return new_checksums
+
+    def update(self, checksums):
+        self.checksums.update(checksums)
+
+
 def set_attrs(obj, attrs):
     for name, value in attrs.iteritems():
         setattr(obj, name, value)
@@ -1,5 +1,6 @@
 import os
 import re
+from pipes import quote
 from os.path import dirname, basename
 
 from cyder.base.utils import dict_merge, Logger, run_command
@@ -39,11 +40,17 @@ class VCSRepo(object):
                            ignore_failure=ignore_failure)
 
     def __init__(self, repo_dir, line_decrease_limit=None,
-                 line_increase_limit=None, logger=Logger()):
+                 line_increase_limit=None, logger=Logger(),
+                 line_count_exclude=()):
+        """
+        line_count_exclude: Paths (relative to the root of the repo) whose
+            changes don't count toward the line count limits.
+        """
         self.repo_dir = repo_dir
         self.line_decrease_limit = line_decrease_limit
         self.line_increase_limit = line_increase_limit
         self.logger = logger
+        self.line_count_exclude = tuple(line_count_exclude)
 
     @repo_chdir_wrapper
     def reset_to_head(self):
@@ -56,8 +63,9 @@ class VCSRepo(object):
         self._pull()
 
     @repo_chdir_wrapper
-    def commit_and_push(self, message, sanity_check=True):
-        self._commit_and_push(message, sanity_check=sanity_check)
+    def commit_and_push(self, message, sanity_check=True, paths=None):
+        self._commit_and_push(message, sanity_check=sanity_check,
+                              paths=paths)
 
     @repo_chdir_wrapper
     def get_revision(self):
@@ -84,9 +92,14 @@ class VCSRepo(object):
 class GitRepo(VCSRepo):
     @repo_chdir_wrapper
     def commit_and_push(self, message, sanity_check=True,
-                        empty=False):
+                        empty=False, paths=None):
+        """
+        Commit and push the changes in the working tree. If `paths` is given,
+        only changes to those paths (relative to the root of the repo) are
+        committed, and the rest of the working tree isn't looked at.
+        """
         self._commit_and_push(message, sanity_check=sanity_check,
-                              empty=empty)
+                              empty=empty, paths=paths)
 
     def _get_revision(self):
         revision, _, _ = self._run_command('git rev-parse HEAD')
@@ -97,9 +110,13 @@ class GitRepo(VCSRepo):
                                              ignore_failure=True)
         return returncode != 0
 
-    def _commit_and_push(self, message, sanity_check=True, empty=False):
+    def _commit_and_push(self, message, sanity_check=True, empty=False,
+                         paths=None):
         if not empty:
-            self._add_all()
+            if paths is None:
+                self._add_all()
+            else:
+                self._add(paths)
 
         if not self._is_index_dirty() and not empty:
             self.logger.log_notice('There were no changes. Nothing to commit.')
@@ -127,14 +144,24 @@ class GitRepo(VCSRepo):
     def _add_all(self):
         self._run_command('git add -A .')
 
+    def _add(self, paths):
+        if paths:
+            self._run_command(
+                'git add -A -- ' + ' '.join(quote(p) for p in paths))
+
     def _get_line_count_difference(self):
         diff_ignore = (re.compile(r'--- \S'), re.compile(r'\+\+\+ \S'))
 
         output, _, _ = self._run_command('git diff --cached')
 
         added, removed = 0, 0
+        excluded = False
         for line in output.split('\n'):
-            if any(regex.match(line) for regex in diff_ignore):
+            if line.startswith('diff --git '):
+                path = line.split(' b/', 1)[-1]
+                excluded = any(path.startswith(prefix)
+                               for prefix in self.line_count_exclude)
+            if excluded or any(regex.match(line) for regex in diff_ignore):
                 continue
             if line.startswith('+'):
                 added += 1
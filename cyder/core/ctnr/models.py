@@ -13,6 +13,7 @@ from cyder.base.utils import transaction_atomic
 from cyder.cydns.domain.models import Domain
 from cyder.cydhcp.constants import DYNAMIC
 from cyder.cydhcp.range.models import Range
+from cyder.cydhcp.range.utils import find_ranges
 from cyder.cydhcp.workgroup.models import Workgroup
 from cyder.cydns.ptr.models import BasePTR
 from cyder.core.validation import validate_ctnr_name
@@ -140,6 +141,9 @@ class CtnrUser(BaseModel, ObjectUrlMixin):
 
 
 def objects_removed(ctnr, objects, objtype="domain"):
+    # The ranges of each PTR class's records, looked up once for all of
+    # the objects.
+    ptr_ranges = {}
     for obj in objects:
         for klass, _ in get_klasses():
             if klass is Domain or klass is Range:
@@ -150,7 +154,12 @@ def objects_removed(ctnr, objects, objtype="domain"):
                 results = klass.filter_by_ctnr(ctnr, objects=None)
 
                 if issubclass(klass, BasePTR) and objtype == "range":
-                    results = [p for p in results.all() if p.range == obj]
+                    if klass not in ptr_ranges:
+                        ptrs = list(results.all())
+                        ptr_ranges[klass] = zip(
+                            ptrs, find_ranges([p.ip_str for p in ptrs]))
+                    results = [p for p, rng in ptr_ranges[klass]
+                               if rng == obj]
                 else:
                     try:
                         kwargs = {objtype: obj}
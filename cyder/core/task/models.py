@@ -1,22 +1,37 @@
-from django.db import models
+from django.db import IntegrityError, models
+
+from cyder.base.utils import savepoint_atomic
 
 
 class DNSManager(models.Manager):
-    def get_queryset(self):
-        return super(DNSManager, self).get_queryset().filter(ttype='dns')
+    def get_query_set(self):
+        return super(DNSManager, self).get_query_set().filter(ttype='dns')
+
+
+class DHCPManager(models.Manager):
+    def get_query_set(self):
+        return super(DHCPManager, self).get_query_set().filter(ttype='dhcp')
 
 
 class Task(models.Model):
     task = models.CharField(max_length=255, blank=False)
     ttype = models.CharField(max_length=255, blank=False)
+    # Set when a build picks the task up. Changes made while a build is
+    # running get a new, unclaimed task, so the build doesn't delete them
+    # when it's done.
+    claimed = models.BooleanField(default=False)
 
     objects = models.Manager()
     dns = DNSManager()
+    dhcp = DHCPManager()
 
     class Meta:
         app_label = 'cyder'
         db_table = u'task'
         ordering = ['task']
+        # At most one pending (and one claimed) task for each zone or
+        # section, even when two processes schedule it at the same time.
+        unique_together = ('ttype', 'task', 'claimed')
 
     def __repr__(self):
         return "<Task: {0}>".format(self)
@@ -27,6 +42,46 @@ class Task(models.Model):
     def save(self):
         super(Task, self).save()
 
+    @staticmethod
+    def schedule(ttype, task):
+        """
+        Add an unclaimed task unless there already is one. The unique
+        constraint decides, so a concurrent insert of the same task blocks
+        until the other transaction ends and then counts as already
+        scheduled.
+        """
+        try:
+            with savepoint_atomic():
+                Task(task=task, ttype=ttype).save()
+        except IntegrityError:
+            pass
+
     @staticmethod
     def schedule_zone_rebuild(soa):
-        Task(task=str(soa.pk), ttype='dns').save()
+        # A zone only needs to be rebuilt once, no matter how many times it
+        # changes before the next build picks it up.
+        Task.schedule('dns', str(soa.pk))
+
+    @staticmethod
+    def schedule_dhcp_rebuild(section):
+        """
+        Record that a section of the dhcpd config needs to be rebuilt.
+        `section` is '<kind>:<pk>' (e.g. 'network:5'), or 'all'. See
+        :mod:`cyder.cydhcp.build.changes`.
+        """
+        Task.schedule('dhcp', section)
+
+    @staticmethod
+    def claim(tasks):
+        """
+        Mark `tasks` as claimed by a build. A task that's already claimed
+        (by a build that failed) makes its unclaimed twin redundant, so the
+        twin is deleted instead of claimed.
+        """
+        claimed = set((t.ttype, t.task) for t in tasks if t.claimed)
+        twins = [t.pk for t in tasks
+                 if not t.claimed and (t.ttype, t.task) in claimed]
+        Task.objects.filter(pk__in=twins).delete()
+        Task.objects.filter(
+            pk__in=[t.pk for t in tasks if not t.claimed],
+        ).exclude(pk__in=twins).update(claimed=True)
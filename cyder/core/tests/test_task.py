@@ -0,0 +1,74 @@
+import threading
+from time import sleep
+
+from django.db import connection, transaction
+from django.test import TransactionTestCase
+
+from cyder.core.task.models import Task
+
+
+class TaskTest(TransactionTestCase):
+    """
+    Tasks are scheduled in transactions of their own, so these tests need
+    real commits.
+    """
+
+    def schedule_in_thread(self, task, errors):
+        def schedule():
+            try:
+                with transaction.commit_on_success():
+                    Task.schedule('dns', task)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=schedule)
+        thread.start()
+        return thread
+
+    def test_schedule_twice(self):
+        """Test that a task is only scheduled once within and across
+        transactions"""
+
+        with transaction.commit_on_success():
+            Task.schedule('dns', '1')
+            Task.schedule('dns', '1')
+        self.assertEqual(Task.dns.filter(task='1').count(), 1)
+
+        with transaction.commit_on_success():
+            Task.schedule('dns', '1')
+        self.assertEqual(Task.dns.filter(task='1').count(), 1)
+
+        Task.dns.filter(task='1').update(claimed=True)
+        with transaction.commit_on_success():
+            Task.schedule('dns', '1')
+        self.assertEqual(
+            sorted(Task.dns.filter(task='1').values_list('claimed',
+                                                         flat=True)),
+            [False, True])
+
+    def test_schedule_concurrently(self):
+        """Test that a task scheduled by two transactions at once is only
+        scheduled once"""
+
+        errors = []
+        with transaction.commit_on_success():
+            Task.schedule('dns', '2')
+            # The other transaction's insert waits for this one to end.
+            thread = self.schedule_in_thread('2', errors)
+            sleep(1)
+        thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(Task.dns.filter(task='2').count(), 1)
+
+    def test_claim(self):
+        """Test that claiming a task that's already claimed deletes its
+        unclaimed twin"""
+
+        Task.schedule('dns', '3')
+        Task.dns.filter(task='3').update(claimed=True)  # A failed build
+        Task.schedule('dns', '3')
+        Task.claim(list(Task.dns.all()))
+        self.assertEqual(
+            list(Task.dns.values_list('task', 'claimed')), [('3', True)])
@@ -2,35 +2,92 @@ from __future__ import unicode_literals
 
 import errno
 import os
+import re
+from hashlib import sha1
+from multiprocessing import Pool
 import shlex
 import subprocess
 import sys
 import syslog
 import time
 
+from django.db import connection
+
+from cyder.base.build_profile import BuildProfile
 from cyder.base.mixins import MutexMixin
 from cyder.base.utils import (
-    copy_tree, dict_merge, Logger, run_command, set_attrs,
-    shell_out, StopFileExists)
+    CommandPool, copy_changed, dict_merge, Logger, remove_dir_contents,
+    run_command, set_attrs, shell_out, StopFileExists)
 from cyder.base.vcs import GitRepo
 
 from cyder.core.utils import fail_mail, mail_if_failure
-from cyder.core.ctnr.models import Ctnr
-from cyder.cydhcp.network.models import Network
-from cyder.cydhcp.vrf.models import Vrf
-from cyder.cydhcp.workgroup.models import Workgroup
+from cyder.core.task.models import Task
+from cyder.cydhcp.build.changes import ALL, parse_section
+from cyder.cydhcp.build.compiler import DHCPCompiler
+from cyder.cydhcp.build.section_cache import SectionCache
 
 from cyder.settings import DHCPBUILD
 
 
+# A split config file's fragments go in the directory named after it plus
+# this. See :func:`DHCPBuilder.write_split_config`.
+FRAGMENT_DIR_SUFFIX = '.d'
+
+INCLUDE_RE = re.compile(r'^include "([^"]*)";$')
+
+
+def _read_file(fname):
+    """Return the contents of `fname`, or None if it doesn't exist."""
+    try:
+        with open(fname) as fd:
+            return fd.read()
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+
+# The builder whose config files are being built by this worker process.
+# It's set right before the worker pool is forked. See
+# :func:`DHCPBuilder.build_files`.
+_worker_builder = None
+
+
+# The database connection a worker process inherited from the parent.
+_parent_connection = None
+
+
+def _init_worker():
+    # Set the inherited connection aside so that anything the worker queries
+    # goes over a connection of its own. It's kept rather than closed (or
+    # garbage collected), which would close the parent's connection too.
+    global _parent_connection
+    _parent_connection = connection.connection
+    connection.connection = None
+
+
+def _build_file_worker(ip_type):
+    result = _worker_builder.build_file(ip_type)
+    return result, _worker_builder.profile.pop_new_entries()
+
+
 class DHCPBuilder(MutexMixin, Logger):
     def __init__(self, *args, **kwargs):
-        kwargs = dict_merge(DHCPBUILD, {
+        kwargs = dict_merge({
+            'profile_file': None,
+            'section_cache_file': None,
+            'split_config': False,
+            'include_dir': '',
+            'jobs': 1,
+        }, DHCPBUILD, {
             'quiet': False,
             'verbose': False,
             'to_syslog': False,
         }, kwargs)
         set_attrs(self, kwargs)
+        self.profile = None
+        self.task_watermark = None
+        self.fragments = None
 
         self.repo = GitRepo(
             self.prod_dir, self.line_decrease_limit, self.line_increase_limit,
@@ -72,8 +129,25 @@ class DHCPBuilder(MutexMixin, Logger):
                            failure_logger=failure_logger,
                            failure_msg=failure_msg)
 
+    def get_scheduled(self):
+        """
+        Return the DHCP tasks, which say what sections of the config need to
+        be rebuilt (see :mod:`cyder.cydhcp.build.changes`). They're claimed
+        the same way as :func:`DNSBuilder.get_scheduled` claims DNS tasks,
+        and deleted once the build is pushed.
+        """
+        ts = list(Task.dhcp.all())
+        self.log_debug("{0} section{1} requested to be rebuilt".format(
+            len(ts), 's' if len(ts) != 1 else ''))
+        if ts:
+            Task.claim(ts)
+            self.task_watermark = max(t.pk for t in ts)
+        else:
+            self.task_watermark = None
+        return ts
+
     @mail_if_failure('Cyder DHCP build failed', ignore=(StopFileExists,))
-    def build(self):
+    def build(self, force=False):
         try:
             with open(self.stop_file) as stop_fd:
                 now = time.time()
@@ -94,49 +168,300 @@ class DHCPBuilder(MutexMixin, Logger):
             if e.errno != errno.ENOENT:  # "No such file or directory"
                 raise
 
-        for ip_type, files in (('4', self.files_v4), ('6', self.files_v6)):
-            self.log_info('Building v{}...'.format(ip_type))
-            with open(os.path.join(self.stage_dir, files['target_file']),
-                      'w') as f:
-                for ctnr in Ctnr.objects.all():
-                    f.write(ctnr.build_legacy_classes(ip_type))
-                for vrf in Vrf.objects.all():
-                    f.write(vrf.build_vrf(ip_type))
-                for network in Network.objects.filter(
-                        ip_type=ip_type, enabled=True):
-                    f.write(network.build_subnet())
-                for workgroup in Workgroup.objects.all():
-                    f.write(workgroup.build_workgroup(ip_type))
-
-            if files['check_file']:
-                self.check_syntax(
-                    ip_type=ip_type, filename=files['check_file'])
+        self.profile = BuildProfile(enabled=bool(self.profile_file))
+        self.profile.start()
+        try:
+            self._build(force=force)
+        finally:
+            self.save_profile()
+
+    def _build(self, force=False):
+        """
+        Build the config if anything in it has changed since the last build
+        (or if `force` is true). Only the sections that changed are
+        rendered; the rest come from the section cache, if there is one.
+        """
+        all_files = (('4', self.files_v4), ('6', self.files_v6))
+        prod_checksums = {}
+        for ip_type, files in all_files:
+            data = self.read_config(files['target_file'], self.prod_dir)
+            prod_checksums[ip_type] = (
+                None if data is None else sha1(data).hexdigest())
+        tasks = self.get_scheduled()
+
+        if (not tasks and not force and
+                None not in prod_checksums.values()):
+            self.log_info('Nothing to do!')
+            return
+
+        changed = set(t.task for t in tasks)
+        cache = SectionCache(self.section_cache_file)
+        if not (force or ALL in changed):
+            cache.load()
+        changed = set(parse_section(name) for name in changed)
+
+        # Everything is loaded up front, so the workers that render the
+        # files get it when they're forked instead of querying for it.
+        with self.profile.measure('load', 'dhcp'):
+            self.compiler = DHCPCompiler()
+        self.section_cache = cache
+        self.changed_sections = changed
+        self.prod_checksums = prod_checksums
+        self.fragments = {}
+
+        # Each file is checked in the background while the other is built.
+        check_pool = CommandPool(len(all_files), logger=self,
+                                 profile=self.profile)
+        try:
+            for ip_type, sections in self.build_files(
+                    [ip_type for ip_type, _ in all_files]):
+                self.finish_file(ip_type, sections, check_pool)
+            check_pool.wait()
+        except:
+            check_pool.terminate()
+            raise
+        finally:
+            self.compiler = None
 
+        cache.save()
         self.log_info('DHCP build successful')
 
+    def get_files(self, ip_type):
+        return self.files_v4 if ip_type == '4' else self.files_v6
+
+    def build_files(self, ip_types):
+        """
+        Call :func:`build_file` on each IP type and yield the results as
+        they're ready. If `jobs` is more than 1, the files are built at the
+        same time in a pool of worker processes.
+        """
+        global _worker_builder
+
+        if self.jobs <= 1:
+            for ip_type in ip_types:
+                yield self.build_file(ip_type)
+            return
+
+        # Otherwise every worker would send back our entries as its own.
+        self.profile.pop_new_entries()
+        _worker_builder = self
+        pool = Pool(min(self.jobs, len(ip_types)), initializer=_init_worker)
+        try:
+            for result, profile_entries in pool.imap_unordered(
+                    _build_file_worker, ip_types):
+                self.profile.update(profile_entries)
+                yield result
+        except:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+            _worker_builder = None
+
+    def build_file(self, ip_type):
+        """
+        Render the config file for `ip_type` and write it to the staging
+        area. Return the IP type and the (kind, pk, data) of each section.
+        Sections that haven't changed are taken from the section cache.
+        """
+        files = self.get_files(ip_type)
+        self.log_info('Building v{}...'.format(ip_type))
+        use_cache = self.section_cache.is_valid(
+            ip_type, self.prod_checksums[ip_type])
+        sections = []
+        for kind, obj, name, build in self.iter_sections(self.compiler,
+                                                         ip_type):
+            with self.profile.measure(kind, name, ip_type=ip_type) as entry:
+                data = (self.section_cache.get((ip_type, kind, obj.pk))
+                        if use_cache else None)
+                if data is None or (kind, obj.pk) in self.changed_sections:
+                    data = build()
+                else:
+                    entry['cached'] = True
+                entry['bytes'] = len(data)
+            sections.append((kind, obj.pk, data))
+
+        # A split config is checked as a single file, so it's written as
+        # one here. See :func:`finish_file`.
+        with open(os.path.join(self.stage_dir, files['target_file']),
+                  'w') as f:
+            for _, _, data in sections:
+                f.write(data)
+        return ip_type, sections
+
+    def finish_file(self, ip_type, sections, check_pool):
+        """
+        Remember the sections of a file :func:`build_file` built and start
+        checking it, unless it's the same as the one in prod. A split config
+        is split once it passes.
+        """
+        files = self.get_files(ip_type)
+        checksum = sha1()
+        for kind, pk, data in sections:
+            self.section_cache.set((ip_type, kind, pk), data)
+            checksum.update(data)
+        self.section_cache.set_checksum(ip_type, checksum.hexdigest())
+
+        if self.split_config:
+            def split():
+                self.write_split_config(files['target_file'], sections)
+        else:
+            split = None
+
+        if checksum.hexdigest() == self.prod_checksums[ip_type]:
+            self.log_debug('v{} config is unchanged'.format(ip_type))
+        elif files['check_file']:
+            check_pool.submit(
+                self.get_check_command(ip_type, files['check_file']),
+                on_success=split, on_failure=self.syntax_error)
+            return
+        if split:
+            split()
+
+    def iter_sections(self, compiler, ip_type):
+        """
+        Yield the kind, object, name, and renderer of each section of the
+        config, in order.
+        """
+        for ctnr in compiler.ctnrs:
+            yield ('ctnr', ctnr, ctnr.name,
+                   lambda: compiler.build_legacy_classes(ctnr, ip_type))
+        for vrf in compiler.vrfs:
+            yield ('vrf', vrf, vrf.name,
+                   lambda: compiler.build_vrf(vrf, ip_type))
+        for network in compiler.networks:
+            if network.ip_type != ip_type or not network.enabled:
+                continue
+            yield ('network', network, network.network_str,
+                   lambda: compiler.build_subnet(network))
+        for workgroup in compiler.workgroups:
+            yield ('workgroup', workgroup, workgroup.name,
+                   lambda: compiler.build_workgroup(workgroup, ip_type))
+
+    def get_fragment_dir(self, target_file):
+        return target_file + FRAGMENT_DIR_SUFFIX
+
+    def write_split_config(self, target_file, sections):
+        """
+        Write each section of the config to a fragment of its own, and
+        `target_file` as a list of includes of them. A change to one network
+        or workgroup then only changes one small file, and the line count
+        sanity check only sees the fragments that changed. Fragments that
+        are the same as the ones in prod aren't staged, so they're neither
+        copied nor committed. Empty sections don't get fragments.
+        """
+        rel_dir = self.get_fragment_dir(target_file)
+        stage_dir = os.path.join(self.stage_dir, rel_dir)
+        if os.path.isdir(stage_dir):
+            # Fragments staged by an earlier build may be out of date.
+            remove_dir_contents(stage_dir)
+        else:
+            os.makedirs(stage_dir)
+
+        names = []
+        staged = 0
+        for kind, pk, data in sections:
+            if not data:
+                continue
+            name = '{0}-{1}.conf'.format(kind, pk)
+            names.append(name)
+            rel_fname = os.path.join(rel_dir, name)
+            if data == _read_file(os.path.join(self.prod_dir, rel_fname)):
+                continue
+            with open(os.path.join(self.stage_dir, rel_fname), 'w') as f:
+                f.write(data)
+            staged += 1
+
+        with open(os.path.join(self.stage_dir, target_file), 'w') as f:
+            for name in names:
+                f.write('include "{0}";\n'.format(
+                    os.path.join(self.include_dir, rel_dir, name)))
+        self.fragments[target_file] = set(names)
+        self.log_debug('Staged {0} of {1} fragments of {2}'.format(
+            staged, len(names), target_file))
+
+    def read_config(self, target_file, dir_):
+        """
+        Return the contents of a config file in `dir_` with the includes of
+        its fragments (if it's split) replaced by the fragments, or None if
+        it doesn't exist.
+        """
+        data = _read_file(os.path.join(dir_, target_file))
+        if data is None:
+            return None
+
+        fragment_dir = os.path.join(self.include_dir,
+                                    self.get_fragment_dir(target_file), '')
+        lines = []
+        for line in data.splitlines(True):
+            match = INCLUDE_RE.match(line.rstrip('\n'))
+            if match and match.group(1).startswith(fragment_dir):
+                rel_fname = os.path.relpath(match.group(1),
+                                            self.include_dir or os.curdir)
+                line = _read_file(os.path.join(dir_, rel_fname)) or b''
+            lines.append(line)
+        return b''.join(lines)
+
+    def remove_stale_fragments(self):
+        """
+        Delete the fragments in prod that the last build didn't write (e.g.
+        those of deleted networks). Return their paths, relative to prod.
+        """
+        removed = []
+        for target_file, names in (self.fragments or {}).iteritems():
+            rel_dir = self.get_fragment_dir(target_file)
+            prod_dir = os.path.join(self.prod_dir, rel_dir)
+            if not os.path.isdir(prod_dir):
+                continue
+            for name in sorted(os.listdir(prod_dir)):
+                if name not in names:
+                    os.remove(os.path.join(prod_dir, name))
+                    removed.append(os.path.join(rel_dir, name))
+        return removed
+
+    def save_profile(self):
+        """
+        Write the build's profile to `profile_file`, if it's set. See
+        :class:`BuildProfile`.
+        """
+        self.profile.stop()
+        if self.profile.enabled:
+            self.profile.save(self.profile_file)
+
     @mail_if_failure('Cyder DHCP build failed')
     def push(self, sanity_check=True):
-        self.repo.reset_and_pull()
+        if self.profile is None:
+            # Nothing was built, so there's nothing to add to.
+            self.profile = BuildProfile(enabled=False)
+
+        with self.profile.measure('git', 'reset_and_pull'):
+            self.repo.reset_and_pull()
 
         try:
-            copy_tree(self.stage_dir, self.prod_dir)
+            changed = copy_changed(self.stage_dir, self.prod_dir)
+            changed += self.remove_stale_fragments()
         except:
             self.repo.reset_to_head()
             raise
 
-        self.repo.commit_and_push('Update config', sanity_check=sanity_check)
-
-    def check_syntax(self, ip_type, filename):
-        out, err, ret = run_command("{} -{} -t -cf {}".format(
-            self.dhcpd, ip_type, os.path.join(self.stage_dir, filename)
-        ))
+        with self.profile.measure('git', 'commit_and_push',
+                                  files=len(changed)):
+            self.repo.commit_and_push('Update config',
+                                      sanity_check=sanity_check,
+                                      paths=changed)
+        if self.task_watermark is not None:
+            Task.dhcp.filter(claimed=True,
+                             pk__lte=self.task_watermark).delete()
+        self.save_profile()
 
-        if ret != 0:
-            log_msg = 'DHCP build failed due to a syntax error'
-            exception_msg = log_msg + ('\n{0} said:\n{1}'
-                                       .format(self.dhcpd, err))
+    def get_check_command(self, ip_type, filename):
+        return "{} -{} -t -cf {}".format(
+            self.dhcpd, ip_type, os.path.join(self.stage_dir, filename))
 
-            self.error(log_msg)
+    def syntax_error(self):
+        self.error('DHCP build failed due to a syntax error')
 
     def _lock_failure(self, pid):
         fail_mail(
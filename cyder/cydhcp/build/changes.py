@@ -0,0 +1,222 @@
+"""
+Change markers for DHCP builds.
+
+Saving or deleting an object that ends up in the dhcpd config schedules a
+rebuild of the sections of the config it appears in (see
+:func:`Task.schedule_dhcp_rebuild`). A section is one of the blocks
+:class:`DHCPBuilder` writes: a container's legacy classes, a VRF's class, a
+subnet, or a workgroup's group. It's named '<kind>:<pk>', e.g. 'network:5',
+and 'all' means the whole config.
+"""
+from django.db.models.signals import (
+    m2m_changed, post_save, pre_delete, pre_save)
+
+
+ALL = 'all'
+
+# Saving an object only to change these (e.g. a range's usage, which is
+# updated whenever an interface in it is saved) doesn't schedule anything.
+IGNORED_FIELDS = ('created', 'modified', 'last_seen', 'range_usage')
+
+
+def section(kind, pk):
+    return '{0}:{1}'.format(kind, pk)
+
+
+def parse_section(name):
+    """Return the kind and pk of a section, or None for 'all'."""
+    if name == ALL:
+        return None
+    kind, pk = name.split(':')
+    return kind, int(pk)
+
+
+def _sections(kind, pks):
+    return set(section(kind, pk) for pk in pks if pk is not None)
+
+
+def _dynamic_intr_workgroups(**filters):
+    from cyder.cydhcp.interface.dynamic_intr.models import DynamicInterface
+    return _sections('workgroup', DynamicInterface.objects.filter(**filters)
+                                  .values_list('workgroup', flat=True))
+
+
+def _range_vrf(range_):
+    if range_ is None:
+        return set()
+    return _sections('vrf', [range_.network.vrf_id])
+
+
+def _all_sections(obj):
+    return set([ALL])
+
+
+def _network_sections(network):
+    return _sections('network', [network.pk]) | _sections('vrf',
+                                                          [network.vrf_id])
+
+
+def _network_av_sections(av):
+    return _sections('network', [av.entity_id])
+
+
+def _range_sections(range_):
+    from cyder.core.ctnr.models import Ctnr
+    from cyder.cydhcp.network.models import Network
+
+    # Legacy classes have the range's addresses, and hosts' names have its
+    # domain.
+    return (
+        _sections('network', [range_.network_id]) |
+        _sections('vrf', Network.objects.filter(pk=range_.network_id)
+                                        .values_list('vrf', flat=True)) |
+        _sections('ctnr', Ctnr.objects.filter(ranges=range_.pk)
+                                      .values_list('pk', flat=True)) |
+        _dynamic_intr_workgroups(range=range_.pk))
+
+
+def _range_av_sections(av):
+    from cyder.cydhcp.range.models import Range
+    return _sections('network', Range.objects.filter(pk=av.entity_id)
+                                             .values_list('network',
+                                                          flat=True))
+
+
+def _static_intr_sections(intr):
+    return _sections('workgroup', [intr.workgroup_id]) | _range_vrf(intr.range)
+
+
+def _dynamic_intr_sections(intr):
+    from cyder.core.system.models import System
+    return (
+        _sections('workgroup', [intr.workgroup_id]) |
+        _sections('ctnr', System.objects.filter(pk=intr.system_id)
+                                        .values_list('ctnr', flat=True)) |
+        _range_vrf(intr.range))
+
+
+def _workgroup_sections(workgroup):
+    return _sections('workgroup', [workgroup.pk])
+
+
+def _workgroup_av_sections(av):
+    return _sections('workgroup', [av.entity_id])
+
+
+def _system_sections(system):
+    # Dynamic hosts' options can have the system's name, and its dynamic
+    # interfaces are in its container's legacy classes.
+    return (_sections('ctnr', [system.ctnr_id]) |
+            _dynamic_intr_workgroups(system=system.pk))
+
+
+def _domain_sections(domain):
+    # Dynamic hosts are named after their range's domain.
+    return _dynamic_intr_workgroups(range__domain=domain.pk)
+
+
+# For each model whose objects can end up in the dhcpd config, a function
+# that returns the sections an object is in, and the fields that affect
+# them (None means all of them but IGNORED_FIELDS).
+TRACKED_MODELS = {
+    'Ctnr': (_all_sections, ('name',)),
+    'Vrf': (_all_sections, ('name',)),
+    'Network': (_network_sections, None),
+    'NetworkAV': (_network_av_sections, None),
+    'Range': (_range_sections, None),
+    'RangeAV': (_range_av_sections, None),
+    'StaticInterface': (_static_intr_sections, None),
+    'DynamicInterface': (_dynamic_intr_sections, None),
+    'Workgroup': (_workgroup_sections, None),
+    'WorkgroupAV': (_workgroup_av_sections, None),
+    'System': (_system_sections, ('name', 'ctnr_id')),
+    'Domain': (_domain_sections, ('name',)),
+}
+
+
+def get_sections(obj):
+    get, _ = TRACKED_MODELS[type(obj)._meta.object_name]
+    return get(obj)
+
+
+def has_changes(old, new):
+    """Return whether `new` differs from `old` in a way that matters."""
+    _, fields = TRACKED_MODELS[type(new)._meta.object_name]
+    if fields is None:
+        fields = [f.attname for f in new._meta.fields
+                  if f.attname not in IGNORED_FIELDS]
+    return any(getattr(old, f) != getattr(new, f) for f in fields)
+
+
+def schedule(sections):
+    from cyder.core.task.models import Task
+
+    if ALL in sections:
+        sections = [ALL]
+    for name in sorted(sections):
+        Task.schedule_dhcp_rebuild(name)
+
+
+def _is_tracked(sender):
+    return getattr(sender, '_meta', None) and (
+        sender._meta.object_name in TRACKED_MODELS)
+
+
+def _remember_old(sender, instance, raw=False, **kwargs):
+    if raw or not _is_tracked(sender) or instance.pk is None:
+        return
+    old = list(sender._default_manager.filter(pk=instance.pk)[:1])
+    instance._dhcp_old = old[0] if old else None
+
+
+def _saved(sender, instance, created, raw=False, **kwargs):
+    if raw or not _is_tracked(sender):
+        return
+    old = getattr(instance, '_dhcp_old', None)
+    instance._dhcp_old = None
+    if old is None:
+        sections = get_sections(instance)
+    elif has_changes(old, instance):
+        sections = get_sections(old) | get_sections(instance)
+    else:
+        return
+    schedule(sections)
+
+
+def _deleted(sender, instance, **kwargs):
+    if _is_tracked(sender):
+        schedule(get_sections(instance))
+
+
+def _ctnr_ranges_changed(sender, instance, action, reverse, pk_set,
+                         **kwargs):
+    from cyder.core.ctnr.models import Ctnr
+    from cyder.cydhcp.range.models import Range
+
+    if (sender is not Ctnr.ranges.through or
+            action not in ('post_add', 'post_remove', 'pre_clear')):
+        return
+
+    if reverse:
+        ranges = [instance.pk]
+        ctnrs = (instance.ctnr_set.values_list('pk', flat=True)
+                 if pk_set is None else pk_set)
+    else:
+        ctnrs = [instance.pk]
+        ranges = (instance.ranges.values_list('pk', flat=True)
+                  if pk_set is None else pk_set)
+
+    # The ranges' pools allow their containers' classes.
+    schedule(_sections('ctnr', ctnrs) |
+             _sections('network', Range.objects.filter(pk__in=list(ranges))
+                                               .values_list('network',
+                                                            flat=True)))
+
+
+def connect_signals():
+    """Schedule DHCP rebuilds when tracked objects change."""
+    pre_save.connect(_remember_old, dispatch_uid='dhcp_remember_old')
+    post_save.connect(_saved, dispatch_uid='dhcp_saved')
+    pre_delete.connect(_deleted, dispatch_uid='dhcp_deleted')
+    m2m_changed.connect(_ctnr_ranges_changed,
+                        dispatch_uid='dhcp_ctnr_ranges_changed')
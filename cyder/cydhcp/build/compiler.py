@@ -0,0 +1,241 @@
+from bisect import bisect_left
+from collections import defaultdict
+from itertools import chain
+
+from cyder.base.eav.constants import ATTRIBUTE_OPTION, ATTRIBUTE_STATEMENT
+from cyder.base.constants import IP_TYPE_4
+from cyder.core.ctnr.models import Ctnr
+from cyder.cydhcp.constants import DYNAMIC
+from cyder.cydhcp.interface.dynamic_intr.models import DynamicInterface
+from cyder.cydhcp.interface.static_intr.models import StaticInterface
+from cyder.cydhcp.network.models import Network, NetworkAV
+from cyder.cydhcp.range.models import Range, RangeAV
+from cyder.cydhcp.utils import join_dhcp_args
+from cyder.cydhcp.vrf.models import Vrf
+from cyder.cydhcp.workgroup.models import Workgroup, WorkgroupAV
+
+
+def group_by(objects, key):
+    """Return a dict mapping each value of `key` to its objects, in order."""
+    groups = defaultdict(list)
+    for obj in objects:
+        groups[getattr(obj, key)].append(obj)
+    return groups
+
+
+def split_attrs(attrs):
+    """Return the options and the statements in `attrs`, in order."""
+    options = [a for a in attrs
+               if a.attribute.attribute_type == ATTRIBUTE_OPTION]
+    statements = [a for a in attrs
+                  if a.attribute.attribute_type == ATTRIBUTE_STATEMENT]
+    return options, statements
+
+
+def is_host_option(option):
+    return any(x in option.value for x in ['%h', '%i', '%m', '%6m'])
+
+
+class DHCPCompiler(object):
+    """
+    Renders the dhcpd config the same way as
+    :func:`Ctnr.build_legacy_classes`, :func:`Vrf.build_vrf`,
+    :func:`Network.build_subnet` and :func:`Workgroup.build_workgroup`.
+
+    Those query for each object's ranges, interfaces and attributes, so the
+    number of queries a build makes grows with the number of objects. This
+    fetches everything with a fixed number of queries when it's created and
+    renders from indexes in memory instead. Related objects are rendered in
+    order of their pks.
+    """
+
+    def __init__(self):
+        self.ctnrs = list(Ctnr.objects.order_by('pk'))
+        self.vrfs = list(Vrf.objects.order_by('pk'))
+        self.networks = list(Network.objects.select_related('vrf')
+                                            .order_by('pk'))
+        self.workgroups = list(Workgroup.objects.order_by('pk'))
+        self.vrf_networks = group_by(self.networks, 'vrf_id')
+
+        networks = dict((n.pk, n) for n in self.networks)
+        ranges = list(Range.objects.select_related('domain').order_by('pk'))
+        for range_ in ranges:
+            # So Range.get_allow_deny_list can get the VRF without a query.
+            range_.network = networks[range_.network_id]
+        self.ranges = dict((r.pk, r) for r in ranges)
+        self.network_ranges = group_by(ranges, 'network_id')
+
+        ctnrs = dict((c.pk, c) for c in self.ctnrs)
+        self.ctnr_ranges = defaultdict(list)
+        self.range_ctnrs = defaultdict(list)
+        for ctnr_pk, range_pk in (Ctnr.ranges.through.objects
+                                  .order_by('range', 'ctnr')
+                                  .values_list('ctnr', 'range')):
+            self.ctnr_ranges[ctnr_pk].append(self.ranges[range_pk])
+            self.range_ctnrs[range_pk].append(ctnrs[ctnr_pk])
+
+        self.network_attrs = group_by(
+            NetworkAV.objects.select_related('attribute'), 'entity_id')
+        self.range_attrs = group_by(
+            RangeAV.objects.select_related('attribute'), 'entity_id')
+        self.workgroup_attrs = group_by(
+            WorkgroupAV.objects.select_related('attribute'), 'entity_id')
+
+        dynamic_intrs = list(DynamicInterface.objects
+                             .filter(dhcp_enabled=True)
+                             .select_related('system').order_by('pk'))
+        for intr in dynamic_intrs:
+            # So DynamicInterface.get_fqdn doesn't need a query.
+            intr.range = self.ranges[intr.range_id]
+        self.range_dynamic_intrs = group_by(dynamic_intrs, 'range_id')
+        self.workgroup_dynamic_intrs = group_by(dynamic_intrs, 'workgroup_id')
+
+        static_intrs = list(StaticInterface.objects.filter(dhcp_enabled=True)
+                                                   .order_by('pk'))
+        self.workgroup_static_intrs = group_by(static_intrs, 'workgroup_id')
+        # Sorted by address for :func:`get_static_intrs`.
+        self.static_intrs = {}
+        self.static_intr_keys = {}
+        for ip_type, intrs in group_by(static_intrs, 'ip_type').iteritems():
+            intrs.sort(key=lambda i: (i.ip_upper, i.ip_lower, i.pk))
+            self.static_intrs[ip_type] = intrs
+            self.static_intr_keys[ip_type] = [
+                (i.ip_upper, i.ip_lower) for i in intrs]
+
+    def get_static_intrs(self, range_):
+        """
+        Return the DHCP-enabled static interfaces in `range_`, the way
+        :func:`Range.staticinterfaces` finds them.
+        """
+        keys = self.static_intr_keys.get(range_.ip_type, [])
+        if range_.start_upper == range_.end_upper:
+            lo = bisect_left(keys, (range_.start_upper, range_.start_lower))
+            hi = bisect_left(keys, (range_.end_upper, range_.end_lower + 1))
+        else:
+            lo = bisect_left(keys, (range_.start_upper + 1,))
+            hi = bisect_left(keys, (range_.end_upper,))
+        intrs = self.static_intrs.get(range_.ip_type, [])[lo:hi]
+        return sorted(intrs, key=lambda i: i.pk)
+
+    def build_legacy_classes(self, ctnr, ip_type):
+        """See :func:`Ctnr.build_legacy_classes`."""
+        if ip_type == IP_TYPE_4:
+            ranges = [r for r in self.ctnr_ranges[ctnr.pk]
+                      if r.ip_type == '4' and
+                      ((r.range_type == DYNAMIC and r.dhcp_enabled) or
+                       r.start_str == '10.255.255.255')]
+        else:
+            ranges = [r for r in self.ctnr_ranges[ctnr.pk]
+                      if r.ip_type == '6' and r.range_type == DYNAMIC and
+                      r.dhcp_enabled]
+
+        build_str = ""
+        for range_ in ranges:
+            classname = '{0}:{1}:{2}'.format(
+                ctnr.name, range_.start_str, range_.end_str)
+            build_str += (
+                'class "{0}" {{\n'
+                '\tmatch hardware;\n'
+                '}}\n'.format(classname))
+            for client in self.range_dynamic_intrs[range_.pk]:
+                if (client.system.ctnr_id == ctnr.pk and
+                        client.mac is not None):
+                    build_str += client.build_subclass(classname)
+        return build_str
+
+    def build_vrf(self, vrf, ip_type):
+        """See :func:`Vrf.build_vrf`."""
+        build_str = ('class "{0}" {{\n'
+                     '\tmatch hardware;\n'
+                     '}}\n'
+                     .format(vrf.name))
+
+        for network in self.vrf_networks[vrf.pk]:
+            if network.ip_type != ip_type:
+                continue
+            for range_ in self.network_ranges[network.pk]:
+                clients = chain(self.get_static_intrs(range_),
+                                self.range_dynamic_intrs[range_.pk])
+                for client in clients:
+                    build_str += client.build_subclass(vrf.name)
+
+        return build_str
+
+    def build_subnet(self, network):
+        """See :func:`Network.build_subnet`."""
+        network.update_network()
+        options, statements = split_attrs(self.network_attrs[network.pk])
+        ranges = [r for r in self.network_ranges[network.pk]
+                  if r.range_type == DYNAMIC and r.dhcp_enabled]
+        if network.ip_type == IP_TYPE_4:
+            build_str = "\nsubnet {0} netmask {1} {{\n".format(
+                network.network.network, network.network.netmask)
+        else:
+            build_str = "\nsubnet6 {0} netmask {1} {{\n".format(
+                network.network.network, network.network.netmask)
+        build_str += "\t# Network statements\n"
+        build_str += join_dhcp_args(statements)
+        build_str += "\t# Network options\n"
+        build_str += join_dhcp_args(options)
+        if network.dhcpd_raw_include:
+            build_str += "\t# Raw network options\n"
+            build_str += join_dhcp_args(network.dhcpd_raw_include.split("\n"))
+        for range_ in ranges:
+            build_str += self.build_range(range_)
+        build_str += "}\n"
+        return build_str
+
+    def build_range(self, range_):
+        """See :func:`Range.build_range`."""
+        range_options, range_statements = split_attrs(
+            self.range_attrs[range_.pk])
+        build_str = "\tpool {\n"
+        build_str += "\t\t# Pool Statements\n"
+        build_str += "\t\tfailover peer \"dhcp\";\n"
+        build_str += "\t\tdeny dynamic bootp clients;\n"
+        build_str += join_dhcp_args(range_statements, depth=2)
+        if range_options:
+            build_str += "\t\t# Pool Options\n"
+            build_str += join_dhcp_args(range_options, depth=2)
+        if range_.dhcpd_raw_include:
+            build_str += "\t\t# Raw pool includes\n"
+            build_str += "\t\t{0};".format(range_.dhcpd_raw_include)
+        build_str += "\t\t# Allow statements\n"
+        build_str += join_dhcp_args(
+            range_.get_allow_deny_list(ctnrs=self.range_ctnrs[range_.pk]),
+            depth=2)
+        if range_.ip_type == IP_TYPE_4:
+            build_str += "\t\trange {0} {1};\n".format(range_.start_str,
+                                                       range_.end_str)
+        else:
+            build_str += "\t\trange6{0} {1};\n".format(range_.start_str,
+                                                       range_.end_str)
+        build_str += "\t}\n\n"
+        return build_str
+
+    def build_workgroup(self, workgroup, ip_type):
+        """See :func:`Workgroup.build_workgroup`."""
+        dynamic_clients = [
+            c for c in self.workgroup_dynamic_intrs[workgroup.pk]
+            if c.range.ip_type == ip_type]
+        static_clients = [
+            c for c in self.workgroup_static_intrs[workgroup.pk]
+            if c.ip_type == ip_type]
+        if not (static_clients or dynamic_clients):
+            return ''
+        build_str = 'group {{ #{0}\n'.format(workgroup.name)
+        options, statements = split_attrs(self.workgroup_attrs[workgroup.pk])
+        host_options = filter(is_host_option, options)
+        options = [o for o in options if not is_host_option(o)]
+
+        build_str += '\t# Workgroup Options\n'
+        if options:
+            build_str += join_dhcp_args(options)
+        build_str += '\t# Workgroup Statements\n'
+        if statements:
+            build_str += join_dhcp_args(statements)
+        build_str += '\t# Static Hosts in Workgroup\n'
+        for client in chain(dynamic_clients, static_clients):
+            build_str += client.build_host(host_options)
+        build_str += '}\n'
+        return build_str
@@ -0,0 +1,84 @@
+import errno
+import json
+import os
+
+
+# Bump this whenever the way sections are rendered changes so that old cache
+# files are ignored.
+SECTION_CACHE_VERSION = 2
+
+
+class SectionCache(object):
+    """
+    Remembers what each section of the dhcpd config was rendered to so that
+    a build only has to render the sections that changed (see
+    :mod:`cyder.cydhcp.build.changes`).
+
+    Entries are keyed by the section's IP type, kind, and pk. The cache also
+    remembers the checksum of each file it was used to build. If the file in
+    prod doesn't match (e.g. the build that saved the cache wasn't pushed, or
+    someone edited the file), none of that IP type's entries are used.
+
+    If `path` is given, the cache can be loaded from and saved to that file
+    as JSON between builds.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.checksums = {}
+        self.new_entries = {}
+        self.new_checksums = {}
+
+    def load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if data['version'] != SECTION_CACHE_VERSION:
+                return
+            checksums = dict(data['checksums'])
+            entries = dict(((ip_type, kind, pk), section)
+                           for ip_type, kind, pk, section in data['entries'])
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except (KeyError, TypeError, ValueError):
+            # The cache is corrupt, so start over.
+            pass
+        else:
+            self.checksums = checksums
+            self.entries = entries
+
+    def save(self):
+        """
+        Save this build's entries and checksums. Sections that weren't
+        built this time (e.g. deleted networks) are forgotten.
+        """
+        if not self.path:
+            return
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        entries = [key + (section,)
+                   for key, section in self.new_entries.iteritems()]
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': SECTION_CACHE_VERSION,
+                       'checksums': self.new_checksums,
+                       'entries': entries}, f)
+        os.rename(tmp_path, self.path)
+
+    def is_valid(self, ip_type, prod_checksum):
+        return (prod_checksum is not None and
+                self.checksums.get(ip_type) == prod_checksum)
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, data):
+        self.new_entries[key] = data
+
+    def set_checksum(self, ip_type, checksum):
+        self.new_checksums[ip_type] = checksum
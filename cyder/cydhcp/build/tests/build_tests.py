@@ -6,11 +6,16 @@ from django.test import TestCase
 from cyder.base.eav.models import Attribute
 from cyder.base.utils import copy_tree, remove_dir_contents
 from cyder.base.vcs import GitRepo, GitRepoManager, SanityCheckFailure
+from cyder.core.ctnr.models import Ctnr
 from cyder.core.system.models import System
+from cyder.core.task.models import Task
 from cyder.cydhcp.build.builder import DHCPBuilder
+from cyder.cydhcp.build.compiler import DHCPCompiler
 from cyder.cydhcp.interface.dynamic_intr.models import DynamicInterface
 from cyder.cydhcp.network.models import Network, NetworkAV
 from cyder.cydhcp.range.models import Range
+from cyder.cydhcp.vrf.models import Vrf
+from cyder.cydhcp.workgroup.models import Workgroup
 
 
 DHCPBUILD = {
@@ -33,6 +38,8 @@ DHCPBUILD = {
 }
 
 PROD_ORIGIN_DIR = '/tmp/cyder_dhcp_test/prod_origin'
+STUB_DHCPD = '/tmp/cyder_dhcp_test/dhcpd'
+STUB_DHCPD_LOG = '/tmp/cyder_dhcp_test/dhcpd.log'
 
 
 class DHCPBuildTest(TestCase):
@@ -51,6 +58,7 @@ class DHCPBuildTest(TestCase):
     def setUp(self):
         if not os.path.isdir(DHCPBUILD['stage_dir']):
             os.makedirs(DHCPBUILD['stage_dir'])
+        remove_dir_contents(DHCPBUILD['stage_dir'])
 
         if not os.path.isdir(DHCPBUILD['prod_dir']):
             os.makedirs(DHCPBUILD['prod_dir'])
@@ -146,3 +154,173 @@ class DHCPBuildTest(TestCase):
 
         self.builder.repo.line_decrease_limit = 100
         self.build_and_push()
+
+    def test_change_tracking(self):
+        """Test that builds only happen and render what changes call for"""
+
+        target = os.path.join(DHCPBUILD['stage_dir'],
+                              DHCPBUILD['files_v4']['target_file'])
+
+        self.build_and_push(sanity_check=False)
+        self.assertFalse(Task.dhcp.exists())
+
+        # Updating a range's usage doesn't change the config.
+        Range.objects.get(name='Test range 1').save()
+        self.assertFalse(Task.dhcp.exists())
+
+        os.remove(target)
+        self.build_and_push(sanity_check=False)
+        self.assertFalse(os.path.exists(target))  # Nothing was built.
+
+        network = Network.objects.get(network_str='192.168.0.0/16')
+        NetworkAV.objects.create(
+            entity=network,
+            attribute=Attribute.objects.get(attribute_type='o',
+                                            name='routers'),
+            value='192.168.0.1',
+        )
+        self.assertEqual(
+            list(Task.dhcp.values_list('task', flat=True)),
+            ['network:{0}'.format(network.pk)])
+
+        self.build_and_push(sanity_check=False)
+        self.assertFalse(Task.dhcp.exists())
+        with open(target) as f:
+            incremental = f.read()
+        self.assertIn('192.168.0.1', incremental)
+
+        self.builder.build(force=True)
+        with open(target) as f:
+            self.assertEqual(f.read(), incremental)
+
+    def test_split_config(self):
+        """Test that split configs match whole ones and change piecemeal"""
+
+        target_file = DHCPBUILD['files_v4']['target_file']
+        self.builder.build(force=True)
+        with open(os.path.join(DHCPBUILD['stage_dir'], target_file)) as f:
+            whole = f.read()
+
+        self.builder = DHCPBuilder(verbose=False, split_config=True,
+                                   include_dir='/etc/dhcp', **DHCPBUILD)
+        self.build_and_push(sanity_check=False)
+        self.assertEqual(
+            self.builder.read_config(target_file, DHCPBUILD['prod_dir']),
+            whole)
+        with open(os.path.join(DHCPBUILD['prod_dir'], target_file)) as f:
+            for line in f:
+                self.assertTrue(line.startswith(
+                    'include "/etc/dhcp/{0}.d/'.format(target_file)))
+
+        network = Network.objects.get(network_str='192.168.0.0/16')
+        NetworkAV.objects.create(
+            entity=network,
+            attribute=Attribute.objects.get(attribute_type='o',
+                                            name='routers'),
+            value='192.168.0.1',
+        )
+        self.build_and_push(sanity_check=False)
+        self.assertEqual(
+            os.listdir(os.path.join(DHCPBUILD['stage_dir'],
+                                    target_file + '.d')),
+            ['network-{0}.conf'.format(network.pk)])
+
+    def make_stub_dhcpd(self, returncode):
+        """Make a `dhcpd` that logs its arguments and exits."""
+        with open(STUB_DHCPD, 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'echo "$@" >> {0}\n'
+                    'exit {1}\n'.format(STUB_DHCPD_LOG, returncode))
+        os.chmod(STUB_DHCPD, 0755)
+        if os.path.exists(STUB_DHCPD_LOG):
+            os.remove(STUB_DHCPD_LOG)
+
+    def build_with_checks(self, **kwargs):
+        """Build with both files checked and return their contents."""
+        files = {'target_file': None, 'check_file': 'dhcpd.conf'}
+        builder = DHCPBuilder(
+            verbose=False, dhcpd=STUB_DHCPD,
+            **dict(DHCPBUILD, files_v4=dict(files, target_file='dhcpd.conf.4'),
+                   files_v6=dict(files, target_file='dhcpd.conf.6'), **kwargs))
+        builder.build(force=True)
+        contents = []
+        for target_file in ('dhcpd.conf.4', 'dhcpd.conf.6'):
+            with open(os.path.join(DHCPBUILD['stage_dir'], target_file)) as f:
+                contents.append(f.read())
+        return contents
+
+    def test_parallel_build(self):
+        """Test that building v4 and v6 at the same time changes nothing"""
+
+        self.make_stub_dhcpd(0)
+        serial = self.build_with_checks(jobs=1)
+        parallel = self.build_with_checks(jobs=2)
+        self.assertEqual(serial, parallel)
+
+        with open(STUB_DHCPD_LOG) as f:
+            checks = sorted(line.split()[0] for line in f)
+        self.assertEqual(checks, ['-4', '-4', '-6', '-6'])
+
+        self.make_stub_dhcpd(1)
+        self.assertRaisesRegexp(
+            Exception, 'DHCP build failed due to a syntax error',
+            self.build_with_checks, jobs=2)
+
+    def test_daemon_retry(self):
+        """Test that the builder daemon retries a build that failed"""
+        from cyder.management.commands.builder_daemon import (
+            BuildTrigger, get_dhcp_fingerprint)
+
+        Task.dhcp.all().delete()
+        trigger = BuildTrigger(debounce=5, max_delay=60)
+        Task.schedule_dhcp_rebuild('all')
+        pending, fingerprint = get_dhcp_fingerprint()
+        trigger.update(fingerprint, pending=pending, now=0)
+        self.assertTrue(trigger.is_due(now=5))
+
+        # The build claims the tasks and then fails before pushing.
+        self.builder.get_scheduled()
+        trigger.failed(now=5)
+
+        pending, fingerprint = get_dhcp_fingerprint()
+        self.assertTrue(pending)
+        trigger.update(fingerprint, pending=pending, now=10)
+        self.assertFalse(trigger.is_due(now=10))
+        self.assertTrue(trigger.is_due(now=65))
+
+    def test_daemon_lock_held(self):
+        """Test that the builder daemon retries on the next poll when
+        another build has the lock"""
+        from cyder.management.commands.builder_daemon import (
+            BuildTrigger, Command)
+
+        command = Command()
+        command.builder_opts = {'quiet': True, 'report_lock_failure': False}
+        trigger = BuildTrigger(debounce=5, max_delay=60)
+        trigger.update('fingerprint', now=0)
+
+        def build():
+            with DHCPBuilder(**dict(DHCPBUILD, **command.builder_opts)):
+                self.fail('The lock was acquired twice')
+
+        with self.builder:  # A manual build
+            command.run_build(trigger, build)
+        self.assertTrue(trigger.is_due(now=5))
+
+    def test_compiler(self):
+        """Test that the compiler renders the same config as the models"""
+
+        compiler = DHCPCompiler()
+        for ip_type in ('4', '6'):
+            for ctnr in Ctnr.objects.all():
+                self.assertEqual(compiler.build_legacy_classes(ctnr, ip_type),
+                                 ctnr.build_legacy_classes(ip_type))
+            for vrf in Vrf.objects.all():
+                self.assertEqual(compiler.build_vrf(vrf, ip_type),
+                                 vrf.build_vrf(ip_type))
+            for workgroup in Workgroup.objects.all():
+                self.assertEqual(compiler.build_workgroup(workgroup, ip_type),
+                                 workgroup.build_workgroup(ip_type))
+        for network in Network.objects.filter(enabled=True):
+            self.assertEqual(compiler.build_subnet(network),
+                             network.build_subnet())
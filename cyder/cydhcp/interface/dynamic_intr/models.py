@@ -122,29 +122,33 @@ class DynamicInterface(BaseModel, ObjectUrlMixin, ExpirableMixin):
 
     @transaction_atomic
     def delete(self, *args, **kwargs):
+        from cyder.cydhcp.range.counters import dynamic_interface_changed
+
         delete_system = kwargs.pop('delete_system', True)
         update_range_usage = kwargs.pop('update_range_usage', True)
-        rng = self.range
+        range_id = self.range_id if self.dhcp_enabled else None
         if delete_system:
             if (not self.system.dynamicinterface_set.exclude(
                     id=self.id).exists() and
                     not self.system.staticinterface_set.exists()):
                 self.system.delete(commit=False)
         super(DynamicInterface, self).delete()
-        if rng and update_range_usage:
-            rng.save(commit=False)
+        if update_range_usage:
+            dynamic_interface_changed(old_range_id=range_id)
 
     @transaction_atomic
     def save(self, *args, **kwargs):
+        from cyder.cydhcp.range.counters import dynamic_interface_changed
+
         self.full_clean()
 
         update_range_usage = kwargs.pop('update_range_usage', True)
-        old_range = None
+        old_range_id = None
         if self.id is not None:
-            old_range = DynamicInterface.objects.get(id=self.id).range
+            old = DynamicInterface.objects.get(id=self.id)
+            old_range_id = old.range_id if old.dhcp_enabled else None
 
         super(DynamicInterface, self).save()
-        if self.range and update_range_usage:
-            self.range.save(commit=False)
-            if old_range:
-                old_range.save(commit=False)
+        if update_range_usage:
+            dynamic_interface_changed(
+                old_range_id, self.range_id if self.dhcp_enabled else None)
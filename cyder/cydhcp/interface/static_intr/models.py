@@ -132,25 +132,25 @@ class StaticInterface(BaseAddressRecord, BasePTR, ExpirableMixin):
 
     @transaction_atomic
     def save(self, *args, **kwargs):
+        from cyder.cydhcp.range.counters import address_changed, get_ip_key
+
         self.full_clean()
 
         update_range_usage = kwargs.pop('update_range_usage', True)
-        old_range = None
+        old_ip_key = None
         if self.id is not None:
-            old_range = StaticInterface.objects.get(id=self.id).range
+            old_ip_key = get_ip_key(StaticInterface.objects.get(id=self.id))
 
         super(StaticInterface, self).save(*args, **kwargs)
         self.schedule_zone_rebuild()
         if update_range_usage:
-            new_range = self.range
-            if new_range:
-                new_range.save(commit=False)
-            if old_range:
-                old_range.save(commit=False)
+            address_changed(self, old_ip_key, get_ip_key(self))
 
     @transaction_atomic
     def delete(self, *args, **kwargs):
-        rng = self.range
+        from cyder.cydhcp.range.counters import address_changed, get_ip_key
+
+        ip_key = get_ip_key(self)
         update_range_usage = kwargs.pop('update_range_usage', True)
         delete_system = kwargs.pop('delete_system', True)
 
@@ -161,8 +161,8 @@ class StaticInterface(BaseAddressRecord, BasePTR, ExpirableMixin):
                 self.system.delete(commit=False)
 
         super(StaticInterface, self).delete(*args, **kwargs)
-        if rng and update_range_usage:
-            rng.save(commit=False)
+        if update_range_usage:
+            address_changed(self, old_ip_key=ip_key)
 
     def schedule_zone_rebuild(self):
         if self.domain.soa is not None:
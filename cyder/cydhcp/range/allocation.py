@@ -0,0 +1,106 @@
+"""
+Finds free addresses in a range of addresses.
+
+An address is taken if an A/AAAA record, a PTR, or a static interface has
+it. The taken addresses are fetched as integers with one `values_list` query
+per model, and then free ones are found without looking at each record
+again:
+
+    *   In ranges of at most `OCCUPANCY_MAP_LIMIT` addresses (any IPv4 range
+        that's in use), each address gets a byte in an occupancy map, and
+        free addresses are found by searching the map for zero bytes, which
+        `bytearray.find` does in C. A /16 takes 64 KiB.
+    *   In bigger ranges (IPv6), the taken addresses are sorted and the free
+        addresses are read off the gaps between them.
+"""
+from itertools import islice
+
+import ipaddr
+from django.db.models import Q
+
+from cyder.base.constants import IP_TYPE_6
+from cyder.cydhcp.interface.static_intr.models import StaticInterface
+from cyder.cydhcp.utils import one_to_two, two_to_one
+from cyder.cydns.address_record.models import AddressRecord
+from cyder.cydns.ptr.models import PTR
+
+
+OCCUPANCY_MAP_LIMIT = 1 << 24
+
+
+def ip_range_q(start, end, ip_type):
+    """
+    Return a Q object that matches the objects whose addresses are between
+    `start` and `end` (integers), inclusive.
+    """
+    start_upper, start_lower = one_to_two(start)
+    end_upper, end_lower = one_to_two(end)
+    if start_upper == end_upper:
+        q = Q(ip_upper=start_upper, ip_lower__gte=start_lower,
+              ip_lower__lte=end_lower)
+    else:
+        q = (Q(ip_upper=start_upper, ip_lower__gte=start_lower) |
+             Q(ip_upper__gt=start_upper, ip_upper__lt=end_upper) |
+             Q(ip_upper=end_upper, ip_lower__lte=end_lower))
+    return q & Q(ip_type=ip_type)
+
+
+def get_taken_ips(start, end, ip_type):
+    """
+    Yield the addresses between `start` and `end` (integers, inclusive) that
+    are taken, as integers, in no particular order and possibly more than
+    once.
+    """
+    q = ip_range_q(start, end, ip_type)
+    for model in (AddressRecord, PTR, StaticInterface):
+        for upper, lower in model.objects.filter(q).values_list(
+                'ip_upper', 'ip_lower').iterator():
+            yield two_to_one(upper, lower)
+
+
+def _iter_free_map(start, end, taken):
+    occupancy = bytearray(end - start + 1)  # All zeros, i.e. free
+    for ip in taken:
+        occupancy[ip - start] = 1
+    i = occupancy.find(b'\x00')
+    while i != -1:
+        yield start + i
+        i = occupancy.find(b'\x00', i + 1)
+
+
+def _iter_free_gaps(start, end, taken):
+    next_free = start
+    for ip in sorted(set(taken)):
+        while next_free < ip:
+            yield next_free
+            next_free += 1
+        next_free = ip + 1
+    while next_free <= end:
+        yield next_free
+        next_free += 1
+
+
+def iter_free_ips(start, end, ip_type):
+    """
+    Yield the free addresses between `start` and `end` (integers, inclusive)
+    as integers, lowest first.
+    """
+    taken = get_taken_ips(start, end, ip_type)
+    if end - start < OCCUPANCY_MAP_LIMIT:
+        return _iter_free_map(start, end, taken)
+    else:
+        return _iter_free_gaps(start, end, taken)
+
+
+def find_free_ips(start, end, ip_type, count=1):
+    """
+    Return a list of the lowest `count` free addresses between `start` and
+    `end` (integers, inclusive) as IPv4Address or IPv6Address objects. It's
+    shorter than `count` if there aren't enough.
+    """
+    if ip_type == IP_TYPE_6:
+        IPKlass = ipaddr.IPv6Address
+    else:
+        IPKlass = ipaddr.IPv4Address
+    return [IPKlass(ip)
+            for ip in islice(iter_free_ips(start, end, ip_type), count)]
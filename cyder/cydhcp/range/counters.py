@@ -0,0 +1,141 @@
+"""
+Keeps each range's count of used addresses (`Range.used_ips`) up to date as
+addresses are taken and freed, so saving a record doesn't mean recounting
+its whole range.
+
+A static range's used addresses are the ones that an A/AAAA record, a PTR,
+or a static interface has. Several objects with the same address count
+once. A dynamic range's are its DHCP-enabled dynamic interfaces.
+:func:`rebuild_range_usage` recounts every range from scratch.
+"""
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+
+import ipaddr
+from django.db.models import Count
+
+from cyder.cydhcp.constants import DYNAMIC, STATIC
+from cyder.cydhcp.interface.dynamic_intr.models import DynamicInterface
+from cyder.cydhcp.interface.static_intr.models import StaticInterface
+from cyder.cydhcp.range.models import Range
+from cyder.cydhcp.range.utils import find_range
+from cyder.cydhcp.utils import four_to_two, two_to_one
+from cyder.cydns.address_record.models import AddressRecord
+from cyder.cydns.ptr.models import PTR
+
+
+ADDRESS_MODELS = (AddressRecord, PTR, StaticInterface)
+
+
+def get_ip_key(obj):
+    """
+    Return the address of an A/AAAA record, PTR, or static interface as
+    (ip_type, ip_upper, ip_lower).
+    """
+    return obj.ip_type, obj.ip_upper, obj.ip_lower
+
+
+def is_ip_taken(ip_key, exclude=None):
+    """
+    Return whether an A/AAAA record, PTR, or static interface other than
+    `exclude` has the address `ip_key` (see :func:`get_ip_key`).
+    """
+    ip_type, ip_upper, ip_lower = ip_key
+    for model in ADDRESS_MODELS:
+        objects = model.objects.filter(ip_type=ip_type, ip_upper=ip_upper,
+                                       ip_lower=ip_lower)
+        if isinstance(exclude, model) and exclude.pk is not None:
+            objects = objects.exclude(pk=exclude.pk)
+        if objects.exists():
+            return True
+    return False
+
+
+def _find_static_range(ip_key):
+    ip_type, ip_upper, ip_lower = ip_key
+    ip_str = str(ipaddr.IPAddress(two_to_one(ip_upper, ip_lower),
+                                  version=int(ip_type)))
+    rng = find_range(ip_str)
+    if rng is not None and rng.range_type == STATIC:
+        return rng
+
+
+def address_changed(obj, old_ip_key=None, new_ip_key=None):
+    """
+    Update the counters of the static ranges that `obj` (an A/AAAA record,
+    PTR, or static interface) left and entered when its address changed
+    from `old_ip_key` to `new_ip_key`. Either is None if `obj` was just
+    created or deleted. Call this after the change is saved.
+    """
+    if old_ip_key == new_ip_key:
+        return
+    if old_ip_key is not None and not is_ip_taken(old_ip_key, exclude=obj):
+        rng = _find_static_range(old_ip_key)
+        if rng:
+            rng.add_used_ips(-1)
+    if new_ip_key is not None and not is_ip_taken(new_ip_key, exclude=obj):
+        rng = _find_static_range(new_ip_key)
+        if rng:
+            rng.add_used_ips(1)
+
+
+def dynamic_interface_changed(old_range_id=None, new_range_id=None):
+    """
+    Update the counters of the dynamic ranges a DHCP-enabled dynamic
+    interface left and entered. Either is None if the interface didn't
+    count there (it was created, deleted, or had DHCP turned on or off).
+    """
+    if old_range_id == new_range_id:
+        return
+    for range_id, delta in ((old_range_id, -1), (new_range_id, 1)):
+        if range_id is None:
+            continue
+        for rng in Range.objects.filter(pk=range_id, range_type=DYNAMIC):
+            rng.add_used_ips(delta)
+
+
+def get_taken_ips():
+    """
+    Return the taken addresses of each IP type as sorted lists of distinct
+    integers.
+    """
+    taken = defaultdict(set)
+    for model in ADDRESS_MODELS:
+        for ip_type, ip_upper, ip_lower in model.objects.values_list(
+                'ip_type', 'ip_upper', 'ip_lower').iterator():
+            taken[ip_type].add(two_to_one(ip_upper, ip_lower))
+    return dict((ip_type, sorted(ips)) for ip_type, ips in taken.iteritems())
+
+
+def rebuild_range_usage(dry_run=False):
+    """
+    Recount the used addresses of every range with a fixed number of
+    queries and fix the ranges whose counters are off. Return a list of
+    (range, old count, new count) for them.
+    """
+    taken = get_taken_ips()
+    dynamic_counts = dict(
+        DynamicInterface.objects.filter(dhcp_enabled=True)
+                                .values_list('range')
+                                .annotate(count=Count('pk')))
+
+    fixed = []
+    for rng in Range.objects.order_by('pk'):
+        if rng.range_type == STATIC:
+            start, end = four_to_two(rng.start_upper, rng.start_lower,
+                                     rng.end_upper, rng.end_lower)
+            ips = taken.get(rng.ip_type, [])
+            count = bisect_right(ips, end) - bisect_left(ips, start)
+        else:
+            count = dynamic_counts.get(rng.pk, 0)
+
+        old_count, old_usage = rng.used_ips, rng.range_usage
+        rng.used_ips = count
+        rng.range_usage = rng.get_usage()
+        if (count, rng.range_usage) == (old_count, old_usage):
+            continue
+        fixed.append((rng, old_count, count))
+        if not dry_run:
+            Range.objects.filter(pk=rng.pk).update(
+                used_ips=rng.used_ips, range_usage=rng.range_usage)
+    return fixed
@@ -2,6 +2,8 @@
 
 from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
 
 from cyder.base.constants import IP_TYPES, IP_TYPE_4, IP_TYPE_6
 from cyder.base.eav.constants import ATTRIBUTE_OPTION, ATTRIBUTE_STATEMENT
@@ -16,17 +18,23 @@ from cyder.cydhcp.constants import (ALLOW_OPTIONS, ALLOW_ANY, ALLOW_KNOWN,
                                     STATIC, DYNAMIC)
 from cyder.cydhcp.interface.static_intr.models import StaticInterface
 from cyder.cydhcp.network.models import Network
+from cyder.cydhcp.range.allocation import find_free_ips, get_taken_ips
+from cyder.cydhcp.range.overlaps import find_overlapping_range
+from cyder.cydhcp.range.utils import invalidate_range_index
 from cyder.cydhcp.utils import (IPFilter, four_to_two, join_dhcp_args,
                                 start_end_filter)
 from cyder.cydns.models import ViewMixin
 from cyder.cydns.domain.models import Domain
-from cyder.cydns.address_record.models import AddressRecord
 from cyder.cydns.ip.models import ipv6_to_longs
-from cyder.cydns.ptr.models import PTR
 
 import ipaddr
 
 
+# The fields that decide which addresses count toward a range's usage.
+USAGE_FIELDS = ('range_type', 'ip_type', 'start_upper', 'start_lower',
+                'end_upper', 'end_lower')
+
+
 class Range(BaseModel, ViewMixin, ObjectUrlMixin):
     """
     Ranges live inside networks; their start ip address is greater than or
@@ -96,6 +104,8 @@ class Range(BaseModel, ViewMixin, ObjectUrlMixin):
     description = models.TextField(blank=True)
 
     range_usage = models.IntegerField(max_length=3, null=True, blank=True)
+    # How many addresses are used. See cyder.cydhcp.range.counters.
+    used_ips = models.IntegerField(default=0, editable=False)
 
     search_fields = ('start_str', 'end_str', 'name',
                      'description', 'dhcpd_raw_include')
@@ -202,7 +212,18 @@ class Range(BaseModel, ViewMixin, ObjectUrlMixin):
         self.full_clean()
 
         update_range_usage = kwargs.pop('update_range_usage', True)
-        if update_range_usage:
+        # The counter is kept up to date as addresses are taken and freed
+        # (see cyder.cydhcp.range.counters), so the range is only recounted
+        # when it's new or covers different addresses. Otherwise the stored
+        # count is kept, since ours may be out of date.
+        old = list(Range.objects.filter(pk=self.pk).values_list(
+            'used_ips', *USAGE_FIELDS)) if self.pk else []
+        if old and (not update_range_usage or old[0][1:] ==
+                    tuple(getattr(self, f) for f in USAGE_FIELDS)):
+            self.used_ips = old[0][0]
+            self.range_usage = self.get_usage()
+        elif update_range_usage:
+            self.used_ips = self.count_used_ips()
             self.range_usage = self.get_usage()
         super(Range, self).save(*args, **kwargs)
 
@@ -282,7 +303,12 @@ class Range(BaseModel, ViewMixin, ObjectUrlMixin):
 
         super(Range, self).delete(*args, **kwargs)
 
-    def get_allow_deny_list(self):
+    def get_allow_deny_list(self, ctnrs=None):
+        """
+        `ctnrs` is the range's containers, if they've already been fetched.
+        """
+        if ctnrs is None:
+            ctnrs = self.ctnr_set.all()
         if self.allow == ALLOW_ANY:
             allow = []
         elif self.allow == ALLOW_KNOWN:
@@ -291,7 +317,7 @@ class Range(BaseModel, ViewMixin, ObjectUrlMixin):
             allow += [
                 'allow members of "{0}:{1}:{2}"'.format(
                     ctnr.name, self.start_str, self.end_str)
-                for ctnr in self.ctnr_set.all()]
+                for ctnr in ctnrs]
         else:
             allow = []
             if self.allow == ALLOW_VRF:
@@ -301,7 +327,7 @@ class Range(BaseModel, ViewMixin, ObjectUrlMixin):
                 allow += [
                     'allow members of "{0}:{1}:{2}"'.format(
                         ctnr.name, self.start_str, self.end_str)
-                    for ctnr in self.ctnr_set.all()]
+                    for ctnr in ctnrs]
             if not allow:
                 allow += ['deny unknown-clients']
 
@@ -309,21 +335,14 @@ class Range(BaseModel, ViewMixin, ObjectUrlMixin):
 
     def check_for_overlaps(self):
         """
-        This function will look at all the other ranges and make sure we don't
-        overlap with any of them.
+        Make sure this range doesn't overlap any other range. To check many
+        ranges at once, see :mod:`cyder.cydhcp.range.overlaps`.
         """
-        self._range_ips()
-
-        for oldrange in Range.objects.all():
-            if oldrange.pk == self.pk:
-                continue
-            oldrange._range_ips()
-            #the range being tested is above this range
-            if self._start > oldrange._end:
-                continue
-            # start > end
-            if self._end < oldrange._start:
-                continue
+        start, end = four_to_two(
+            self.start_upper, self.start_lower, self.end_upper, self.end_lower)
+        oldrange = find_overlapping_range(start, end, self.ip_type,
+                                          exclude=self.pk)
+        if oldrange is not None:
             raise ValidationError(
                 u"Old range {0} would overlap with new range {1}".format(
                     oldrange.get_ip_str(padded=False),
@@ -344,7 +363,7 @@ class Range(BaseModel, ViewMixin, ObjectUrlMixin):
             build_str += join_dhcp_args(range_options, depth=2)
         if self.dhcpd_raw_include:
             build_str += "\t\t# Raw pool includes\n"
-            build_str += "\t\t{0};".format(self.dhcp_raw_include)
+            build_str += "\t\t{0};".format(self.dhcpd_raw_include)
         build_str += "\t\t# Allow statements\n"
         build_str += join_dhcp_args(self.get_allow_deny_list(), depth=2)
         if self.ip_type == IP_TYPE_4:
@@ -362,70 +381,92 @@ class Range(BaseModel, ViewMixin, ObjectUrlMixin):
         self.ipf = IPFilter(self.start_str, self.end_str, self.network.ip_type,
                             object_=self)
 
-    def get_usage(self):
-        if self.range_type == 'st':
-            from cyder.cydhcp.range.range_usage import range_usage
-            _, usage = range_usage(self.start_lower, self.end_lower,
-                                   self.ip_type)
+    def count_used_ips(self):
+        """Count the used addresses in the range from scratch."""
+        if self.range_type == STATIC:
+            start, end = four_to_two(self.start_upper, self.start_lower,
+                                     self.end_upper, self.end_lower)
+            return len(set(get_taken_ips(start, end, self.ip_type)))
         else:
             DynamicInterface = models.get_model('cyder', 'dynamicinterface')
-            used = float(DynamicInterface.objects.filter(
-                range=self, dhcp_enabled=True).count())
-            capacity = float(self.end_lower - self.start_lower + 1)
-            usage = (used/capacity)*100
+            return DynamicInterface.objects.filter(
+                range=self, dhcp_enabled=True).count()
 
-        return usage
+    def get_usage(self):
+        """Return the percentage of the range's addresses that are used."""
+        start, end = four_to_two(self.start_upper, self.start_lower,
+                                 self.end_upper, self.end_lower)
+        return int((float(self.used_ips) / (end - start + 1)) * 100)
+
+    def add_used_ips(self, delta):
+        """
+        Add `delta` to the range's count of used addresses and update its
+        usage. The row is updated in place, so concurrent updates don't get
+        lost and nothing else about the range is saved.
+        """
+        ranges = Range.objects.filter(pk=self.pk)
+        if not ranges.update(used_ips=F('used_ips') + delta):
+            return  # The range was deleted.
+        self.used_ips = ranges.values_list('used_ips', flat=True)[0]
+        self.range_usage = self.get_usage()
+        ranges.update(range_usage=self.range_usage)
 
     def get_next_ip(self):
         """Finds the most appropriate IP address within a range. If it can't
-        find an IP it returns None. If it finds an IP it returns an IPv4Address
-        object.
+        find an IP it returns None. If it finds an IP it returns an
+        IPv4Address or IPv6Address object.
 
-            :returns: ipaddr.IPv4Address
+            :returns: ipaddr.IPv4Address or ipaddr.IPv6Address
         """
-        if self.network.ip_type != '4':
-            return None
-        elif self.ip_type != '4':
-            return None
-
-        ip = find_free_ip(self.start_lower, self.end_lower, ip_type='4')
-        if ip:
-            return ip
-        else:
-            return None
+        ips = self.get_next_ips(1)
+        return ips[0] if ips else None
 
-    def bind_render_record(self, **kwargs):
+    def get_next_ips(self, count):
+        """Finds the `count` lowest free IP addresses within a range. Returns
+        fewer if there aren't enough. See
+        :mod:`cyder.cydhcp.range.allocation`.
+
+            :returns: list of ipaddr.IPv4Address or ipaddr.IPv6Address
+        """
+        start, end = four_to_two(self.start_upper, self.start_lower,
+                                 self.end_upper, self.end_lower)
+        return find_free_ips(start, end, self.ip_type, count=count)
+
+    def iter_bind_records(self, reverse=False):
+        """
+        Yield the $GENERATE lines that cover this range, one for each /24 it
+        touches. Static and IPv6 ranges don't have any.
+        """
         if self.range_type == STATIC or self.ip_type == IP_TYPE_6:
-            return ""
+            return
 
         DEFAULT_TTL = 3600
-        reverse = kwargs.pop('reverse', False)
-        built = ""
-        start = map(int, self.start_str.split("."))
-        end = map(int, self.end_str.split("."))
-        for a in range(start[0], end[0] + 1):
-            b1 = start[1] if a == start[0] else 0
-            b2 = end[1] if a == end[0] else 255
-            for b in range(b1, b2 + 1):
-                c1 = start[2] if (a, b) == tuple(start[:2]) else 0
-                c2 = end[2] if (a, b) == tuple(end[:2]) else 255
-                for c in range(c1, c2 + 1):
-                    d1 = start[3] if (a, b, c) == tuple(start[:3]) else 0
-                    d2 = end[3] if (a, b, c) == tuple(end[:3]) else 255
-                    host = "{0}-{1}-{2}-$.{3}.".format(a, b, c, self.domain)
-                    if reverse:
-                        ip = "$.{2}.{1}.{0}.in-addr.arpa.".format(a, b, c)
-                        template = ("$GENERATE {3:>3}-{4:<3}  {1:44} {2}  "
-                                    "IN  PTR     {0}")
-                    else:
-                        ip = "{0}.{1}.{2}.$".format(a, b, c)
-                        template = ("$GENERATE {3:>3}-{4:<3}  {0:44} {2}  "
-                                    "IN  A       {1}")
-
-                    rec = template.format(host, ip, DEFAULT_TTL, d1, d2)
-                    built = "\n".join([built, rec]).strip()
-
-        return built
+        host = '%d-%d-%d-$.' + '{0}.'.format(self.domain).replace('%', '%%')
+        if reverse:
+            ip = '$.%d.%d.%d.in-addr.arpa.'
+            template = ('$GENERATE %3d-%-3d  %-44s {0}  IN  PTR     %s'
+                        .format(DEFAULT_TTL))
+        else:
+            ip = '%d.%d.%d.$'
+            template = ('$GENERATE %3d-%-3d  %-44s {0}  IN  A       %s'
+                        .format(DEFAULT_TTL))
+
+        start = int(ipaddr.IPv4Address(self.start_str))
+        end = int(ipaddr.IPv4Address(self.end_str))
+        # Each /24 is a block of 256 addresses. Only the first and last
+        # blocks can be partial.
+        for block in xrange(start >> 8, (end >> 8) + 1):
+            a, b, c = block >> 16, (block >> 8) & 0xff, block & 0xff
+            d1 = start & 0xff if block == start >> 8 else 0
+            d2 = end & 0xff if block == end >> 8 else 255
+            if reverse:
+                yield template % (d1, d2, ip % (c, b, a), host % (a, b, c))
+            else:
+                yield template % (d1, d2, host % (a, b, c), ip % (a, b, c))
+
+    def bind_render_record(self, **kwargs):
+        return '\n'.join(
+            self.iter_bind_records(reverse=kwargs.pop('reverse', False)))
 
 
 def find_free_ip(start, end, ip_type='4'):
@@ -436,37 +477,19 @@ def find_free_ip(start, end, ip_type='4'):
     :type end: int
     :param ip_type: The type of IP you are looking for.
     :type ip_type: str either '4' or '6'
+    :returns: ipaddr.IPv4Address or ipaddr.IPv6Address, or None if the range
+        is full
     """
-    if ip_type == IP_TYPE_4:
-        records = AddressRecord.objects.filter(ip_upper=0, ip_lower__gte=start,
-                                               ip_lower__lte=end)
-        ptrs = PTR.objects.filter(ip_upper=0, ip_lower__gte=start,
-                                  ip_lower__lte=end)
-        intrs = StaticInterface.objects.filter(ip_upper=0, ip_lower__gte=start,
-                                               ip_lower__lte=end)
-        if not records and not intrs:
-            ip = ipaddr.IPv4Address(start)
-            return ip
-        for i in xrange(start, end + 1):
-            taken = False
-            for record in records:
-                if record.ip_lower == i:
-                    taken = True
-                    break
-            for ptr in ptrs:
-                if ptr.ip_lower == i:
-                    taken = True
-                    break
-            if not taken:
-                for intr in intrs:
-                    if intr.ip_lower == i:
-                        taken = True
-                        break
-            if not taken:
-                ip = ipaddr.IPv4Address(i)
-                return ip
-    else:
-        raise NotImplemented
+    ips = find_free_ips(start, end, ip_type)
+    return ips[0] if ips else None
+
+
+def range_changed(sender, **kwargs):
+    invalidate_range_index()
+
+
+post_save.connect(range_changed, sender=Range)
+post_delete.connect(range_changed, sender=Range)
 
 
 class RangeAV(EAVBase):
@@ -478,5 +501,18 @@ class RangeAV(EAVBase):
     attribute = EAVAttributeField(Attribute)
 
 
+class RangeIndexVersion(models.Model):
+    """
+    A single row whose version changes in the same transaction as every
+    range save and delete, so each process can tell whether its range index
+    (see :class:`cyder.cydhcp.range.utils.RangeIndex`) is out of date.
+    """
+    version = models.CharField(max_length=32)
+
+    class Meta:
+        app_label = 'cyder'
+        db_table = 'range_index_version'
+
+
 class RangeOverflowError(ValidationError):
     pass
@@ -0,0 +1,123 @@
+"""
+Finds ranges that overlap each other.
+
+Two ranges of the same IP type overlap if each one starts at or before the
+other one's end.
+
+*   A single range is checked with one query that asks for an overlapping
+    range. The query compares its bounds with the other ranges', so it can
+    use the index on their bounds.
+*   A batch of proposed ranges (e.g. a bulk import) is checked by fetching
+    the bounds of every existing range once. All of them are sorted by
+    (ip_type, start, end), and then one pass over them finds every
+    overlap. This takes O(n log n) time in Python instead of one query per
+    range.
+"""
+from django.core.exceptions import ValidationError
+from django.db.models import get_model, Q
+
+import ipaddr
+
+from cyder.cydhcp.utils import one_to_two, two_to_one
+
+
+def _le_q(field, ip):
+    upper, lower = one_to_two(ip)
+    return (Q(**{field + '_upper__lt': upper}) |
+            Q(**{field + '_upper': upper, field + '_lower__lte': lower}))
+
+
+def _ge_q(field, ip):
+    upper, lower = one_to_two(ip)
+    return (Q(**{field + '_upper__gt': upper}) |
+            Q(**{field + '_upper': upper, field + '_lower__gte': lower}))
+
+
+def range_overlap_q(start, end, ip_type):
+    """
+    Return a Q object that matches the ranges that overlap the addresses
+    between `start` and `end` (integers), inclusive.
+    """
+    return _le_q('start', end) & _ge_q('end', start) & Q(ip_type=ip_type)
+
+
+def find_overlapping_range(start, end, ip_type, exclude=None):
+    """
+    Return a range other than the one whose pk is `exclude` that overlaps
+    the addresses between `start` and `end` (integers), or None.
+    """
+    Range = get_model('cyder', 'range')
+    ranges = Range.objects.filter(range_overlap_q(start, end, ip_type))
+    if exclude is not None:
+        ranges = ranges.exclude(pk=exclude)
+    try:
+        return ranges.order_by('start_upper', 'start_lower')[0]
+    except IndexError:
+        return None
+
+
+def _get_bounds(rng):
+    try:
+        return tuple(
+            int(ipaddr.IPAddress(ip_str, version=int(rng.ip_type)))
+            for ip_str in (rng.start_str, rng.end_str))
+    except (ValueError, ipaddr.AddressValueError), e:
+        raise ValidationError(str(e))
+
+
+def find_overlaps(ranges):
+    """
+    Return a list of (range, other range) pairs for the ranges in `ranges`
+    that overlap an existing range or each other. The ranges' bounds are
+    read from their `start_str` and `end_str`, so they don't have to be
+    cleaned first. Existing ranges in `ranges` are checked with their new
+    bounds.
+    """
+    Range = get_model('cyder', 'range')
+    proposed = [(rng.ip_type,) + _get_bounds(rng) + (True, rng)
+                for rng in ranges]
+    proposed_pks = set(rng.pk for rng in ranges if rng.pk is not None)
+
+    existing = []
+    for (pk, ip_type, start_upper, start_lower, end_upper, end_lower,
+            start_str, end_str) in Range.objects.values_list(
+                'pk', 'ip_type', 'start_upper', 'start_lower', 'end_upper',
+                'end_lower', 'start_str', 'end_str').iterator():
+        if pk in proposed_pks:
+            continue
+        # Enough of a range to show in an error message
+        rng = Range(pk=pk, ip_type=ip_type, start_str=start_str,
+                    end_str=end_str)
+        existing.append((ip_type, two_to_one(start_upper, start_lower),
+                         two_to_one(end_upper, end_lower), False, rng))
+
+    overlaps = []
+    # `reach` is the interval that ends last among the ones before.
+    reach = None
+    for interval in sorted(existing + proposed, key=lambda i: i[:3]):
+        ip_type, start, end, is_proposed, rng = interval
+        if reach is None or reach[0] != ip_type:
+            reach = interval
+            continue
+        if start <= reach[2] and (is_proposed or reach[3]):
+            if is_proposed:
+                overlaps.append((rng, reach[4]))
+            else:
+                overlaps.append((reach[4], rng))
+        if end > reach[2]:
+            reach = interval
+    return overlaps
+
+
+def check_for_overlaps(ranges):
+    """
+    Raise a ValidationError if any of the ranges in `ranges` overlap an
+    existing range or each other. See :func:`find_overlaps`.
+    """
+    overlaps = find_overlaps(ranges)
+    if overlaps:
+        raise ValidationError([
+            u"Range {0} would overlap with range {1}".format(
+                rng.get_ip_str(padded=False),
+                other.get_ip_str(padded=False))
+            for rng, other in overlaps])
@@ -1,87 +1,112 @@
-from itertools import chain, groupby
-
 import json
-from cyder.base.constants import IP_TYPE_4, IP_TYPE_6
+from collections import defaultdict
+
+import ipaddr
 
-from cyder.cydhcp.utils import start_end_filter, two_to_one
+from cyder.base.constants import IP_TYPE_6
 from cyder.cydhcp.interface.static_intr.models import StaticInterface
+from cyder.cydhcp.range.allocation import get_taken_ips, ip_range_q
+from cyder.cydhcp.utils import two_to_one
 
 from cyder.cydns.address_record.models import AddressRecord
 from cyder.cydns.ptr.models import PTR
 
 
-def contiguous_ips(ip_list, ip_type=IP_TYPE_4):
+def get_blocks(start, end, taken):
     """
-    Given a sorted set of ips of the same type group them into a list of
-    the contiguous sublists
+    Given the taken addresses between `start` and `end` as a sorted list of
+    distinct integers, return the range's free blocks and contiguous used
+    blocks in order, as (first, last, is_free) tuples of integers.
     """
-    grouped_ips = []
-    contiguous_list = []
+    blocks = []
+    next_free = start
+    i = 0
+    while i < len(taken):
+        j = i
+        while j + 1 < len(taken) and taken[j + 1] == taken[j] + 1:
+            j += 1
+        if next_free < taken[i]:
+            blocks.append((next_free, taken[i] - 1, True))
+        blocks.append((taken[i], taken[j], False))
+        next_free = taken[j] + 1
+        i = j + 1
+    if next_free <= end:
+        blocks.append((next_free, end, True))
+    return blocks
+
+
+class RangeUsage(object):
     """
-    We need to group together objects which have the same ip addres.
-    They willb e stored in a tuple with the first element being an
-    ipaddr object and the second element is a list of records which
-    have that ip address.
+    A range's usage list: a sequence of its free blocks and its contiguous
+    blocks of used addresses, in order.
+
+    Only the taken addresses are fetched when it's created, as integers.
+    Rows are built when it's indexed or sliced, so paginating a big range
+    only fetches the records and builds the rows on the requested page.
+
+    A free block is ("Free", first IP, last IP, JSON for the create forms).
+    A used block is a list of (IP, records with that IP) tuples.
     """
-    for ip, grp in groupby(ip_list, key=lambda rec: rec.get_wrapped_ip()):
-        grouped_ips.append((ip, list(grp)))
-    if not grouped_ips:
-        return [], 0
-    ips_used = len(grouped_ips)
-    current_list = [grouped_ips[0]]
-    for ip_grp in grouped_ips[1:]:
-        """
-        If the next record is the successor of the last contiguous record
-        add it to the current list of contiguous records else add that
-        contiguous list to the list of contigguous ranges and start a new one.
-        """
-        if current_list[-1][0] == ip_grp[0] + 1:
-            current_list.append(ip_grp)
+
+    def __init__(self, start, end, ip_type):
+        self.ip_type = ip_type
+        if ip_type == IP_TYPE_6:
+            self.IPKlass = ipaddr.IPv6Address
         else:
-            contiguous_list.append(current_list)
-            current_list = [ip_grp]
-    contiguous_list.append(current_list)
-    return contiguous_list, ips_used
+            self.IPKlass = ipaddr.IPv4Address
+        taken = sorted(set(get_taken_ips(start, end, ip_type)))
+        self.used = len(taken)
+        self.total = end - start + 1
+        self.blocks = get_blocks(start, end, taken)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._build_rows(self.blocks[index])
+        return self._build_rows([self.blocks[index]])[0]
+
+    def __iter__(self):
+        return iter(self[:])
+
+    @property
+    def percent_used(self):
+        return int((float(self.used) / self.total) * 100)
+
+    def _get_records(self, blocks):
+        used = [(first, last) for first, last, is_free in blocks
+                if not is_free]
+        records = defaultdict(list)
+        if not used:
+            return records
+        q = ip_range_q(used[0][0], used[-1][1], self.ip_type)
+        for model in (AddressRecord, PTR, StaticInterface):
+            for record in model.objects.filter(q):
+                records[two_to_one(record.ip_upper,
+                                   record.ip_lower)].append(record)
+        return records
+
+    def _build_rows(self, blocks):
+        records = self._get_records(blocks)
+        rows = []
+        for first, last, is_free in blocks:
+            if is_free:
+                rows.append(
+                    ("Free",
+                     self.IPKlass(first), self.IPKlass(last),
+                     json.dumps({"ip_str": str(self.IPKlass(first)),
+                                 "ip_type": self.ip_type})))
+            else:
+                rows.append([(self.IPKlass(ip), records[ip])
+                             for ip in xrange(first, last + 1)])
+        return rows
 
 
 def range_usage(start, end, ip_type):
     """
     Takes a start and end address as integers and returns a range usage list
-    containing tuples of the available ips and lists of contiguously used ip
-    addresses.
+    (see :class:`RangeUsage`) and the percentage of the range that's used.
     """
-    ip_start, ip_end, ipf_q = start_end_filter(start, end, ip_type)
-    record_ip = lambda x: two_to_one(x.ip_upper, x.ip_lower)
-    taken_ips = sorted(chain(
-        AddressRecord.objects.filter(ipf_q),
-        PTR.objects.filter(ipf_q),
-        StaticInterface.objects.filter(ipf_q)),
-        key=record_ip)
-    contiguous_ip_list, total_used = contiguous_ips(taken_ips)
-    total_ips = (end - start) + 1
-    range_usage_list = []
-    free_range_start = ip_start
-    for filled_range in contiguous_ip_list:
-        # if the first address in the current contiguous range is greater
-        # than the first free address add that free range of ips to the range
-        # usage list
-        if free_range_start < filled_range[0][0]:
-            range_usage_list.append(
-                ("Free",
-                 free_range_start, filled_range[0][0] - 1,
-                 json.dumps({"ip_str": str(free_range_start),
-                             "ip_type": ip_type})))
-        # the new free range may start with the next address after the end of
-        # the current filled range
-        free_range_start = filled_range[-1][0] + 1
-        range_usage_list.append(filled_range)
-    # handle the case where there is an additional free range after the final
-    # filled range
-    if free_range_start < ip_end:
-        range_usage_list.append(
-            ("Free",
-             free_range_start, ip_end,
-             json.dumps({"ip_str": str(free_range_start),
-                         "ip_type": ip_type})))
-
-    return range_usage_list, int((float(total_used) / total_ips) * 100)
+    usage = RangeUsage(start, end, ip_type)
+    return usage, usage.percent_used
@@ -1,7 +1,11 @@
 from django.core.exceptions import ValidationError
+from django.db import transaction
+
+import ipaddr
 
 from cyder.base.tests import ModelTestMixin, TestCase
 from cyder.cydns.domain.models import Domain
+from cyder.cydhcp.constants import DYNAMIC
 from cyder.cydhcp.network.models import Network
 from cyder.cydhcp.range.models import Range
 from cyder.cydhcp.interface.static_intr.models import StaticInterface
@@ -252,3 +256,236 @@ class V4RangeTests(TestCase, ModelTestMixin):
             ip_str=str(r.get_next_ip()), system=system,
             mac="00:00:00:00:00:01")
         self.assertEqual(r.get_next_ip(), None)
+
+    def test_next_ips(self):
+        system = System.objects.create(name='foobar', ctnr=self.ctnr)
+        r = Range.objects.create(
+            start_str="10.0.34.1",
+            end_str="10.0.34.5",
+            network=self.s,
+            ip_type='4',
+        )
+        self.ctnr.ranges.add(r)
+        for i, ip_str in enumerate(('10.0.34.1', '10.0.34.3')):
+            StaticInterface.objects.create(
+                label="foo{0}".format(i), domain=self.d, ip_type='4',
+                ip_str=ip_str, system=system, mac="00:00:00:00:00:01")
+
+        self.assertEqual(map(str, r.get_next_ips(2)),
+                         ['10.0.34.2', '10.0.34.4'])
+        self.assertEqual(map(str, r.get_next_ips(10)),
+                         ['10.0.34.2', '10.0.34.4', '10.0.34.5'])
+
+    def test_used_ips(self):
+        from cyder.cydhcp.range.counters import rebuild_range_usage
+
+        system = System.objects.create(name='foobar', ctnr=self.ctnr)
+        r1 = Range.objects.create(
+            start_str="10.0.35.1",
+            end_str="10.0.35.4",
+            network=self.s,
+            ip_type='4',
+        )
+        r2 = Range.objects.create(
+            start_str="10.0.36.1",
+            end_str="10.0.36.4",
+            network=self.s,
+            ip_type='4',
+        )
+
+        def used_ips():
+            return [Range.objects.get(pk=r.pk).used_ips for r in (r1, r2)]
+
+        intrs = [
+            StaticInterface.objects.create(
+                label="foo{0}".format(i), domain=self.d, ip_type='4',
+                ip_str=ip_str, system=system, mac="00:00:00:00:00:01")
+            for i, ip_str in enumerate(
+                ('10.0.35.1', '10.0.35.2', '10.0.35.2'))]
+        self.assertEqual(used_ips(), [2, 0])
+        self.assertEqual(Range.objects.get(pk=r1.pk).range_usage, 50)
+
+        intrs[0].ip_str = '10.0.36.1'
+        intrs[0].save()
+        self.assertEqual(used_ips(), [1, 1])
+
+        # Saving a stale copy of a range keeps its counter.
+        r2.description = 'foo'
+        r2.save()
+        self.assertEqual(used_ips(), [1, 1])
+
+        intrs[1].delete()
+        self.assertEqual(used_ips(), [1, 1])
+        intrs[2].delete()
+        self.assertEqual(used_ips(), [0, 1])
+
+        self.assertEqual(rebuild_range_usage(), [])
+        Range.objects.filter(pk=r2.pk).update(used_ips=3)
+        self.assertEqual(
+            [(r.pk, old, new) for r, old, new in rebuild_range_usage()],
+            [(r2.pk, 3, 1)])
+        self.assertEqual(used_ips(), [0, 1])
+
+    def test_batch_overlaps(self):
+        from cyder.cydhcp.range.overlaps import (check_for_overlaps,
+                                                 find_overlaps)
+
+        old = Range.objects.create(
+            start_str="10.0.37.10",
+            end_str="10.0.37.20",
+            network=self.s,
+            ip_type='4',
+        )
+        new = [
+            Range(start_str="10.0.37.1", end_str="10.0.37.9", network=self.s,
+                  ip_type='4'),
+            Range(start_str="10.0.37.21", end_str="10.0.37.30",
+                  network=self.s, ip_type='4'),
+        ]
+        check_for_overlaps(new)
+
+        new.append(Range(start_str="10.0.37.5", end_str="10.0.37.12",
+                         network=self.s, ip_type='4'))
+        self.assertEqual(
+            [(r.start_str, o.start_str) for r, o in find_overlaps(new)],
+            [("10.0.37.5", "10.0.37.1"), ("10.0.37.5", "10.0.37.10")])
+        self.assertRaises(ValidationError, check_for_overlaps, new)
+
+        # An existing range is checked with its new bounds.
+        old.start_str = "10.0.37.13"
+        self.assertEqual(find_overlaps(new[:2] + [old]), [])
+
+    def test_find_ranges(self):
+        from cyder.cydhcp.range.utils import find_range, find_ranges
+
+        r1 = Range.objects.create(
+            start_str="10.0.38.1",
+            end_str="10.0.38.10",
+            network=self.s,
+            ip_type='4',
+        )
+        r2 = Range.objects.create(
+            start_str="10.0.38.20",
+            end_str="10.0.38.30",
+            network=self.s,
+            ip_type='4',
+        )
+        self.assertEqual(
+            find_ranges(['10.0.38.1', '10.0.38.10', '10.0.38.15',
+                         '10.0.38.30', '10.0.38.31', '::a00:2605']),
+            [r1, r1, None, r2, None, None])
+
+        r2.delete()
+        self.assertEqual(find_range('10.0.38.25'), None)
+        r1.end_str = "10.0.38.12"
+        r1.save()
+        self.assertEqual(find_range('10.0.38.12'), r1)
+
+        # A range that's rolled back is forgotten.
+        sid = transaction.savepoint()
+        r3 = Range.objects.create(
+            start_str="10.0.38.40",
+            end_str="10.0.38.50",
+            network=self.s,
+            ip_type='4',
+        )
+        self.assertEqual(find_range('10.0.38.40'), r3)
+        transaction.savepoint_rollback(sid)
+        self.assertEqual(find_range('10.0.38.40'), None)
+
+    def test_find_range_queries(self):
+        from django.core.signals import request_started
+        from cyder.cydhcp.range.utils import (
+            _request_finished, find_range, find_ranges)
+
+        r1 = Range.objects.create(
+            start_str="10.0.38.1",
+            end_str="10.0.38.10",
+            network=self.s,
+            ip_type='4',
+        )
+        self.assertEqual(find_range('10.0.38.1'), r1)
+
+        # Outside of a request, each lookup checks the version.
+        with self.assertNumQueries(2):
+            find_range('10.0.38.2')
+            find_ranges(['10.0.38.3', '10.0.38.4'])
+
+        request_started.send(sender=None)
+        try:
+            with self.assertNumQueries(1):
+                for i in range(1, 11):
+                    self.assertEqual(find_range('10.0.38.%d' % i), r1)
+                find_ranges(['10.0.38.5', '10.0.38.15'])
+
+            # Saving a range makes the next lookup check again.
+            r1.end_str = "10.0.38.12"
+            r1.save()
+            self.assertEqual(find_range('10.0.38.12'), r1)
+            with self.assertNumQueries(0):
+                find_range('10.0.38.11')
+        finally:
+            # Sending request_finished would close the test's connection.
+            _request_finished(sender=None)
+
+    def test_range_usage(self):
+        from cyder.cydhcp.range.range_usage import range_usage
+
+        system = System.objects.create(name='foobar', ctnr=self.ctnr)
+        r = Range.objects.create(
+            start_str="10.0.39.1",
+            end_str="10.0.39.8",
+            network=self.s,
+            ip_type='4',
+        )
+        intrs = [
+            StaticInterface.objects.create(
+                label="foo{0}".format(i), domain=self.d, ip_type='4',
+                ip_str=ip_str, system=system, mac="00:00:00:00:00:01")
+            for i, ip_str in enumerate(
+                ('10.0.39.1', '10.0.39.2', '10.0.39.5'))]
+
+        usage, percent = range_usage(r.start_lower, r.end_lower, '4')
+        self.assertEqual(percent, 37)
+        self.assertEqual(len(usage), 4)
+        free, used = usage[1:3]
+        self.assertEqual(free[:3], ("Free", ipaddr.IPv4Address('10.0.39.3'),
+                                    ipaddr.IPv4Address('10.0.39.4')))
+        self.assertEqual(used,
+                         [(ipaddr.IPv4Address('10.0.39.5'), [intrs[2]])])
+        self.assertEqual(usage[0],
+                         [(ipaddr.IPv4Address('10.0.39.1'), [intrs[0]]),
+                          (ipaddr.IPv4Address('10.0.39.2'), [intrs[1]])])
+        self.assertEqual(usage[-1][1:3], (ipaddr.IPv4Address('10.0.39.6'),
+                                          ipaddr.IPv4Address('10.0.39.8')))
+
+    def test_bind_records(self):
+        r = Range.objects.create(
+            start_str="10.0.1.250",
+            end_str="10.0.3.4",
+            network=self.s,
+            ip_type='4',
+            range_type=DYNAMIC,
+            domain=self.d,
+        )
+
+        lines = list(r.iter_bind_records())
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(
+            lines[0],
+            '$GENERATE 250-255  {0:44} 3600  IN  A       10.0.1.$'.format(
+                '10-0-1-$.com.'))
+        self.assertTrue(
+            lines[1].startswith('$GENERATE   0-255  10-0-2-$.com. '))
+        self.assertTrue(
+            lines[2].startswith('$GENERATE   0-4    10-0-3-$.com. '))
+        self.assertEqual(r.bind_render_record(), '\n'.join(lines))
+
+        lines = list(r.iter_bind_records(reverse=True))
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(
+            lines[0],
+            '$GENERATE 250-255  {0:44} 3600  IN  PTR     10-0-1-$.com.'
+            .format('$.1.0.10.in-addr.arpa.'))
+        self.assertEqual(r.bind_render_record(reverse=True),
+                         '\n'.join(lines))
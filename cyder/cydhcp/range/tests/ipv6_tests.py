@@ -52,6 +52,17 @@ class V6RangeTests(TestCase, ModelTestMixin):
         self.assertEqual(r.end_upper, 0xffffffffffffffff)
         self.assertEqual(r.end_lower, 0xfffffffffffffffe)
 
+    def test_next_ips(self):
+        r = Range.objects.create(
+            start_str="1234:1234:1234:1::",
+            end_str="1234:1234:1234:1234:1234:1234::",
+            network=self.s,
+            ip_type='6',
+        )
+        self.assertEqual(str(r.get_next_ip()), "1234:1234:1234:1::")
+        self.assertEqual(map(str, r.get_next_ips(2)),
+                         ["1234:1234:1234:1::", "1234:1234:1234:1::1"])
+
     def test_bad_create1(self):
         # start > end
         self.assertRaises(
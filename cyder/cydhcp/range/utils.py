@@ -1,6 +1,15 @@
-from django.db.models import get_model, Q
+import threading
+from bisect import bisect_right
+from collections import defaultdict
+from copy import copy
+from uuid import uuid4
 
-from cyder.cydhcp.utils import start_end_filter, two_to_one, one_to_two
+from django.core.signals import request_finished, request_started
+from django.db.models import get_model
+from django.dispatch import receiver
+
+from cyder.cydhcp.utils import (start_end_filter, two_to_one, one_to_two,
+                                four_to_two)
 
 from django.http import HttpResponse
 
@@ -11,21 +20,127 @@ import json
 import ipaddr
 
 
-def find_range(ip_str):
-    Range = get_model('cyder', 'range')
-    ip_upper, ip_lower = one_to_two(int(ipaddr.IPAddress(ip_str)))
-    q_start = (Q(start_upper__lt=ip_upper) |
-               Q(start_upper=ip_upper,
-                 start_lower__lte=ip_lower))
-    q_end = (Q(end_upper__gt=ip_upper) |
-             Q(end_upper=ip_upper,
-               end_lower__gte=ip_lower))
-    try:
-        return Range.objects.filter(q_start, q_end)[0]
-    except IndexError:
+# The pk of the only RangeIndexVersion row.
+RANGE_INDEX_VERSION_PK = 1
+
+_range_index = None
+
+# The index whose version was checked during the current request, if any.
+# See :func:`get_range_index`.
+_request_state = threading.local()
+
+
+class RangeIndex(object):
+    """
+    Finds the ranges that addresses are in without a query per address.
+
+    Each IP type's ranges are sorted by where they start. Ranges don't
+    overlap (see :func:`Range.check_for_overlaps`), so the only range that
+    can contain an address is the last one that starts at or before it,
+    which a binary search finds.
+    """
+
+    def __init__(self, version=None):
+        Range = get_model('cyder', 'range')
+        self.version = version
+        intervals = defaultdict(list)
+        for rng in Range.objects.all():
+            start, end = four_to_two(rng.start_upper, rng.start_lower,
+                                     rng.end_upper, rng.end_lower)
+            intervals[str(rng.ip_type)].append((start, end, rng))
+        self.starts = {}
+        self.intervals = {}
+        for ip_type, ip_type_intervals in intervals.iteritems():
+            ip_type_intervals.sort(key=lambda i: (i[0], i[2].pk))
+            self.starts[ip_type] = [i[0] for i in ip_type_intervals]
+            self.intervals[ip_type] = ip_type_intervals
+
+    def find(self, ip):
+        """
+        Return the range that `ip` (an IPv4Address or IPv6Address) is in, or
+        None. The range is a copy, so callers can change it.
+        """
+        ip_type = str(ip.version)
+        ip = int(ip)
+        i = bisect_right(self.starts.get(ip_type, []), ip) - 1
+        if i >= 0:
+            _, end, rng = self.intervals[ip_type][i]
+            if ip <= end:
+                return copy(rng)
         return None
 
 
+def get_range_index_version():
+    RangeIndexVersion = get_model('cyder', 'rangeindexversion')
+    versions = RangeIndexVersion.objects.filter(
+        pk=RANGE_INDEX_VERSION_PK).values_list('version', flat=True)
+    return versions[0] if versions else None
+
+
+def get_range_index():
+    """
+    Return this process's :class:`RangeIndex`, rebuilding it first if a
+    range has been saved or deleted since it was built.
+
+    Whether it's up to date is told by the version in the database (see
+    :class:`RangeIndexVersion`), which is changed in the same transaction
+    as every range save and delete. Versions are random, so an index built
+    from changes that were rolled back never matches a later version.
+
+    During a request, the version is only read once, unless this process
+    saves or deletes a range. Changes made by other processes in the
+    meantime, and range changes rolled back to a savepoint, are seen by
+    the next request.
+    """
+    global _range_index
+    index = getattr(_request_state, 'index', None)
+    if index is not None:
+        return index
+    version = get_range_index_version()
+    if _range_index is None or _range_index.version != version:
+        _range_index = RangeIndex(version)
+    if getattr(_request_state, 'in_request', False):
+        _request_state.index = _range_index
+    return _range_index
+
+
+def invalidate_range_index():
+    """Called when a range is saved or deleted."""
+    RangeIndexVersion = get_model('cyder', 'rangeindexversion')
+    version = uuid4().hex
+    if not RangeIndexVersion.objects.filter(
+            pk=RANGE_INDEX_VERSION_PK).update(version=version):
+        RangeIndexVersion.objects.create(pk=RANGE_INDEX_VERSION_PK,
+                                         version=version)
+    _request_state.index = None
+
+
+@receiver(request_started)
+def _request_started(sender, **kwargs):
+    _request_state.in_request = True
+    _request_state.index = None
+
+
+@receiver(request_finished)
+def _request_finished(sender, **kwargs):
+    _request_state.in_request = False
+    _request_state.index = None
+
+
+def find_range(ip_str):
+    """Return the range that the address `ip_str` is in, or None."""
+    return get_range_index().find(ipaddr.IPAddress(ip_str))
+
+
+def find_ranges(ip_strs):
+    """
+    Return a list of the ranges that the addresses in `ip_strs` are in
+    (None for each address that isn't in one).
+    """
+    index = get_range_index()
+    return [index.find(ipaddr.IPAddress(ip_str)) for ip_str in ip_strs]
+
+
 def ip_taken(ip, records):
     """
     Given an ip as an integer and a queryset find an object in the queryset
@@ -156,7 +271,7 @@ def range_wizard_get_ip(request):
     Range = get_model('cyder', 'range')
     rng = Range.objects.get(id=rngId)
 
-    if freeIp == 'true' and rng and rng.ip_type == '4':
+    if freeIp == 'true' and rng:
         ip_str = rng.get_next_ip()
         if not ip_str:
             ip_str = 'This range is full!'
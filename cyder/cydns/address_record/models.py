@@ -6,7 +6,6 @@ from django.core.exceptions import ValidationError
 
 from cyder.base.constants import IP_TYPE_6, IP_TYPE_4
 from cyder.base.utils import transaction_atomic
-from cyder.cydhcp.range.utils import find_range
 from cyder.cydns.cname.models import CNAME
 from cyder.cydns.ip.models import Ip
 from cyder.cydns.models import CydnsRecord, LabelDomainMixin
@@ -200,27 +199,27 @@ class AddressRecord(BaseAddressRecord):
 
     @transaction_atomic
     def save(self, *args, **kwargs):
+        from cyder.cydhcp.range.counters import address_changed, get_ip_key
+
         self.full_clean()
 
         update_range_usage = kwargs.pop('update_range_usage', True)
-        old_range = None
+        old_ip_key = None
         if self.id is not None:
-            old_ip = AddressRecord.objects.get(id=self.id).ip_str
-            old_range = find_range(old_ip)
+            old_ip_key = get_ip_key(AddressRecord.objects.get(id=self.id))
         super(AddressRecord, self).save(*args, **kwargs)
-        rng = find_range(self.ip_str)
-        if rng and update_range_usage:
-            rng.save(commit=False)
-            if old_range:
-                old_range.save(commit=False)
+        if update_range_usage:
+            address_changed(self, old_ip_key, get_ip_key(self))
 
     @transaction_atomic
     def delete(self, *args, **kwargs):
+        from cyder.cydhcp.range.counters import address_changed, get_ip_key
+
         update_range_usage = kwargs.pop('update_range_usage', True)
-        rng = find_range(self.ip_str)
+        ip_key = get_ip_key(self)
         super(AddressRecord, self).delete(*args, **kwargs)
-        if rng and update_range_usage:
-            rng.save(commit=False)
+        if update_range_usage:
+            address_changed(self, old_ip_key=ip_key)
 
     def set_is_glue(self):
         self.is_glue = True
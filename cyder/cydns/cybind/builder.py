@@ -1,44 +1,109 @@
 from __future__ import unicode_literals
 
+import hashlib
 import inspect
 import os
+import shutil
 import sys
 import syslog
+import tempfile
 import time
 import errno
 
+from multiprocessing import Pool
 from traceback import format_exception
 
+from django.db import connection
+
 from cyder.settings import BINDBUILD, ZONES_WITH_NO_CONFIG
 
+from cyder.base.build_profile import BuildProfile
 from cyder.base.mixins import MutexMixin
 from cyder.base.utils import (
-    copy_tree, dict_merge, Logger, remove_dir_contents,
-    run_command, set_attrs, StopFileExists)
+    ChecksumCache, CommandPool, copy_changed, dict_merge, Logger,
+    open_if_changed, run_command, set_attrs, StopFileExists)
 from cyder.base.vcs import GitRepo
 
 from cyder.core.task.models import Task
 from cyder.core.utils import fail_mail, mail_if_failure
 
 from cyder.cydns.soa.models import SOA
-from cyder.cydns.view.models import View
-from cyder.cydns.cybind.zone_builder import build_zone_data
+from cyder.cydns.cybind.zone_builder import (
+    iter_zone_records, render_soa_only, shard_zone_records, write_zone_data)
+from cyder.cydns.cybind.zone_loader import ZoneDataLoader
+from cyder.cydns.cybind.render_cache import RenderCache
 from cyder.cydns.cybind.models import DNSBuildRun
-from cyder.cydns.cybind.serial_utils import get_serial
+from cyder.cydns.cybind.journal import JOURNAL_DIR, update_journal
+from cyder.cydns.cybind.serial_utils import (
+    SERIAL_MANIFEST_FNAME, SerialManifest)
+
+
+# A sharded zone file's fragments go in the directory named after it plus
+# this. See :func:`DNSBuilder.write_sharded_zone`.
+FRAGMENT_DIR_SUFFIX = '.d'
+
+# The builder whose zones are being built by this worker process. It's set
+# right before the worker pool is forked. See
+# :func:`DNSBuilder.build_soas_parallel`.
+_worker_builder = None
+
+
+def _read_file(fname):
+    try:
+        with open(fname) as fd:
+            return fd.read()
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return ''
+
+
+def _fragment_sort_key(name):
+    # '3.2.10.in-addr.arpa' sorts as 10.2.3.
+    return [int(octet) for octet in reversed(name.split('.')[:3])]
+
+
+def _build_soa_worker(args):
+    soa_pk, soa_pks_to_rebuild, force = args
+    soa = SOA.objects.get(pk=soa_pk)
+    zone_stmts = _worker_builder.build_soa(soa, soa_pks_to_rebuild,
+                                           force=force)
+    _worker_builder.check_pool.wait()
+    return zone_stmts, _worker_builder.pop_worker_state()
 
 
 class DNSBuilder(MutexMixin, Logger):
     def __init__(self, **kwargs):
-        kwargs = dict_merge(BINDBUILD, {
+        kwargs = dict_merge({
+            'jobs': 1,
+            'render_cache_file': None,
+            'check_jobs': 1,
+            'check_cache_file': None,
+            'ixfr_journal_length': 0,
+            'profile_file': None,
+            'profile_build_run': False,
+            'shard_reverse_zones': False,
+        }, BINDBUILD, {
             'quiet': False,
             'verbose': False,
             'to_syslog': False,
         }, kwargs)
         set_attrs(self, kwargs)
+        self.zone_loader = None
+        self.render_cache = None
+        self.check_pool = None
+        self.check_cache = None
+        self.serial_manifest = None
+        self.task_watermark = None
+        self.profile = None
+        self.build_run = None
+        self.check_dir = None
+        self.staged = None
+        self.fragments = None
 
         self.repo = GitRepo(
             self.prod_dir, self.line_decrease_limit, self.line_increase_limit,
-            logger=self)
+            logger=self, line_count_exclude=[JOURNAL_DIR + '/'])
 
     def log(self, log_level, msg, root_domain=None):
         if root_domain:
@@ -78,8 +143,10 @@ class DNSBuilder(MutexMixin, Logger):
         build its build request will not be deleted and will be serviced
         during the next build.
 
-        If the build is successful we will delete all the scheduled tasks
-        returned by this function.
+        The tasks are marked as claimed, and the highest task id seen is
+        remembered as the build's watermark. If the build is successful we
+        will delete all the claimed tasks up to the watermark. Zones that
+        change during the build get new, unclaimed tasks.
 
         note::
             When we are not checking files into Git we do not need to delete
@@ -91,6 +158,13 @@ class DNSBuilder(MutexMixin, Logger):
         self.log_debug("{0} zone{1} requested to be rebuilt".format(
             ts_len, 's' if ts_len != 1 else '')
         )
+        if ts:
+            # Claim exactly the tasks we saw. A task that was inserted with a
+            # lower id but committed after we looked stays unclaimed.
+            Task.claim(ts)
+            self.task_watermark = max(t.pk for t in ts)
+        else:
+            self.task_watermark = None
         return ts
 
     def calc_target(self, root_domain, soa):
@@ -129,62 +203,265 @@ class DNSBuilder(MutexMixin, Logger):
             zone_path = tmp_path + '/'
         return zone_path
 
-    def write_stage_zone(self, stage_fname, root_domain, fname, data):
-        """
-        Write a zone_file.
-        Return the path to the file.
+    def run_check(self, command, fname, data, failure_msg, on_failure=None,
+                  checksum_command=None, prepare=None):
+        """Run a check on a file in the check pool. If it fails, an exception
+        is raised the next time the pool is used.
+
+        If the last version of the file that passed this check had the same
+        `data`, the check is skipped. If `command` checks a copy of the file
+        rather than the file itself, `checksum_command` is the command that
+        would check the file, and `prepare` is called to write the copy if
+        the check isn't skipped.
         """
-        if not os.path.exists(os.path.dirname(stage_fname)):
-            os.makedirs(os.path.dirname(stage_fname))
-        self.log_debug("Stage zone file is {0}".format(stage_fname),
-                       root_domain=root_domain)
-        with open(stage_fname, 'w+') as fd:
-            fd.write(data)
-        return stage_fname
+        checksum = ChecksumCache.checksum(checksum_command or command, data)
+        if self.check_cache.matches(fname, checksum):
+            self.log_debug('Skipping `{0}` because the file is unchanged '
+                           'since it last passed'.format(command))
+            return
+        if prepare is not None:
+            prepare()
+
+        def on_success():
+            self.check_cache.set(fname, checksum)
+
+        self.check_pool.submit(command, failure_msg=failure_msg,
+                               on_success=on_success, on_failure=on_failure)
 
-    def run_checkzone(self, zone_file, root_domain):
+    def run_checkzone(self, zone_file, root_domain, data, on_failure=None):
         """Shell out and call named-checkzone on the zone file. If it returns
-        with errors raise an exception.
+        with errors raise an exception (see :func:`run_check`).
+
+        `data` is the digest of the zone's data that ignores its serial (see
+        :func:`write_zone_data`), so a zone that's only been given a new
+        serial isn't checked again.
         """
         # Check the zone file.
-        self.run_command(
-            ' '.join((self.named_checkzone, self.named_checkzone_opts,
-                      root_domain.name, zone_file)),
+        self.run_check(
+            self.get_checkzone_command(zone_file, root_domain),
+            zone_file, data,
+            failure_msg='named-checkzone failed on zone {0}'
+                        .format(root_domain.name),
+            on_failure=on_failure
+        )
+
+    def run_sharded_checkzone(self, file_meta, root_domain, data,
+                              on_failure=None):
+        """Like :func:`run_checkzone`, but for a sharded zone file. Its
+        $INCLUDEs point at its fragments in prod, some of which are about to
+        be replaced by the ones in the staging area, so the zone is checked
+        as a single file with the new fragments in place. That file is only
+        written if the check isn't skipped.
+        """
+        zone_file = os.path.join(self.stage_dir, file_meta['rel_fname'])
+        check_file = os.path.join(self.check_dir, file_meta['rel_fname'])
+
+        def write_check_file():
+            if not os.path.exists(os.path.dirname(check_file)):
+                os.makedirs(os.path.dirname(check_file))
+            with open(check_file, 'w') as fd:
+                fd.write(self.read_zone(file_meta,
+                                        (self.stage_dir, self.prod_dir)))
+
+        self.run_check(
+            self.get_checkzone_command(check_file, root_domain),
+            zone_file, data,
             failure_msg='named-checkzone failed on zone {0}'
-                        .format(root_domain.name)
+                        .format(root_domain.name),
+            on_failure=on_failure,
+            checksum_command=self.get_checkzone_command(zone_file,
+                                                        root_domain),
+            prepare=write_check_file
         )
 
-    def run_checkconf(self, conf_file):
-        self.run_command(
+    def get_checkzone_command(self, zone_file, root_domain):
+        return ' '.join((self.named_checkzone, self.named_checkzone_opts,
+                         root_domain.name, zone_file))
+
+    def run_checkconf(self, conf_file, data):
+        self.run_check(
             ' '.join((self.named_checkconf, conf_file)),
+            conf_file, data,
             failure_msg='named-checkconf rejected config {0}'.format(conf_file)
         )
 
+    def open_stage_file(self, rel_fname):
+        """
+        Open a file in the staging area for writing with
+        :func:`open_if_changed`, so it isn't rewritten if its contents are
+        the same as before, and remember that this build staged it. See
+        :func:`remove_unstaged_files`.
+        """
+        self.staged.add(rel_fname)
+        return open_if_changed(os.path.join(self.stage_dir, rel_fname))
+
     def write_stage_config(self, config_fname, stmts):
         """
         Write config files to the correct area in staging.
         Return the path to the file.
         """
-        stage_config = os.path.join(self.stage_dir, "config", config_fname)
-
-        if not os.path.exists(os.path.dirname(stage_config)):
-            os.makedirs(os.path.dirname(stage_config))
-        with open(stage_config, 'w+') as fd:
+        rel_fname = os.path.join("config", config_fname)
+        with self.open_stage_file(rel_fname) as fd:
             fd.write(stmts)
-        return stage_config
+        return os.path.join(self.stage_dir, rel_fname)
 
-    def build_zone(self, view, file_meta, view_data, root_domain):
+    def build_zone(self, view, file_meta, root_domain, soa, serial):
         """
-        This function will write the zone's zone file to the staging area and
-        call named-checkconf on the files.
+        Render the zone's records in `view` straight into its zone file in
+        the staging area. Return what :func:`write_zone_data` returns, which
+        is None if the view has no records (and so no zone file).
         """
         stage_fname = os.path.join(self.stage_dir, file_meta['rel_fname'])
-        self.write_stage_zone(
-            stage_fname, root_domain, file_meta['rel_fname'], view_data
-        )
+        self.log_debug("++++++ Looking at < {0} > view ++++++"
+                       .format(view.name), root_domain=root_domain)
+        t_start = time.time()  # tic
+        if file_meta['rel_fragment_dir']:
+            result = self.write_sharded_zone(view, file_meta, root_domain,
+                                             soa, serial)
+        else:
+            result = write_zone_data(stage_fname, view, root_domain, soa,
+                                     serial, logf=self.log_notice,
+                                     loader=self.zone_loader,
+                                     render_cache=self.render_cache)
+            if result is not None:
+                self.staged.add(file_meta['rel_fname'])
+        build_time = time.time() - t_start  # toc
+        self.log_debug('< {0} > Built {1} data in {2} seconds'
+                       .format(view.name, soa, build_time),
+                       root_domain=root_domain)
+        if result is None:
+            # Though there is no zone file, we keep it in the config to
+            # claim authority (for DNS poison, etc.)
+            self.log_debug(
+                '< {0} > No data found in this view. No zone file will be '
+                'made, but it will be included in the config for this '
+                'view.'.format(view.name), root_domain=root_domain)
+            return None
+
+        self.log_debug(
+            '< {0} > Non-empty data set for this view. Its zone file will '
+            'be included in the config.'.format(view.name),
+            root_domain=root_domain)
         self.log_debug(
             "Built stage_{0}_file to {1}".format(view.name, stage_fname),
             root_domain=root_domain)
+        return result
+
+    def is_sharded(self, root_domain):
+        """
+        Return whether `root_domain`'s zone files are split into a fragment
+        for each /24 and a main file that includes them. Only IPv4 reverse
+        zones bigger than a /24 are, and only if `shard_reverse_zones` is
+        set.
+        """
+        name = root_domain.name
+        return bool(self.shard_reverse_zones and
+                    name.endswith('in-addr.arpa') and name.count('.') < 4)
+
+    def write_sharded_zone(self, view, file_meta, root_domain, soa, serial):
+        """
+        Like :func:`write_zone_data`, but the records of each /24 go in a
+        fragment of their own, which the main file (the SOA record, the NS
+        records, and anything else that isn't about a single address)
+        $INCLUDEs. A change to one address then only changes one small file.
+        Fragments that are the same as the ones in prod aren't staged, so
+        they're neither copied nor committed. Fragments in prod that aren't
+        written any more are deleted when the build is pushed (see
+        :func:`remove_stale_fragments`). See :func:`shard_zone_records`.
+        """
+        lines = iter_zone_records(view, root_domain, soa,
+                                  logf=self.log_notice,
+                                  loader=self.zone_loader,
+                                  render_cache=self.render_cache)
+        main_lines, fragments = shard_zone_records(lines)
+        if not main_lines and not fragments:
+            return None
+
+        digest = hashlib.sha1()
+        digest.update(render_soa_only(soa, root_domain, serial='')
+                      .encode('utf-8'))
+        size = 0
+        staged = 0
+        for name in sorted(fragments, key=_fragment_sort_key):
+            rel_fname = os.path.join(file_meta['rel_fragment_dir'], name)
+            data = ''.join(fragments[name]).encode('utf-8')
+            digest.update(name.encode('utf-8') + b'\n')
+            digest.update(data)
+            size += len(data)
+            main_lines.append('$INCLUDE {0}\n'.format(
+                os.path.join(self.bind_prefix, rel_fname)))
+            if data == _read_file(os.path.join(self.prod_dir, rel_fname)):
+                # An earlier build that wasn't pushed may have staged a
+                # different version, which would shadow prod's when the zone
+                # is checked.
+                stage_fname = os.path.join(self.stage_dir, rel_fname)
+                if os.path.exists(stage_fname):
+                    os.remove(stage_fname)
+                continue
+
+            with self.open_stage_file(rel_fname) as fd:
+                fd.write(data)
+            staged += 1
+
+        with self.open_stage_file(file_meta['rel_fname']) as fd:
+            soa_data = render_soa_only(soa, root_domain, serial=serial)
+            fd.write(soa_data)
+            size += len(soa_data)
+            for line in main_lines:
+                fd.write(line)
+                digest.update(line.encode('utf-8'))
+                size += len(line)
+
+        self.fragments[file_meta['rel_fragment_dir']] = set(fragments)
+        self.log_debug('< {0} > Staged {1} of {2} fragments'
+                       .format(view.name, staged, len(fragments)),
+                       root_domain=root_domain)
+        return size, digest.hexdigest()
+
+    def read_zone(self, file_meta, dirs):
+        """
+        Return the contents of a zone file with the $INCLUDEs of its
+        fragments (if it's sharded) replaced by the fragments. Each file is
+        read from the first directory in `dirs` that has it.
+        """
+        def read(rel_fname):
+            for dir_ in dirs:
+                fname = os.path.join(dir_, rel_fname)
+                if os.path.exists(fname):
+                    return _read_file(fname)
+            return ''
+
+        fragment_dir = file_meta['rel_fname'] + FRAGMENT_DIR_SUFFIX + '/'
+        lines = []
+        for line in read(file_meta['rel_fname']).splitlines(True):
+            if line.startswith('$INCLUDE '):
+                rel_fname = os.path.relpath(line.split()[1],
+                                            self.bind_prefix or os.curdir)
+                if rel_fname.startswith(fragment_dir):
+                    line = read(rel_fname)
+            lines.append(line)
+        return ''.join(lines)
+
+    def write_journal(self, file_meta, root_domain):
+        """
+        Write the zone file's IXFR journal to the staging area, adding the
+        changes between the zone file in prod and the new one in the staging
+        area. See :mod:`cyder.cydns.cybind.journal`.
+        """
+        rel_fname = os.path.join(JOURNAL_DIR, file_meta['rel_fname'])
+
+        # Sharded zones are compared with their fragments in place.
+        journal_data = update_journal(
+            _read_file(os.path.join(self.prod_dir, rel_fname)),
+            self.read_zone(file_meta, (self.prod_dir,)),
+            self.read_zone(file_meta, (self.stage_dir, self.prod_dir)),
+            self.ixfr_journal_length)
+        if not journal_data:
+            self.log_debug('Starting a new IXFR journal',
+                           root_domain=root_domain)
+
+        with self.open_stage_file(rel_fname) as fd:
+            fd.write(journal_data)
 
     def calc_fname(self, view, root_domain):
         return "{0}.{1}".format(root_domain.name, view.name)
@@ -205,7 +482,8 @@ class DNSBuilder(MutexMixin, Logger):
 
     def verify_previous_build(self, file_meta, view, root_domain, soa):
         force_rebuild, new_serial = False, None
-        serial = get_serial(os.path.join(file_meta['prod_fname']))
+        serial = self.serial_manifest.get_serial(file_meta['rel_fname'],
+                                                 file_meta['prod_fname'])
         if not serial.isdigit():
             new_serial = int(time.time())
             force_rebuild = True
@@ -252,6 +530,10 @@ class DNSBuilder(MutexMixin, Logger):
             * bind_fnam
                 - The path name used in the zones `zone` statement. See
                   :func:`render_zone_stmt` for more info.
+
+            * rel_fragment_dir
+                - Where the zone file's fragments go if it's sharded, or
+                  None if it isn't. See :func:`write_sharded_zone`.
         """
         file_meta = {}
         rel_zone_dir = self.calc_target(root_domain, soa)
@@ -261,166 +543,283 @@ class DNSBuilder(MutexMixin, Logger):
                                                file_meta['rel_fname'])
         file_meta['bind_fname'] = os.path.join(self.bind_prefix,
                                                file_meta['rel_fname'])
+        if self.is_sharded(root_domain):
+            file_meta['rel_fragment_dir'] = (file_meta['rel_fname'] +
+                                             FRAGMENT_DIR_SUFFIX)
+        else:
+            file_meta['rel_fragment_dir'] = None
         return file_meta
 
     def build_zone_files(self, soa_pks_to_rebuild, force=False):
+        """
+        Build the zone files of every enabled SOA and return the zone
+        statements for each view, keyed by view name.
+
+        If `jobs` is greater than one, zones are rendered and checked by a
+        pool of worker processes. Either way, the zone statements are merged
+        in root domain order so the generated config doesn't depend on which
+        worker finished first.
+
+        The records of the zones that are known to need rebuilding are
+        fetched up front, all at once. Zones found to need rebuilding later
+        (e.g. because their files were tampered with) fetch their own.
+
+        If `render_cache_file` is set, records that haven't changed since the
+        last build aren't rendered again. See :class:`RenderCache`.
+        """
+        soas = list(SOA.objects.filter(dns_enabled=True)
+                               .order_by("root_domain__name"))
+        if force:
+            self.zone_loader = ZoneDataLoader()
+        else:
+            self.zone_loader = ZoneDataLoader(soas=[
+                soa for soa in soas
+                if soa.pk in soa_pks_to_rebuild or soa.dirty])
+        self.render_cache = RenderCache(self.render_cache_file)
+        if not force:
+            self.render_cache.load()
+
+        if self.jobs > 1:
+            # Fetch everything before forking so the workers share it.
+            self.zone_loader.load_all()
+            results = self.build_soas_parallel(
+                [soa.pk for soa in soas], soa_pks_to_rebuild, force=force)
+        else:
+            results = (self.build_soa(soa, soa_pks_to_rebuild, force=force)
+                       for soa in soas)
+
         zone_stmts = {}
+        for soa_zone_stmts in results:
+            for view_name, zone_stmt in soa_zone_stmts:
+                zone_stmts.setdefault(view_name, []).append(zone_stmt)
 
-        for soa in (SOA.objects.filter(dns_enabled=True)
-                               .order_by("root_domain__name")):
-            # If anything happens during this soa's build we need to mark
-            # it as dirty so it can be rebuild
-            try:
-                root_domain = soa.root_domain
-
-                if not root_domain:
-                    continue
-
-                # General order of things:
-                # * Find which views should have a zone file built and add them
-                # to a list.
-                # * If any of the view's zone file have been tampered with or
-                # the zone is new, trigger the rebuilding of all the zone's
-                # view files. (Rebuilding all views in a zone keeps the serial
-                # synced across all views.)
-                # * Either rebuild all of a zone's view files because one view
-                # needed to be rebuilt due to tampering or the zone was dirty
-                # (again, this is to keep their serial synced) or just call
-                # named-checkzone on the existing zone files for good measure.
-                # Also generate a zone statement and add it to a dictionary for
-                # later use during BIND configuration generation.
-
-                force_rebuild = (soa.pk in soa_pks_to_rebuild or soa.dirty
-                                 or force)
-                if force_rebuild:
-                    soa.dirty = False
-                    soa.save()
+        self.render_cache.save()
+        self.zone_loader = None
+        self.render_cache = None
+        return zone_stmts
 
-                self.log_debug('====== Processing {0} {1} ======'.format(
-                    root_domain, soa.serial)
-                )
-                views_to_build = []
-                self.log_debug(
-                    "SOA was seen with dirty == {0}".format(force_rebuild),
-                    root_domain=root_domain
-                )
+    def build_soas_parallel(self, soa_pks, soa_pks_to_rebuild, force=False):
+        """
+        Call :func:`build_soa` on each SOA in a pool of `jobs` worker
+        processes and return the results in the same order as `soa_pks`.
+        """
+        global _worker_builder
+
+        self.log_info('Building zones with {0} workers'.format(self.jobs))
+        # The workers are forked, so they must not share our database
+        # connection. Each of them will open its own.
+        connection.close()
+        # Otherwise every worker would send back our entries as its own.
+        self.profile.pop_new_entries()
+        _worker_builder = self
+        pool = Pool(self.jobs)
+        results = []
+        try:
+            for zone_stmts, worker_state in pool.imap(
+                    _build_soa_worker,
+                    [(pk, soa_pks_to_rebuild, force) for pk in soa_pks]):
+                results.append(zone_stmts)
+                self.merge_worker_state(worker_state)
+        except:
+            exc_info = sys.exc_info()
+            pool.terminate()
+            pool.join()
+            # Workers that were killed may have already marked their SOAs
+            # clean without getting to mark them dirty again on failure.
+            # Results come back in order, so every SOA from the one that
+            # failed onward is unfinished.
+            for soa in SOA.objects.filter(pk__in=soa_pks[len(results):]):
+                soa.schedule_rebuild()
+            raise exc_info[0], exc_info[1], exc_info[2]
+        else:
+            pool.close()
+            pool.join()
+        finally:
+            _worker_builder = None
 
-                def get_view_data(view):
-                    self.log_debug("++++++ Looking at < {0} > view ++++++"
-                                   .format(view.name), root_domain=root_domain)
-                    t_start = time.time()  # tic
-                    view_data = build_zone_data(view, root_domain, soa,
-                                                logf=self.log_notice)
-                    build_time = time.time() - t_start  # toc
-                    self.log_debug('< {0} > Built {1} data in {2} seconds'
-                                   .format(view.name, soa, build_time),
-                                   root_domain=root_domain)
-                    if not view_data:
-                        # Though there is no zone file, we keep it in the
-                        # config to claim authority (for DNS poison, etc.)
-                        self.log_debug(
-                            '< {0} > No data found in this view. '
-                            'No zone file will be made, but it will be '
-                            'included in the config for '
-                            'this view.'.format(view.name),
-                            root_domain=root_domain)
-                        return None
-                    self.log_debug(
-                        '< {0} > Non-empty data set for this '
-                        'view. Its zone file will be included in the '
-                        'config.'.format(view.name), root_domain=root_domain)
-                    return view_data
-
-                # This for loop decides which views will be canidates for
-                # rebuilding.
-                for view in View.objects.all():
-                    self.log_debug("++++++ Looking at < {0} > view ++++++"
-                                   .format(view.name), root_domain=root_domain)
-                    file_meta = self.get_file_meta(view, root_domain, soa)
-
-                    if force:
-                        was_bad_prev = True
-                        new_serial = int(time.time())
-                    else:
-                        was_bad_prev, new_serial = self.verify_previous_build(
-                            file_meta, view, root_domain, soa)
-
-                    if was_bad_prev:
-                        soa.serial = new_serial
-                        force_rebuild = True
-
-                    views_to_build.append(
-                        (view, file_meta)
-                    )
+        return results
 
-                self.log_debug(
-                    '----- Building < {0} > ------'.format(
-                        ' | '.join([v.name for v, _ in views_to_build])
-                    ), root_domain=root_domain
+    def pop_worker_state(self):
+        """
+        Return what a worker process added to its copies of the builder's
+        caches (and the files it staged) since the last call. The parent
+        can't see those copies.
+        """
+        staged, self.staged = self.staged, set()
+        fragments, self.fragments = self.fragments, {}
+        return {
+            'render_cache': self.render_cache.pop_new_entries(),
+            'check_cache': self.check_cache.pop_new_checksums(),
+            'serial_manifest': self.serial_manifest.pop_entries(),
+            'profile': self.profile.pop_new_entries(),
+            'staged': staged,
+            'fragments': fragments,
+        }
+
+    def merge_worker_state(self, state):
+        self.render_cache.update(state['render_cache'])
+        self.check_cache.update(state['check_cache'])
+        self.serial_manifest.update(state['serial_manifest'])
+        self.profile.update(state['profile'])
+        self.staged.update(state['staged'])
+        self.fragments.update(state['fragments'])
+
+    def build_soa(self, soa, soa_pks_to_rebuild, force=False):
+        """
+        Build (or just check) the zone files of one SOA. Return a list of
+        (view name, zone statement) pairs for the config files.
+        """
+        root_domain = soa.root_domain
+        with self.profile.measure(
+                'zone', root_domain.name if root_domain else None,
+                rebuilt=False) as entry:
+            return self._build_soa(soa, soa_pks_to_rebuild, entry,
+                                   force=force)
+
+    def _build_soa(self, soa, soa_pks_to_rebuild, profile_entry,
+                   force=False):
+        zone_stmts = []
+
+        # If anything happens during this soa's build we need to mark
+        # it as dirty so it can be rebuild
+        try:
+            root_domain = soa.root_domain
+
+            if not root_domain:
+                return zone_stmts
+
+            # General order of things:
+            # * Find which views should have a zone file built and add them
+            # to a list.
+            # * If any of the view's zone file have been tampered with or
+            # the zone is new, trigger the rebuilding of all the zone's
+            # view files. (Rebuilding all views in a zone keeps the serial
+            # synced across all views.)
+            # * Either rebuild all of a zone's view files because one view
+            # needed to be rebuilt due to tampering or the zone was dirty
+            # (again, this is to keep their serial synced) or just call
+            # named-checkzone on the existing zone files for good measure.
+            # Also generate a zone statement and add it to a dictionary for
+            # later use during BIND configuration generation.
+
+            force_rebuild = (soa.pk in soa_pks_to_rebuild or soa.dirty
+                             or force)
+            if force_rebuild:
+                soa.dirty = False
+                soa.save()
+
+            self.log_debug('====== Processing {0} {1} ======'.format(
+                root_domain, soa.serial)
+            )
+            views_to_build = []
+            self.log_debug(
+                "SOA was seen with dirty == {0}".format(force_rebuild),
+                root_domain=root_domain
+            )
+
+            # This for loop decides which views will be canidates for
+            # rebuilding.
+            for view in self.zone_loader.get_views():
+                self.log_debug("++++++ Looking at < {0} > view ++++++"
+                               .format(view.name), root_domain=root_domain)
+                file_meta = self.get_file_meta(view, root_domain, soa)
+
+                if force:
+                    was_bad_prev = True
+                    new_serial = int(time.time())
+                else:
+                    was_bad_prev, new_serial = self.verify_previous_build(
+                        file_meta, view, root_domain, soa)
+
+                if was_bad_prev:
+                    soa.serial = new_serial
+                    force_rebuild = True
+
+                views_to_build.append(
+                    (view, file_meta)
                 )
 
-                if force_rebuild:
-                    # Bypass save so we don't have to save a possible stale
-                    # 'dirty' value to the db.
-                    SOA.objects.filter(pk=soa.pk).update(serial=soa.serial + 1)
-                    self.log_debug('Zone will be rebuilt at serial {0}'
-                                   .format(soa.serial + 1),
-                                   root_domain=root_domain)
+            self.log_debug(
+                '----- Building < {0} > ------'.format(
+                    ' | '.join([v.name for v, _ in views_to_build])
+                ), root_domain=root_domain
+            )
+
+            if force_rebuild:
+                # Bypass save so we don't have to save a possible stale
+                # 'dirty' value to the db.
+                SOA.objects.filter(pk=soa.pk).update(serial=soa.serial + 1)
+                self.log_debug('Zone will be rebuilt at serial {0}'
+                               .format(soa.serial + 1),
+                               root_domain=root_domain)
+            else:
+                self.log_debug('Zone is stable at serial {0}'
+                               .format(soa.serial),
+                               root_domain=root_domain)
+
+            for view, file_meta in views_to_build:
+                if (root_domain.name, view.name) in ZONES_WITH_NO_CONFIG:
+                    self.log_notice(
+                        '!!! Not going to emit zone statements for {0}\n'
+                        .format(root_domain.name), root_domain=root_domain)
                 else:
-                    self.log_debug('Zone is stable at serial {0}'
-                                   .format(soa.serial),
-                                   root_domain=root_domain)
-
-                for view, file_meta in views_to_build:
-                    if (root_domain.name, view.name) in ZONES_WITH_NO_CONFIG:
-                        self.log_notice(
-                            '!!! Not going to emit zone statements for {0}\n'
-                            .format(root_domain.name), root_domain=root_domain)
-                    else:
-                        view_zone_stmts = zone_stmts.setdefault(view.name, [])
-                        # If we see a view in this loop it's going to end up in
-                        # the config
-                        view_zone_stmts.append(
-                            self.render_zone_stmt(soa, root_domain, file_meta)
-                        )
-
-                    # If it's dirty or we are rebuilding another view, rebuild
-                    # the zone
-                    if force_rebuild:
-                        self.log_debug(
-                            'Rebuilding < {0} > view file {1}'
-                            .format(view.name, file_meta['prod_fname']),
-                            root_domain=root_domain)
-                        view_data = get_view_data(view)
-                        if view_data is None:
+                    # If we see a view in this loop it's going to end up in
+                    # the config
+                    zone_stmts.append((
+                        view.name,
+                        self.render_zone_stmt(soa, root_domain, file_meta)
+                    ))
+
+                # If it's dirty or we are rebuilding another view, rebuild
+                # the zone
+                if force_rebuild:
+                    self.log_debug(
+                        'Rebuilding < {0} > view file {1}'
+                        .format(view.name, file_meta['prod_fname']),
+                        root_domain=root_domain)
+                    profile_entry['rebuilt'] = True
+                    with self.profile.measure('view', root_domain.name,
+                                              view=view.name) as entry:
+                        result = self.build_zone(view, file_meta,
+                                                 root_domain, soa,
+                                                 soa.serial + 1)
+                        if result is None:
                             continue
-                        self.build_zone(
-                            view, file_meta,
-                            # Lazy string evaluation
-                            view_data.format(serial=soa.serial + 1),
-                            root_domain
-                        )
-                        self.run_checkzone(
-                            os.path.join(self.stage_dir,
-                                         file_meta['rel_fname']),
-                            root_domain)
-                    else:
-                        self.log_debug(
-                            'NO REBUILD needed for < {0} > view file {1}'
-                            .format(view.name, file_meta['prod_fname']),
-                            root_domain=root_domain
-                        )
-            except Exception:
-                soa.schedule_rebuild()
-                raise
+                        entry['bytes'], digest = result
+                        stage_fname = os.path.join(self.stage_dir,
+                                                   file_meta['rel_fname'])
+                        if self.ixfr_journal_length:
+                            self.write_journal(file_meta, root_domain)
+                        self.serial_manifest.set(
+                            file_meta['rel_fname'], soa.serial + 1,
+                            stage_fname)
+                        if file_meta['rel_fragment_dir']:
+                            self.run_sharded_checkzone(
+                                file_meta, root_domain, digest,
+                                on_failure=soa.schedule_rebuild)
+                        else:
+                            self.run_checkzone(
+                                stage_fname, root_domain, digest,
+                                on_failure=soa.schedule_rebuild)
+                else:
+                    self.log_debug(
+                        'NO REBUILD needed for < {0} > view file {1}'
+                        .format(view.name, file_meta['prod_fname']),
+                        root_domain=root_domain
+                    )
+        except Exception:
+            soa.schedule_rebuild()
+            raise
 
         return zone_stmts
 
     def build_view_config(self, view_name, ztype, stmts):
         config_fname = "{0}.{1}".format(ztype, view_name)
-        zone_stmts = '\n'.join(stmts).format(ztype=ztype)
-        stage_config = self.write_stage_config(config_fname, zone_stmts)
-        self.run_checkconf(stage_config)
+        with self.profile.measure('config', config_fname) as entry:
+            zone_stmts = '\n'.join(stmts).format(ztype=ztype)
+            entry['bytes'] = len(zone_stmts)
+            stage_config = self.write_stage_config(config_fname, zone_stmts)
+            self.run_checkconf(stage_config, zone_stmts)
 
     def build_config_files(self, zone_stmts):
         # named-checkconf on config files
@@ -459,32 +858,133 @@ class DNSBuilder(MutexMixin, Logger):
 
         self.log_info('Building...')
 
-        remove_dir_contents(self.stage_dir)
+        self.profile = BuildProfile(
+            enabled=bool(self.profile_file or self.profile_build_run))
+        self.profile.start()
+        try:
+            self._build(force=force)
+        finally:
+            self.save_profile()
+
+    def _build(self, force=False):
+        # The staging area isn't cleared, so files that come out the same
+        # as last time aren't rewritten. Whatever this build doesn't stage
+        # is removed at the end.
+        self.staged = set()
+        self.fragments = {}
         self.dns_tasks = self.get_scheduled()
 
         if not self.dns_tasks and not force:
             self.log_info('Nothing to do!')
+            self.remove_unstaged_files()
             return
 
-        # zone files
-        soa_pks_to_rebuild = set(int(t.task) for t in self.dns_tasks)
-        self.build_config_files(self.build_zone_files(soa_pks_to_rebuild,
-                                force=force))
+        # Files are checked in the background while the others are built.
+        self.check_pool = CommandPool(self.check_jobs, logger=self,
+                                      profile=self.profile)
+        self.check_cache = ChecksumCache(self.check_cache_file)
+        if not force:
+            self.check_cache.load()
+        self.serial_manifest = SerialManifest()
+        self.serial_manifest.load(
+            os.path.join(self.prod_dir, SERIAL_MANIFEST_FNAME))
+        if self.shard_reverse_zones:
+            # Sharded zones are checked as single files, which mustn't end
+            # up in the staging area.
+            self.check_dir = tempfile.mkdtemp(prefix='cyder_dns_check.')
+
+        try:
+            # zone files
+            soa_pks_to_rebuild = set(int(t.task) for t in self.dns_tasks)
+            self.build_config_files(self.build_zone_files(soa_pks_to_rebuild,
+                                    force=force))
+            self.check_pool.wait()
+        except:
+            self.check_pool.terminate()
+            raise
+        finally:
+            if self.check_dir is not None:
+                shutil.rmtree(self.check_dir)
+                self.check_dir = None
+
+        self.check_cache.save()
+        self.staged.add(SERIAL_MANIFEST_FNAME)
+        self.serial_manifest.save(
+            os.path.join(self.stage_dir, SERIAL_MANIFEST_FNAME))
+        self.remove_unstaged_files()
 
         self.log_info('DNS build successful')
 
+    def remove_unstaged_files(self):
+        """
+        Delete the files in the staging area that the last build didn't
+        stage, e.g. those of an earlier build that wasn't pushed, so they
+        aren't pushed with this one.
+        """
+        for dirpath, _, filenames in os.walk(self.stage_dir):
+            for filename in filenames:
+                fname = os.path.join(dirpath, filename)
+                if os.path.relpath(fname, self.stage_dir) not in self.staged:
+                    os.remove(fname)
+
+    def remove_stale_fragments(self):
+        """
+        Delete the fragments in prod of the zone files that the last build
+        sharded but didn't write (e.g. those of /24s that no longer have
+        any records). Return their paths, relative to prod.
+        """
+        removed = []
+        for rel_dir, names in (self.fragments or {}).iteritems():
+            prod_dir = os.path.join(self.prod_dir, rel_dir)
+            if not os.path.isdir(prod_dir):
+                continue
+            for name in sorted(os.listdir(prod_dir)):
+                if name not in names:
+                    os.remove(os.path.join(prod_dir, name))
+                    removed.append(os.path.join(rel_dir, name))
+        return removed
+
+    def save_profile(self):
+        """
+        Write the build's profile to `profile_file` and/or a
+        :class:`DNSBuildRun`, if either is enabled. See :class:`BuildProfile`.
+        """
+        self.profile.stop()
+        if not self.profile.enabled:
+            return
+        if self.profile_file:
+            self.profile.save(self.profile_file)
+        if self.profile_build_run:
+            if self.build_run is None:
+                self.build_run = DNSBuildRun(log='')
+            self.build_run.set_stats(self.profile.report())
+            self.build_run.save()
+
     @mail_if_failure('Cyder DNS build failed')
     def push(self, sanity_check=True):
-        self.repo.reset_and_pull()
+        if self.profile is None:
+            # Nothing was built, so there's nothing to add to.
+            self.profile = BuildProfile(enabled=False)
+
+        with self.profile.measure('git', 'reset_and_pull'):
+            self.repo.reset_and_pull()
 
         try:
-            copy_tree(self.stage_dir, self.prod_dir)
+            changed = copy_changed(self.stage_dir, self.prod_dir)
+            changed += self.remove_stale_fragments()
         except:
             self.repo.reset_to_head()
             raise
 
-        self.repo.commit_and_push('Update config', sanity_check=sanity_check)
-        map(lambda t: t.delete(), self.dns_tasks)
+        with self.profile.measure('git', 'commit_and_push',
+                                  files=len(changed)):
+            self.repo.commit_and_push('Update config',
+                                      sanity_check=sanity_check,
+                                      paths=changed)
+        if self.task_watermark is not None:
+            Task.dns.filter(claimed=True,
+                            pk__lte=self.task_watermark).delete()
+        self.save_profile()
 
     def _lock_failure(self, pid):
         fail_mail(
@@ -0,0 +1,135 @@
+"""
+IXFR-style journals (RFC 1995) of the changes between versions of a zone file.
+
+A journal holds the most recent difference sequences of a zone, oldest first,
+separated by blank lines. Each sequence is the old SOA record, the records
+that were removed, the new SOA record, and the records that were added, one
+record per line.
+"""
+
+# Where journals go, relative to the root of the repo. A journal's path under
+# it is the same as its zone file's path under the root.
+JOURNAL_DIR = 'ixfr'
+
+
+def _strip_line(line):
+    """
+    Return `line` without its comment and the change in parenthesis depth
+    it causes.
+    """
+    depth = 0
+    in_quotes = escaped = False
+    for i, c in enumerate(line):
+        if escaped:
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        elif c == '"':
+            in_quotes = not in_quotes
+        elif in_quotes:
+            continue
+        elif c == ';':
+            return line[:i], depth
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+    return line, depth
+
+
+def get_records(data):
+    """
+    Return the records (and directives) in zone file data, in order. Records
+    that span several lines are joined into one.
+    """
+    records = []
+    parts = []
+    depth = 0
+    for line in data.splitlines():
+        line, delta = _strip_line(line)
+        line = line.strip()
+        if line:
+            parts.append(line)
+        depth += delta
+        if depth <= 0 and parts:
+            records.append(' '.join(parts))
+            parts = []
+            depth = 0
+    if parts:
+        records.append(' '.join(parts))
+    return records
+
+
+def _is_soa(record):
+    # name [ttl] [class] SOA ...
+    return 'SOA' in [field.upper() for field in record.split()[1:4]]
+
+
+def _soa_record(record):
+    return ' '.join(record.replace('(', ' ').replace(')', ' ').split())
+
+
+def diff_zone(old_data, new_data):
+    """
+    Return the difference sequence that turns `old_data` into `new_data` as
+    a list of lines, or None if there isn't one. There isn't one if either
+    doesn't start with an SOA record or if their directives (e.g.
+    $GENERATE) differ, since those can't be expressed in IXFR.
+    """
+    old_records = get_records(old_data)
+    new_records = get_records(new_data)
+    if not old_records or not new_records:
+        return None
+
+    old_soa, new_soa = old_records.pop(0), new_records.pop(0)
+    if not (_is_soa(old_soa) and _is_soa(new_soa)):
+        return None
+
+    if ([r for r in old_records if r.startswith('$')] !=
+            [r for r in new_records if r.startswith('$')]):
+        return None
+
+    old_set = set(r for r in old_records if not r.startswith('$'))
+    new_set = set(r for r in new_records if not r.startswith('$'))
+    removed = [r for r in old_records if r in old_set - new_set]
+    added = [r for r in new_records if r in new_set - old_set]
+
+    return ([_soa_record(old_soa)] + removed +
+            [_soa_record(new_soa)] + added)
+
+
+def parse_journal(data):
+    """Return the difference sequences in a journal."""
+    return [sequence.splitlines() for sequence in data.split('\n\n')
+            if sequence.strip()]
+
+
+def render_journal(sequences):
+    return ''.join('\n'.join(sequence) + '\n\n' for sequence in sequences)
+
+
+def update_journal(journal_data, old_data, new_data, max_length):
+    """
+    Return the journal `journal_data` with the difference sequence from
+    `old_data` to `new_data` appended and only the last `max_length`
+    sequences kept.
+
+    If there's no difference sequence or it doesn't follow on from the last
+    one in the journal, the journal is started over. A secondary whose serial
+    isn't in the journal needs a full transfer anyway.
+    """
+    sequences = parse_journal(journal_data)
+    sequence = diff_zone(old_data, new_data)
+    if sequence is None:
+        return ''
+
+    if sequences:
+        # The old SOA of the new sequence must be the new SOA of the last.
+        last = sequences[-1]
+        last_new_soa = next((line for line in last[1:] if _is_soa(line)),
+                            None)
+        if last_new_soa != sequence[0]:
+            sequences = []
+
+    sequences.append(sequence)
+    return render_journal(sequences[-max_length:])
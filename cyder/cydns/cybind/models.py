@@ -1,3 +1,5 @@
+import json
+
 from django.db import models
 
 
@@ -10,7 +12,8 @@ class DNSBuildRun(models.Model):
     state.
     """
     log = models.TextField()
-    #stats_json = models.JSONField("stats", max_length=max_length)
+    # The build's profile as JSON. See :class:`BuildProfile`.
+    stats_json = models.TextField(blank=True, default='{}')
 
     class Meta:
         app_label = 'cyder'
@@ -21,8 +24,16 @@ class DNSBuildRun(models.Model):
         bm.save()
         return bm
 
+    def get_stats(self):
+        return json.loads(self.stats_json or '{}')
+
+    def set_stats(self, stats):
+        self.stats_json = json.dumps(stats, sort_keys=True)
+
     def stash(self, k, v):
-        self.stats_json[k] = v
+        stats = self.get_stats()
+        stats[k] = v
+        self.set_stats(stats)
 
     def get_manifests(self, **kwargs):
         return BuildManifest.objects.filter(build_run=self, **kwargs)
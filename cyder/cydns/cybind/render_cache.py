@@ -0,0 +1,103 @@
+import errno
+import json
+import os
+from datetime import datetime, timedelta
+
+
+# Bump this whenever the way records are rendered changes so that old cache
+# files are ignored.
+RENDER_CACHE_VERSION = 2
+
+# `modified` may only be precise to the second, so a record that was changed
+# again within a second of being rendered could look unchanged. Records that
+# were modified more recently than this aren't remembered.
+MIN_ENTRY_AGE = timedelta(seconds=2)
+
+
+class RenderCache(object):
+    """
+    Remembers what records were rendered to so that unchanged records don't
+    have to be rendered again.
+
+    Entries are keyed by the record's table, its pk, and the arguments it was
+    rendered with. An entry is only used if the record's `modified` timestamp
+    hasn't changed since it was rendered. Rendering doesn't depend on the
+    view, so a record that's in several views is only rendered once. Forced
+    builds don't use the previous cache, so they render every record.
+
+    If `path` is given, the cache can be loaded from and saved to that file
+    as JSON between builds.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.new_entries = {}
+
+    def load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if data['version'] != RENDER_CACHE_VERSION:
+                return
+            entries = dict(
+                ((table, pk, tuple(tuple(kwarg) for kwarg in kwargs)),
+                 (datetime(*modified), line))
+                for table, pk, kwargs, modified, line in data['entries'])
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except (KeyError, TypeError, ValueError):
+            # The cache is corrupt, so start over.
+            pass
+        else:
+            self.entries = entries
+
+    def save(self):
+        if not self.path:
+            return
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        entries = [
+            (table, pk, kwargs,
+             modified.timetuple()[:6] + (modified.microsecond,), line)
+            for (table, pk, kwargs), (modified, line)
+            in self.entries.iteritems()]
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': RENDER_CACHE_VERSION, 'entries': entries},
+                      f)
+        os.rename(tmp_path, self.path)
+
+    def render(self, renderer, row):
+        """
+        Return `renderer.render(row)`, rendering if needed. See
+        :class:`RowRenderer`.
+        """
+        pk, modified = row[0], row[1]
+        if modified is None:
+            return renderer.render(row)
+
+        key = (renderer.table, pk, renderer.cache_kwargs)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == modified:
+            return entry[1]
+
+        line = renderer.render(row)
+        if datetime.now() - modified >= MIN_ENTRY_AGE:
+            self.entries[key] = self.new_entries[key] = (modified, line)
+        return line
+
+    def pop_new_entries(self):
+        """
+        Return the entries added since the last call and forget that they
+        were new. Used to send entries from worker processes to the parent.
+        """
+        new_entries, self.new_entries = self.new_entries, {}
+        return new_entries
+
+    def update(self, entries):
+        self.entries.update(entries)
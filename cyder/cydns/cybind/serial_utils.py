@@ -1,6 +1,18 @@
-import re
-import os
 import errno
+import hashlib
+import json
+
+from cyder.base.utils import open_if_changed
+
+
+# The name of the serial manifest, relative to the root of the repo.
+SERIAL_MANIFEST_FNAME = 'serials.json'
+
+
+def file_checksum(fname):
+    with open(fname, 'rb') as fd:
+        return hashlib.sha1(fd.read()).hexdigest()
+
 
 def get_serial(file_):
     """
@@ -105,7 +117,7 @@ def _lex_word(ll):
                 return word
             else:
                 return None
-        if re.match('\s', c):
+        if c.isspace():
             ll.unpop()
             break
         else:
@@ -119,7 +131,7 @@ def _lex_ws(ll):
         c = ll.pop()
         if c is None:
             return
-        if re.match('\s', c):
+        if c.isspace():
             continue
         else:
             ll.unpop()
@@ -147,3 +159,83 @@ class LexLine(object):
 
     def peek(self):
         return self.line[self.pos]
+
+
+class SerialManifest(object):
+    """
+    Maps each zone file (by its path relative to the root of the repo) to its
+    serial and a checksum of its contents. The builder keeps a manifest in the
+    repo with the zone files so it doesn't have to lex every zone file to find
+    its serial. A file whose checksum doesn't match (e.g. because someone
+    edited it by hand) is lexed as before.
+    """
+
+    def __init__(self):
+        self.previous = {}
+        self.entries = {}
+
+    def load(self, fname):
+        try:
+            with open(fname) as fd:
+                previous = json.load(fd)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            # The manifest is corrupt, so every file will be lexed.
+            pass
+        else:
+            if isinstance(previous, dict):
+                self.previous = previous
+
+    def save(self, fname):
+        with open_if_changed(fname) as fd:
+            # One value per line keeps diffs (and the line count sanity
+            # check) sensible.
+            json.dump(self.entries, fd, indent=4, sort_keys=True)
+            fd.write('\n')
+
+    def get_serial(self, rel_fname, fname):
+        """
+        Return the serial of the zone file `fname`, or '' if it doesn't exist
+        or doesn't have one. The serial is taken from the manifest if the file
+        hasn't changed since the manifest was saved.
+        """
+        try:
+            checksum = file_checksum(fname)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return ''
+            raise
+
+        entry = self.previous.get(rel_fname)
+        if (isinstance(entry, dict) and entry.get('checksum') == checksum
+                and isinstance(entry.get('serial'), int)):
+            serial = str(entry['serial'])
+        else:
+            serial = get_serial(fname)
+
+        if serial.isdigit():
+            self.entries[rel_fname] = {
+                'serial': int(serial),
+                'checksum': checksum,
+            }
+        return serial
+
+    def set(self, rel_fname, serial, fname):
+        """Record that the zone file `fname` was built with `serial`."""
+        self.entries[rel_fname] = {
+            'serial': serial,
+            'checksum': file_checksum(fname),
+        }
+
+    def pop_entries(self):
+        """
+        Return the entries recorded since the last call and forget them. Used
+        to send entries from worker processes to the parent.
+        """
+        entries, self.entries = self.entries, {}
+        return entries
+
+    def update(self, entries):
+        self.entries.update(entries)
@@ -1,18 +1,32 @@
 import errno
+import json
 import os
+import re
 import shutil
+import sys
 from django.core.management import call_command
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from time import sleep
 
 from cyder.base.utils import remove_dir_contents
 from cyder.base.vcs import GitRepo, GitRepoManager, SanityCheckFailure
+from cyder.core.ctnr.models import Ctnr
 from cyder.core.system.models import System
+from cyder.core.task.models import Task
 from cyder.cydhcp.interface.static_intr.models import StaticInterface
 from cyder.cydhcp.range.models import Range
 from cyder.cydns.cname.models import CNAME
 from cyder.cydns.cybind.builder import DNSBuilder
+from cyder.cydns.cybind.journal import JOURNAL_DIR, get_records
+from cyder.cydns.cybind.models import DNSBuildRun
+from cyder.cydns.cybind.render_cache import RenderCache
+from cyder.cydns.cybind.row_renderers import RENDERERS
+from cyder.cydns.cybind.serial_utils import SERIAL_MANIFEST_FNAME
+from cyder.cydns.cybind.zone_builder import build_zone_data
+from cyder.cydns.cybind.zone_loader import RECORD_SETS, ZoneDataLoader
 from cyder.cydns.domain.models import Domain
+from cyder.cydns.soa.models import SOA
+from cyder.cydns.txt.models import TXT
 from cyder.cydns.view.models import View
 
 
@@ -32,21 +46,29 @@ BINDBUILD = {
 
 PROD_ORIGIN_DIR = '/tmp/cyder_dns_test/prod_origin/'
 
+STUB_CHECKER = os.path.join(os.path.dirname(__file__), 'stub_checker.py')
+CHECK_LOG = '/tmp/cyder_dns_test.check_log'
+CHECK_CACHE = '/tmp/cyder_dns_test.check_cache'
+PROFILE_FILE = '/tmp/cyder_dns_test.profile'
 
-class DNSBuildTest(TestCase):
+
+class DNSBuildTestMixin(object):
     fixtures = ['dns_build_test.json']
 
+    def remove_stop_file(self):
+        try:
+            os.remove(BINDBUILD['stop_file'])
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
     def build_and_push(self, force=False, sanity_check=True):
         """
         force: whether to force unchanged zones to be rebuilt
         sanity_check: whether to run the diff sanity check
         """
 
-        try:
-            os.remove(BINDBUILD['stop_file'])
-        except OSError as e:
-            if e.errno != errno.ENOENT:
-                raise
+        self.remove_stop_file()
         self.builder.build(force=force)
         self.builder.push(sanity_check=sanity_check)
 
@@ -72,7 +94,10 @@ class DNSBuildTest(TestCase):
         self.builder = DNSBuilder(verbose=False, debug=False, **BINDBUILD)
         self.builder.repo.commit_and_push(empty=True, message='Initial commit')
 
-        super(DNSBuildTest, self).setUp()
+        super(DNSBuildTestMixin, self).setUp()
+
+
+class DNSBuildTest(DNSBuildTestMixin, TestCase):
 
     def test_force(self):
         """Test that the 'force' argument works"""
@@ -108,6 +133,25 @@ class DNSBuildTest(TestCase):
 
         self.assertNotEqual(rev1, rev2)
 
+    def test_task_queue(self):
+        """Test that zones have at most one pending task and that tasks
+        scheduled during a build survive it"""
+
+        Task.dns.all().delete()
+        soa = Domain.objects.get(name='example.com').soa
+        soa.schedule_rebuild()
+        soa.schedule_rebuild()
+        self.assertEqual(Task.dns.count(), 1)
+
+        self.remove_stop_file()
+        self.builder.build()
+        self.assertFalse(Task.dns.filter(claimed=False).exists())
+        soa.schedule_rebuild()  # The zone changed during the build.
+        self.builder.push(sanity_check=False)
+
+        self.assertEqual(list(Task.dns.values_list('task', 'claimed')),
+                         [(str(soa.pk), False)])
+
     def test_sanity_check_increase(self):
         """Test sanity check when line count increases"""
 
@@ -167,3 +211,354 @@ class DNSBuildTest(TestCase):
 
         self.builder.repo.line_decrease_limit = 100
         self.build_and_push()
+
+    def test_zone_loader(self):
+        """Test that a shared loader renders the same data as a per-zone one
+        """
+
+        def log(msg):
+            pass
+
+        loader = ZoneDataLoader()
+        for soa in SOA.objects.all():
+            for view in View.objects.all():
+                self.assertEqual(
+                    build_zone_data(view, soa.root_domain, soa, logf=log,
+                                    loader=loader),
+                    build_zone_data(view, soa.root_domain, soa, logf=log))
+
+    def test_render_cache(self):
+        """Test that cached records are only used until they change"""
+
+        def log(msg):
+            pass
+
+        def build():
+            return build_zone_data(view, soa.root_domain, soa, logf=log,
+                                   render_cache=cache)
+
+        cache = RenderCache()
+        soa = Domain.objects.get(name='example.com').soa
+        view = View.objects.get(name='public')
+
+        data = build()
+        self.assertIn('www.example.com.', data)
+        self.assertTrue(cache.entries)
+        self.assertEqual(build(), data)
+
+        cache.path = os.path.join(BINDBUILD['stage_dir'], 'render_cache')
+        cache.save()
+        loaded = RenderCache(cache.path)
+        loaded.load()
+        self.assertEqual(loaded.entries, cache.entries)
+
+        cname = CNAME.objects.get(fqdn='foo.example.com')
+        cname.target = 'www2.example.com'
+        cname.save()
+        self.assertEqual(
+            build(), build_zone_data(view, soa.root_domain, soa, logf=log))
+        self.assertNotEqual(build(), data)
+
+    def test_row_renderers(self):
+        """Test that rows are rendered the same way as model instances"""
+
+        for name, record_set in RECORD_SETS.iteritems():
+            renderer = RENDERERS[name]
+            records = record_set['model'].objects.filter(
+                **record_set.get('filter', {}))
+            rows = dict((row[0], row) for row in renderer.get_rows(records))
+            for record in records:
+                self.assertEqual(
+                    renderer.render(rows[record.pk]),
+                    record.bind_render_record(
+                        **dict(renderer.cache_kwargs)))
+
+    def test_serial_manifest(self):
+        """Test that hand-edited zone files are noticed despite the manifest
+        """
+
+        def get_manifest():
+            with open(os.path.join(BINDBUILD['prod_dir'],
+                                   SERIAL_MANIFEST_FNAME)) as f:
+                return json.load(f)
+
+        self.build_and_push(force=True)
+        manifest = get_manifest()
+        rel_fname, entry = sorted(manifest.items())[0]
+
+        # Edit a zone file's serial by hand.
+        fname = os.path.join(BINDBUILD['prod_dir'], rel_fname)
+        with open(fname) as f:
+            data = f.read()
+        with open(fname, 'w') as f:
+            f.write(data.replace(str(entry['serial']),
+                                 str(entry['serial'] + 10)))
+        self.builder.repo.commit_and_push('Edit by hand', sanity_check=False)
+
+        # Rebuild some other zone.
+        for soa in SOA.objects.all():
+            if soa.root_domain.name not in rel_fname:
+                soa.schedule_rebuild()
+                break
+        self.build_and_push(sanity_check=False)
+
+        manifest = get_manifest()
+        self.assertEqual(manifest[rel_fname]['serial'], entry['serial'] + 11)
+
+    def test_ixfr_journal(self):
+        """Test that the IXFR journal records changes between builds"""
+
+        self.builder.ixfr_journal_length = 2
+        self.build_and_push(force=True)
+
+        cname = CNAME.objects.get(fqdn='foo.example.com')
+        cname.target = 'www2.example.com'
+        cname.save()
+        sleep(1)  # Ensure a different serial.
+        self.build_and_push()
+
+        with open(os.path.join(BINDBUILD['prod_dir'], JOURNAL_DIR,
+                               'com/example/example.com.public')) as f:
+            sequences = f.read().strip().split('\n\n')
+        self.assertEqual(len(sequences), 1)
+        old_soa, removed, new_soa, added = sequences[0].split('\n')
+        self.assertIn(' SOA ', old_soa)
+        self.assertIn(' SOA ', new_soa)
+        self.assertTrue(removed.startswith('foo.example.com.'))
+        self.assertTrue(removed.endswith(' www.example.com.'))
+        self.assertTrue(added.startswith('foo.example.com.'))
+        self.assertTrue(added.endswith(' www2.example.com.'))
+
+    def test_unchanged_files_untouched(self):
+        """Test that push only copies files that changed"""
+
+        self.build_and_push(force=True)
+        config = os.path.join(BINDBUILD['prod_dir'], 'config/master.public')
+        zone = os.path.join(BINDBUILD['prod_dir'],
+                            'com/example/example.com.public')
+        config_mtime = os.path.getmtime(config)
+        zone_mtime = os.path.getmtime(zone)
+
+        sleep(1)  # Ensure different mtimes and serial.
+        Domain.objects.get(name='example.com').soa.schedule_rebuild()
+        self.build_and_push()
+
+        self.assertEqual(os.path.getmtime(config), config_mtime)
+        self.assertNotEqual(os.path.getmtime(zone), zone_mtime)
+
+    def test_sharded_reverse_zones(self):
+        """Test that sharded reverse zones have the same records and that
+        unchanged fragments aren't staged"""
+
+        soa = Domain.objects.get(name='192.in-addr.arpa').soa
+        view = View.objects.get(name='public')
+        rel_fname = 'reverse/in-addr.arpa/192.in-addr.arpa.public'
+        fragment = rel_fname + '.d/0.168.192.in-addr.arpa'
+
+        self.builder.shard_reverse_zones = True
+        self.build_and_push(force=True)
+        with open(os.path.join(BINDBUILD['prod_dir'], rel_fname)) as f:
+            self.assertIn('$INCLUDE ' + fragment, f.read())
+        file_meta = self.builder.get_file_meta(view, soa.root_domain, soa)
+        soa = SOA.objects.get(pk=soa.pk)
+        self.assertEqual(
+            sorted(get_records(self.builder.read_zone(
+                file_meta, (BINDBUILD['prod_dir'],)))),
+            sorted(get_records(build_zone_data(
+                view, soa.root_domain, soa, logf=lambda msg: None))))
+
+        sleep(1)  # Ensure different serial.
+        soa.schedule_rebuild()
+        self.remove_stop_file()
+        self.builder.build()
+        self.assertTrue(os.path.exists(
+            os.path.join(BINDBUILD['stage_dir'], rel_fname)))
+        self.assertFalse(os.path.exists(
+            os.path.join(BINDBUILD['stage_dir'], fragment)))
+        self.builder.push()
+
+    def test_stale_fragments_removed(self):
+        """Test that fragments that are no longer written are deleted from
+        prod"""
+
+        soa = Domain.objects.get(name='192.in-addr.arpa').soa
+        rel_fname = 'reverse/in-addr.arpa/192.in-addr.arpa.public'
+        stale = rel_fname + '.d/9.9.192.in-addr.arpa'
+        prod_stale = os.path.join(BINDBUILD['prod_dir'], stale)
+
+        self.builder.shard_reverse_zones = True
+        self.build_and_push(force=True)
+        with open(prod_stale, 'w') as f:
+            f.write('; no longer generated\n')
+        self.builder.repo.commit_and_push('Add a stale fragment',
+                                          sanity_check=False, paths=[stale])
+
+        sleep(1)  # Ensure different serial.
+        soa.schedule_rebuild()
+        self.build_and_push()
+        self.assertFalse(os.path.exists(prod_stale))
+
+    def test_unchanged_stage_files_untouched(self):
+        """Test that staged files that come out the same aren't rewritten
+        and that files the build didn't stage are removed"""
+
+        self.build_and_push(force=True)
+        config = os.path.join(BINDBUILD['stage_dir'], 'config/master.public')
+        config_mtime = os.path.getmtime(config)
+        leftover = os.path.join(BINDBUILD['stage_dir'], 'leftover')
+        with open(leftover, 'w') as f:
+            f.write('from a build that was never pushed\n')
+
+        sleep(1)  # Ensure different mtimes and serial.
+        Domain.objects.get(name='example.com').soa.schedule_rebuild()
+        self.build_and_push()
+
+        self.assertEqual(os.path.getmtime(config), config_mtime)
+        self.assertFalse(os.path.exists(leftover))
+
+    def test_braces_in_records(self):
+        """Test that records containing braces are written verbatim"""
+
+        txt = TXT.objects.create(
+            label='braces',
+            domain=Domain.objects.get(name='example.com'),
+            ctnr=Ctnr.objects.get(name='campus'),
+            txt_data='{serial} {{}}',
+        )
+        txt.views.add(View.objects.get(name='public'))
+        self.build_and_push(force=True)
+
+        with open(os.path.join(BINDBUILD['prod_dir'],
+                               'com/example/example.com.public')) as f:
+            self.assertIn('{serial} {{}}', f.read())
+
+    def test_profile(self):
+        """Test that the build profile is written"""
+
+        self.builder.profile_file = PROFILE_FILE
+        self.builder.profile_build_run = True
+        self.build_and_push(force=True)
+
+        with open(PROFILE_FILE) as f:
+            report = json.load(f)
+        zones = [e for e in report['entries'] if e['kind'] == 'zone']
+        views = [e for e in report['entries'] if e['kind'] == 'view']
+        self.assertTrue(any(e['name'] == 'example.com' for e in zones))
+        self.assertTrue(any(e.get('bytes') for e in views))
+        self.assertGreater(report['totals']['zone']['queries'], 0)
+        self.assertEqual(report['totals']['git']['count'], 2)
+
+        build_run = DNSBuildRun.objects.get()
+        self.assertEqual(build_run.get_stats()['entries'],
+                         report['entries'])
+
+
+class DNSCheckTest(DNSBuildTestMixin, TestCase):
+    def setUp(self):
+        super(DNSCheckTest, self).setUp()
+
+        for fname in (CHECK_LOG, CHECK_CACHE):
+            try:
+                os.remove(fname)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+        self.builder.check_jobs = 3
+        self.builder.check_cache_file = CHECK_CACHE
+        self.use_stub_checker()
+
+    def use_stub_checker(self, fail=False):
+        checker = ' '.join(
+            (sys.executable, STUB_CHECKER, CHECK_LOG) +
+            (('--fail',) if fail else ()))
+        self.builder.named_checkzone = checker
+        self.builder.named_checkconf = checker
+
+    def get_checked(self):
+        try:
+            with open(CHECK_LOG) as f:
+                return f.read().splitlines()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+
+    def test_checks_run(self):
+        """Test that every zone file and config file is checked"""
+
+        self.build_and_push(force=True)
+        checked = self.get_checked()
+        self.assertTrue(any(' example.com ' in c for c in checked))
+        self.assertTrue(any(c.endswith('/config/master.public')
+                            for c in checked))
+
+    def test_unchanged_files_skipped(self):
+        """Test that files identical to ones that passed aren't rechecked"""
+
+        self.build_and_push(force=True)
+        num_checked = len(self.get_checked())
+
+        soa = Domain.objects.get(name='example.com').soa
+        soa.schedule_rebuild()
+        self.build_and_push()
+        self.assertEqual(len(self.get_checked()), num_checked)
+
+        cname = CNAME.objects.get(fqdn='foo.example.com')
+        cname.target = 'www2.example.com'
+        cname.save()
+        self.build_and_push()
+        self.assertGreater(len(self.get_checked()), num_checked)
+
+    def test_check_cache_saved(self):
+        """Test that the check cache is saved in a directory of its own
+        without leaving temporary files behind"""
+
+        cache_dir = '/tmp/cyder_dns_test/check_cache'
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        self.builder.check_cache_file = os.path.join(cache_dir, 'cache.json')
+        self.build_and_push(force=True)
+
+        self.assertEqual(os.listdir(cache_dir), ['cache.json'])
+        with open(self.builder.check_cache_file) as f:
+            self.assertTrue(json.load(f))
+
+    def test_check_failure(self):
+        """Test that a failed check fails the build and dirties the zone"""
+
+        SOA.objects.update(dirty=False)
+        self.use_stub_checker(fail=True)
+        self.assertRaises(Exception, self.builder.build, force=True)
+        self.assertTrue(SOA.objects.filter(dirty=True).exists())
+
+
+class DNSParallelBuildTest(DNSBuildTestMixin, TransactionTestCase):
+    """
+    The worker processes open their own database connections, so they can
+    only see data that has been committed.
+    """
+
+    def get_stage_contents(self):
+        contents = {}
+        for dirpath, _, filenames in os.walk(BINDBUILD['stage_dir']):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                rel_path = os.path.relpath(path, BINDBUILD['stage_dir'])
+                with open(path) as f:
+                    # Serials depend on the time of the build.
+                    contents[rel_path] = re.sub(
+                        r'\d+(\s+; Serial)', r'\1', f.read())
+        return contents
+
+    def test_parallel_build(self):
+        """Test that building zones in parallel gives the same result"""
+
+        self.build_and_push(force=True, sanity_check=False)
+        serial_contents = self.get_stage_contents()
+
+        self.builder.jobs = 3
+        self.build_and_push(force=True, sanity_check=False)
+        parallel_contents = self.get_stage_contents()
+
+        self.assertTrue(serial_contents)
+        self.assertEqual(serial_contents, parallel_contents)
@@ -0,0 +1,25 @@
+"""
+A stand-in for named-checkzone and named-checkconf so builds can be tested
+without BIND installed.
+
+Usage: python stub_checker.py LOG_FILE [--fail] ARGS...
+
+Appends ARGS to LOG_FILE (one line per call) and exits successfully, or
+unsuccessfully if --fail is given.
+"""
+import sys
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    log_file = args.pop(0)
+    fail = args[:1] == ['--fail']
+    if fail:
+        args.pop(0)
+
+    with open(log_file, 'a') as f:
+        f.write(' '.join(args) + '\n')
+
+    if fail:
+        sys.stderr.write('stub checker failed\n')
+        sys.exit(1)
@@ -1,17 +1,11 @@
-from django.db.models import Q
+import hashlib
+from itertools import chain
 
 from cyder.base.constants import IP_TYPE_4, IP_TYPE_6
-from cyder.cydns.address_record.models import AddressRecord
-from cyder.cydns.cname.models import CNAME
-from cyder.cydns.mx.models import MX
-from cyder.cydns.nameserver.models import Nameserver
-from cyder.cydns.ptr.models import PTR
-from cyder.cydns.srv.models import SRV
-from cyder.cydns.txt.models import TXT
-from cyder.cydns.sshfp.models import SSHFP
+from cyder.base.utils import open_if_changed
+from cyder.cydns.cybind.row_renderers import RENDERERS
+from cyder.cydns.cybind.zone_loader import ZoneDataLoader
 from cyder.cydns.view.models import View
-from cyder.cydhcp.interface.static_intr.models import StaticInterface
-from cyder.cydhcp.range.models import Range
 
 from gettext import gettext as _
 from cyder.core.utils import fail_mail
@@ -19,9 +13,10 @@ from cyder.core.utils import fail_mail
 DEFAULT_TTL = 3600
 
 
-def render_soa_only(soa, root_domain):
+def render_soa_only(soa, root_domain, serial):
     kwargs = {
         'root_domain': root_domain.name,
+        'serial': serial,
         'primary': soa.primary,
         'contact': soa.contact,
         'refresh': soa.refresh,
@@ -31,7 +26,7 @@ def render_soa_only(soa, root_domain):
         'ttl': soa.ttl,
     }
     BUILD_STR = _("{root_domain}.  {ttl}  IN  SOA  {primary}. {contact}. (\n"
-                  "\t\t{{serial}}     ; Serial\n"
+                  "\t\t{serial}     ; Serial\n"
                   "\t\t{refresh}     ; Refresh\n"
                   "\t\t{retry}     ; Retry\n"
                   "\t\t{expire}     ; Expire\n"
@@ -40,117 +35,226 @@ def render_soa_only(soa, root_domain):
     return BUILD_STR
 
 
-def render_rdtype(rdtype_set, **kwargs):
-    if len(rdtype_set) == 0:
-        return ""
+def iter_rdtype(rows, renderer, cache=None, sort=True):
+    """
+    Render the records in `rows` with `renderer` and yield them one at a
+    time. See :class:`RowRenderer`.
+    """
+    if len(rows) == 0:
+        return
 
-    rdtype_set = map(lambda obj: obj.bind_render_record(**kwargs), rdtype_set)
-    rdtype_set = (r.strip() for r in rdtype_set if r.strip())
-    if kwargs.pop('sort', True):
-        rdtype_set = sorted(rdtype_set, key=lambda s: s.lower())
+    if cache is None:
+        lines = (renderer.render(row) for row in rows)
+    else:
+        lines = (cache.render(renderer, row) for row in rows)
+    lines = (r.strip() for r in lines)
+    lines = (r for r in lines if r)
+    if sort:
+        lines = sorted(lines, key=lambda s: s.lower())
 
-    return "\n".join(rdtype_set) + "\n"
+    for r in lines:
+        yield r + "\n"
 
 
-def _render_forward_zone(default_ttl, nameserver_set, mx_set,
-                         addressrecord_set, interface_set, cname_set, srv_set,
-                         txt_set, sshfp_set, range_set):
-    BUILD_STR = ""
-    BUILD_STR += render_rdtype(nameserver_set)
-    BUILD_STR += render_rdtype(mx_set)
-    BUILD_STR += render_rdtype(txt_set)
-    BUILD_STR += render_rdtype(sshfp_set)
-    BUILD_STR += render_rdtype(srv_set)
-    BUILD_STR += render_rdtype(cname_set)
-    BUILD_STR += render_rdtype(interface_set, rdtype='A')
-    BUILD_STR += render_rdtype(addressrecord_set)
-    BUILD_STR += render_rdtype(range_set, sort=False)
-    return BUILD_STR
+def render_rdtype(rows, renderer, cache=None, sort=True):
+    return "".join(iter_rdtype(rows, renderer, cache=cache, sort=sort))
 
 
-def render_forward_zone(view, mega_filter):
-    data = _render_forward_zone(
-        default_ttl=DEFAULT_TTL,
+def iter_ranges(range_set, reverse=False, sort=False):
+    """
+    Yield the $GENERATE lines of the ranges in `range_set`. They're cheap to
+    generate and there can be a lot of them, so they're streamed rather than
+    cached.
 
-        nameserver_set=Nameserver.objects
-        .filter(mega_filter)
-        .filter(views__name=view.name).order_by('server'),
-
-        mx_set=MX.objects
-        .filter(mega_filter)
-        .filter(views__name=view.name).order_by('server'),
-
-        addressrecord_set=AddressRecord.objects
-        .filter(mega_filter).filter(views__name=view.name)
-        .order_by('pk', 'ip_type', 'fqdn', 'ip_upper', 'ip_lower'),
-
-        interface_set=StaticInterface.objects
-        .filter(mega_filter, dns_enabled=True)
-        .filter(views__name=view.name)
-        .order_by('pk', 'ip_type', 'fqdn', 'ip_upper', 'ip_lower'),
-
-        cname_set=CNAME.objects
-        .filter(mega_filter)
-        .filter(views__name=view.name)
-        .order_by('fqdn'),
-
-        srv_set=SRV.objects
-        .filter(mega_filter)
-        .filter(views__name=view.name)
-        .order_by('pk', 'fqdn'),
-
-        txt_set=TXT.objects
-        .filter(mega_filter)
-        .filter(views__name=view.name)
-        .order_by('pk', 'fqdn'),
-
-        sshfp_set=SSHFP.objects
-        .filter(mega_filter)
-        .filter(views__name=view.name)
-        .order_by('pk', 'fqdn'),
-
-        range_set=Range.objects
-        .filter(mega_filter)
-        .filter(views__name=view.name)
-        .order_by('start_upper', 'start_lower'),
+    If `sort` is True, the ranges are ordered by their first line, the way
+    :func:`iter_rdtype` orders records.
+    """
+    if sort:
+        keyed = []
+        for range_ in range_set:
+            first_line = next(range_.iter_bind_records(reverse=reverse), None)
+            if first_line is not None:
+                keyed.append((first_line.lower(), range_))
+        keyed.sort(key=lambda k: k[0])
+        range_set = [range_ for key, range_ in keyed]
+
+    for range_ in range_set:
+        for line in range_.iter_bind_records(reverse=reverse):
+            yield line + "\n"
+
+
+def _iter_forward_zone(default_ttl, nameserver_set, mx_set,
+                       addressrecord_set, interface_set, cname_set, srv_set,
+                       txt_set, sshfp_set, range_set, cache=None):
+    return chain(
+        iter_rdtype(nameserver_set, RENDERERS['nameserver'], cache=cache),
+        iter_rdtype(mx_set, RENDERERS['mx'], cache=cache),
+        iter_rdtype(txt_set, RENDERERS['txt'], cache=cache),
+        iter_rdtype(sshfp_set, RENDERERS['sshfp'], cache=cache),
+        iter_rdtype(srv_set, RENDERERS['srv'], cache=cache),
+        iter_rdtype(cname_set, RENDERERS['cname'], cache=cache),
+        iter_rdtype(interface_set, RENDERERS['staticinterface'],
+                    cache=cache),
+        iter_rdtype(addressrecord_set, RENDERERS['addressrecord'],
+                    cache=cache),
+        iter_ranges(range_set),
     )
-    return data
 
 
-def _render_reverse_zone(default_ttl, nameserver_set, interface_set,
-                         ptr_set, range_set):
-    BUILD_STR = ''
-    BUILD_STR += render_rdtype(nameserver_set)
-    BUILD_STR += render_rdtype(ptr_set)
-    BUILD_STR += render_rdtype(interface_set, reverse=True, rdtype='PTR')
-    BUILD_STR += render_rdtype(range_set, reverse=True)
-    return BUILD_STR
+def iter_forward_zone(view, domain_ids, loader, cache=None):
+    return _iter_forward_zone(
+        default_ttl=DEFAULT_TTL,
+        nameserver_set=loader.get_records('nameserver', domain_ids, view),
+        mx_set=loader.get_records('mx', domain_ids, view),
+        addressrecord_set=loader.get_records('addressrecord', domain_ids,
+                                             view),
+        interface_set=loader.get_records('staticinterface', domain_ids, view),
+        cname_set=loader.get_records('cname', domain_ids, view),
+        srv_set=loader.get_records('srv', domain_ids, view),
+        txt_set=loader.get_records('txt', domain_ids, view),
+        sshfp_set=loader.get_records('sshfp', domain_ids, view),
+        range_set=loader.get_ranges(domain_ids, view),
+        cache=cache,
+    )
+
 
+def _iter_reverse_zone(default_ttl, nameserver_set, interface_set,
+                       ptr_set, range_set, cache=None):
+    return chain(
+        iter_rdtype(nameserver_set, RENDERERS['nameserver'], cache=cache),
+        iter_rdtype(ptr_set, RENDERERS['ptr'], cache=cache),
+        iter_rdtype(interface_set, RENDERERS['reverse_staticinterface'],
+                    cache=cache),
+        iter_ranges(range_set, reverse=True, sort=True),
+    )
 
-def render_reverse_zone(view, domain_mega_filter, rdomain_mega_filter,
-                        range_set, ip_type=IP_TYPE_4):
-    data = _render_reverse_zone(
+
+def iter_reverse_zone(view, domain_ids, loader, range_set,
+                      ip_type=IP_TYPE_4, cache=None):
+    return _iter_reverse_zone(
         default_ttl=DEFAULT_TTL,
+        nameserver_set=loader.get_records('nameserver', domain_ids, view),
+        interface_set=loader.get_records('reverse_staticinterface',
+                                         domain_ids, view),
+        ptr_set=loader.get_records('ptr', domain_ids, view),
+        range_set=range_set,
+        cache=cache,
+    )
 
-        nameserver_set=Nameserver.objects.filter(domain_mega_filter).filter(
-            views__name=view.name).order_by('server'),
 
-        interface_set=(
-            StaticInterface.objects
-            .filter(rdomain_mega_filter, dns_enabled=True)
-            .filter(views__name=view.name)
-            .order_by('pk', 'ip_type', 'label', 'ip_upper', 'ip_lower')),
+def iter_zone_records(view, root_domain, soa, logf, loader=None,
+                      render_cache=None):
+    """
+    Yield the lines of a zone's records in `view`, not including its SOA
+    record. See :func:`build_zone_data`.
+    """
+    if loader is None or not loader.covers(soa):
+        loader = ZoneDataLoader(soas=[soa])
+    domain_ids = loader.get_zone_domain_ids(soa)
+
+    ztype = 'reverse' if root_domain.is_reverse else 'forward'
+    if (loader.has_records(soa, view) and
+            not loader.has_nameservers(root_domain, view)):
+        msg = ("The {0} zone has at least one record in the {1} view, but "
+               "there are no nameservers in that view. A zone file for {1} "
+               "won't be built. Use the search string 'zone=:{0} view=:{1}' "
+               "to find the troublesome record(s)"
+               .format(root_domain, view.name))
+        fail_mail(msg, subject="Record(s) without NS records can't be built")
+        logf(msg)
+        return iter(())
 
-        ptr_set=PTR.objects.filter(rdomain_mega_filter).filter(
-            views__name=view.name).order_by('pk', 'ip_upper',
-                                            'ip_lower'),
+    if root_domain.ip_type == '4':
+        range_set = loader.get_related_ranges(root_domain, view)
+    else:
+        range_set = []
 
-        range_set=range_set
-    )
-    return data
+    try:
+        if ztype == "forward":
+            return iter_forward_zone(view, domain_ids, loader,
+                                     cache=render_cache)
+        else:
+            ip_type = (IP_TYPE_6 if root_domain.name.endswith('ip6.arpa')
+                       else IP_TYPE_4)
+            return iter_reverse_zone(
+                view, domain_ids, loader, ip_type=ip_type,
+                range_set=range_set, cache=render_cache)
+    except View.DoesNotExist:
+        return iter(())
 
 
-def build_zone_data(view, root_domain, soa, logf):
+def write_zone_data(fname, view, root_domain, soa, serial, logf,
+                    loader=None, render_cache=None):
+    """
+    Write a zone's data in `view` to `fname` as it's rendered, with `serial`
+    in its SOA record, so the whole zone is never held in one string.
+
+    If the zone has no records in `view`, no file is written and None is
+    returned. Otherwise, a (size, digest) pair is returned. The digest is a
+    checksum of the data that ignores the serial, so a zone that only got a
+    new serial has the same digest as before. An existing file with the same
+    contents isn't rewritten.
+    """
+    lines = iter_zone_records(view, root_domain, soa, logf, loader=loader,
+                              render_cache=render_cache)
+    try:
+        first_line = next(lines)
+    except StopIteration:
+        return None
+
+    digest = hashlib.sha1()
+    digest.update(render_soa_only(soa, root_domain, serial='')
+                  .encode('utf-8'))
+    size = 0
+    with open_if_changed(fname) as fd:
+        soa_data = render_soa_only(soa, root_domain, serial=serial)
+        fd.write(soa_data)
+        size += len(soa_data)
+        for line in chain((first_line,), lines):
+            fd.write(line)
+            digest.update(line.encode('utf-8'))
+            size += len(line)
+    return size, digest.hexdigest()
+
+
+def get_fragment_name(record):
+    """
+    Return the name of the /24 reverse domain whose fragment `record` (a
+    rendered record of an IPv4 reverse zone) goes in, or None if it goes in
+    the zone's main file. See :func:`shard_zone_records`.
+    """
+    fields = record.split(None, 3)
+    if fields[:1] == ['$GENERATE']:
+        fields = fields[2:]
+    if not fields:
+        return None
+    labels = fields[0].rstrip('.').split('.')
+    if len(labels) != 6 or labels[4:] != ['in-addr', 'arpa']:
+        return None
+    return '.'.join(labels[1:])
+
+
+def shard_zone_records(lines):
+    """
+    Split the records of an IPv4 reverse zone (from
+    :func:`iter_zone_records`) by /24. Return the records that go in the
+    zone's main file, which are the ones that aren't about a single address
+    (e.g. its NS records), and a dict mapping the name of each /24 reverse
+    domain to the records in it. Records keep their order.
+    """
+    main_lines = []
+    fragments = {}
+    for line in lines:
+        name = get_fragment_name(line)
+        if name is None:
+            main_lines.append(line)
+        else:
+            fragments.setdefault(name, []).append(line)
+    return main_lines, fragments
+
+
+def build_zone_data(view, root_domain, soa, logf, loader=None,
+                    render_cache=None, serial=None):
     """
     This function does the heavy lifting of building a zone. It coordinates
     getting all of the data out of the db into BIND format.
@@ -161,6 +265,19 @@ def build_zone_data(view, root_domain, soa, logf):
         :param root_domain: The root domain of this zone.
         :type root_domain: str
 
+        :param loader: Where to get the zone's records from. If it's None or
+            doesn't cover this zone, a loader for just this zone is used.
+        :type loader: ZoneDataLoader
+
+        :param render_cache: Where to get already rendered records from. If
+            it's None, every record is rendered.
+        :type render_cache: RenderCache
+
+        :param serial: The serial to put in the SOA record. If it's None,
+            the SOA's current serial is used. Builds write zone files with
+            :func:`write_zone_data` instead.
+        :type serial: int
+
         :returns public_file_path: The path to the zone file in the STAGEING
             dir
         :type public_file_path: str
@@ -173,51 +290,12 @@ def build_zone_data(view, root_domain, soa, logf):
         :param view_data: The data that should be written to view_zone_file
         :type view_data: str
     """
-    ztype = 'reverse' if root_domain.is_reverse else 'forward'
-    if (soa.has_record_set(view=view, exclude_ns=True) and
-            not root_domain.nameserver_set.filter(views=view).exists()):
-        msg = ("The {0} zone has at least one record in the {1} view, but "
-               "there are no nameservers in that view. A zone file for {1} "
-               "won't be built. Use the search string 'zone=:{0} view=:{1}' "
-               "to find the troublesome record(s)"
-               .format(root_domain, view.name))
-        fail_mail(msg, subject="Record(s) without NS records can't be built")
-        logf(msg)
-        return ''
-
-    domains = soa.domain_set.all().order_by('name')
-
-    # Build the mega filter!
-    domain_mega_filter = Q(domain=root_domain)
-    for domain in domains:
-        domain_mega_filter = domain_mega_filter | Q(domain=domain)
-
-    rdomain_mega_filter = Q(reverse_domain=root_domain)
-    for reverse_domain in domains:
-        rdomain_mega_filter = rdomain_mega_filter | Q(
-            reverse_domain=reverse_domain)
-
-    soa_data = render_soa_only(soa=soa, root_domain=root_domain)
-    if root_domain.ip_type == '4':
-        range_set = (root_domain.get_related_ranges()
-                                .filter(views__name=view.name)
-                                .order_by('start_upper', 'start_lower'))
-    else:
-        range_set = []
-
-    try:
-        if ztype == "forward":
-            view_data = render_forward_zone(view, domain_mega_filter)
-        else:
-            ip_type = (IP_TYPE_6 if root_domain.name.endswith('ip6.arpa')
-                       else IP_TYPE_4)
-            view_data = render_reverse_zone(
-                view, domain_mega_filter, rdomain_mega_filter, ip_type=ip_type,
-                range_set=range_set)
-    except View.DoesNotExist:
-        view_data = ""
-
+    if serial is None:
+        serial = soa.serial
+    lines = iter_zone_records(view, root_domain, soa, logf, loader=loader,
+                              render_cache=render_cache)
+    view_data = "".join(lines)
     if view_data:
-        view_data = soa_data + view_data
+        view_data = render_soa_only(soa, root_domain, serial) + view_data
 
     return view_data
@@ -0,0 +1,265 @@
+from collections import defaultdict
+from itertools import chain
+from operator import itemgetter
+
+from cyder.cydns.address_record.models import AddressRecord
+from cyder.cydns.cname.models import CNAME
+from cyder.cydns.cybind.row_renderers import RENDERERS
+from cyder.cydns.domain.models import Domain
+from cyder.cydns.mx.models import MX
+from cyder.cydns.nameserver.models import Nameserver
+from cyder.cydns.ptr.models import PTR
+from cyder.cydns.srv.models import SRV
+from cyder.cydns.txt.models import TXT
+from cyder.cydns.sshfp.models import SSHFP
+from cyder.cydns.view.models import View
+from cyder.cydhcp.interface.static_intr.models import StaticInterface
+from cyder.cydhcp.range.models import Range
+
+
+# Every kind of record that can end up in a zone file.
+#   model: The record's class.
+#   key: The domain foreign key that places the record in a zone.
+#   filter: Only records matching this are rendered.
+#   order_by: The order the records are rendered in (before sorting).
+# Records are fetched as rows and rendered by RENDERERS, which says which
+# fields each kind of record needs.
+RECORD_SETS = {
+    'nameserver': {
+        'model': Nameserver,
+        'key': 'domain',
+        'order_by': ('server',),
+    },
+    'mx': {
+        'model': MX,
+        'key': 'domain',
+        'order_by': ('server',),
+    },
+    'addressrecord': {
+        'model': AddressRecord,
+        'key': 'domain',
+        'order_by': ('pk', 'ip_type', 'fqdn', 'ip_upper', 'ip_lower'),
+    },
+    'staticinterface': {
+        'model': StaticInterface,
+        'key': 'domain',
+        'filter': {'dns_enabled': True},
+        'order_by': ('pk', 'ip_type', 'fqdn', 'ip_upper', 'ip_lower'),
+    },
+    'cname': {
+        'model': CNAME,
+        'key': 'domain',
+        'order_by': ('fqdn',),
+    },
+    'srv': {
+        'model': SRV,
+        'key': 'domain',
+        'order_by': ('pk', 'fqdn'),
+    },
+    'txt': {
+        'model': TXT,
+        'key': 'domain',
+        'order_by': ('pk', 'fqdn'),
+    },
+    'sshfp': {
+        'model': SSHFP,
+        'key': 'domain',
+        'order_by': ('pk', 'fqdn'),
+    },
+    'ptr': {
+        'model': PTR,
+        'key': 'reverse_domain',
+        'order_by': ('pk', 'ip_upper', 'ip_lower'),
+    },
+    'reverse_staticinterface': {
+        'model': StaticInterface,
+        'key': 'reverse_domain',
+        'filter': {'dns_enabled': True},
+        'order_by': ('pk', 'ip_type', 'label', 'ip_upper', 'ip_lower'),
+    },
+}
+
+# The record sets (other than nameservers) that make a zone need an NS record
+# in a view. See :func:`SOA.has_record_set`.
+NEEDS_NS_RECORD_SETS = ('addressrecord', 'cname', 'mx', 'srv', 'sshfp',
+                        'staticinterface', 'txt', 'ptr')
+
+
+def get_view_field_names(model):
+    """
+    Return the names of the two foreign keys in `model`'s views through
+    table: the one pointing at the record and the one pointing at the view.
+    """
+    field = model._meta.get_field('views')
+    return field.m2m_field_name(), field.m2m_reverse_field_name()
+
+
+class ZoneDataLoader(object):
+    """
+    Fetches records for :func:`build_zone_data`.
+
+    Records are fetched as `values_list` rows (see :class:`RowRenderer`)
+    rather than as model instances. Each record type is fetched with one
+    query (plus one for its view memberships) the first time it's needed,
+    and then grouped by domain and view in memory. The number of queries a
+    build makes therefore depends on the number of record types rather than
+    on the number of zones and views.
+
+    If `soas` is given, only records in those zones are fetched.
+    """
+
+    def __init__(self, soas=None):
+        if soas is None:
+            self.soa_pks = None
+        else:
+            self.soa_pks = set(soa.pk for soa in soas)
+        self._zone_domain_ids = None
+        self._groups = {}
+        self._occupancy = None
+        self._ranges = None
+        self._views = None
+
+    def covers(self, soa):
+        """Return whether this loader has fetched (or will fetch) `soa`."""
+        return self.soa_pks is None or soa.pk in self.soa_pks
+
+    def load_all(self):
+        """Fetch everything now instead of when it's first needed."""
+        self.get_views()
+        self._get_zone_domain_ids()
+        for name in RECORD_SETS:
+            self._get_groups(name)
+        self._get_ranges()
+
+    def get_views(self):
+        if self._views is None:
+            self._views = list(View.objects.all())
+        return self._views
+
+    def _get_zone_domain_ids(self):
+        if self._zone_domain_ids is None:
+            domains = Domain.objects.filter(soa__isnull=False)
+            if self.soa_pks is not None:
+                domains = domains.filter(soa__in=self.soa_pks)
+            self._zone_domain_ids = defaultdict(set)
+            for pk, soa_pk in domains.values_list('pk', 'soa'):
+                self._zone_domain_ids[soa_pk].add(pk)
+        return self._zone_domain_ids
+
+    def get_zone_domain_ids(self, soa):
+        """Return the pks of every domain in `soa`'s zone."""
+        return (self._get_zone_domain_ids()[soa.pk] |
+                set([soa.root_domain_id]))
+
+    def _get_groups(self, name):
+        if name not in self._groups:
+            self._groups[name] = self._load(RENDERERS[name],
+                                            **RECORD_SETS[name])
+        return self._groups[name]
+
+    def _load(self, renderer, model, key, order_by, filter=None):
+        record_field, view_field = get_view_field_names(model)
+        records = model.objects.filter(**(filter or {}))
+        memberships = model.views.through.objects.all()
+        if self.soa_pks is not None:
+            # Domain.soa is kept up to date by Domain.save and SOA.save, so
+            # this is a single join no matter how many domains there are.
+            soa_pks = list(self.soa_pks)
+            records = records.filter(**{key + '__soa__in': soa_pks})
+            memberships = memberships.filter(**{
+                '{0}__{1}__soa__in'.format(record_field, key): soa_pks})
+        rows = renderer.get_rows(records.order_by(*order_by))
+
+        record_views = defaultdict(list)
+        for record_pk, view_pk in memberships.values_list(record_field,
+                                                          view_field):
+            record_views[record_pk].append(view_pk)
+
+        # Remember each record's position so a zone's records can be put back
+        # in query order after being collected from several domains.
+        groups = defaultdict(list)
+        for i, row in enumerate(rows):
+            domain_pk = row[2]  # `key`
+            for view_pk in record_views[row[0]]:
+                groups[(domain_pk, view_pk)].append((i, row))
+        return groups
+
+    def get_records(self, name, domain_ids, view):
+        """
+        Return the rows of the records of type `name` that are in one of the
+        domains in `domain_ids` and in `view`. They're rendered by
+        `RENDERERS[name]`.
+        """
+        groups = self._get_groups(name)
+        rows = chain.from_iterable(
+            groups.get((domain_pk, view.pk), ()) for domain_pk in domain_ids)
+        return [row for _, row in sorted(rows, key=itemgetter(0))]
+
+    def _get_occupancy(self):
+        # Which (zone, view) pairs have records that need an NS record,
+        # worked out in one pass over the groups instead of probing them for
+        # every domain of every zone in every view.
+        if self._occupancy is None:
+            soa_pks = {}
+            for soa_pk, domain_pks in self._get_zone_domain_ids().iteritems():
+                for domain_pk in domain_pks:
+                    soa_pks[domain_pk] = soa_pk
+            self._occupancy = set()
+            for name in NEEDS_NS_RECORD_SETS:
+                for domain_pk, view_pk in self._get_groups(name):
+                    if domain_pk in soa_pks:
+                        self._occupancy.add((soa_pks[domain_pk], view_pk))
+        return self._occupancy
+
+    def has_records(self, soa, view):
+        """
+        Return whether there are records other than nameservers in `soa`'s
+        zone and in `view`.
+        """
+        if (soa.pk, view.pk) in self._get_occupancy():
+            return True
+        # The root domain is always in its zone, even if its soa is stale.
+        return any((soa.root_domain_id, view.pk) in self._get_groups(name)
+                   for name in NEEDS_NS_RECORD_SETS)
+
+    def has_nameservers(self, domain, view):
+        """Return whether `domain` has a nameserver in `view`."""
+        return (domain.pk, view.pk) in self._get_groups('nameserver')
+
+    def _get_ranges(self):
+        # Ranges are always fetched in full because reverse zones find theirs
+        # by address rather than by domain. There aren't many of them.
+        if self._ranges is None:
+            record_field, view_field = get_view_field_names(Range)
+            range_views = defaultdict(set)
+            for range_pk, view_pk in (Range.views.through.objects
+                                      .values_list(record_field,
+                                                   view_field)):
+                range_views[range_pk].add(view_pk)
+            self._ranges = [
+                (range_, range_views[range_.pk]) for range_ in
+                Range.objects.select_related('domain')
+                             .order_by('start_upper', 'start_lower')]
+        return self._ranges
+
+    def get_ranges(self, domain_ids, view):
+        """
+        Return the ranges that are in one of the domains in `domain_ids` and
+        in `view`.
+        """
+        return [range_ for range_, view_pks in self._get_ranges()
+                if view.pk in view_pks and range_.domain_id in domain_ids]
+
+    def get_related_ranges(self, root_domain, view):
+        """
+        Return the ranges in `view` that are related to the reverse domain
+        `root_domain`. See :func:`Domain.get_related_ranges`.
+        """
+        ip_str = root_domain.name.rsplit('.', 2)[0]
+        ip_str = '.'.join(reversed(ip_str.split('.')))
+        if ip_str.count('.') < 3:
+            ip_str += '.'
+        return [range_ for range_, view_pks in self._get_ranges()
+                if view.pk in view_pks and
+                (range_.start_str.startswith(ip_str) or
+                 range_.end_str.startswith(ip_str))]
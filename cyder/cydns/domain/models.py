@@ -12,6 +12,20 @@ from cyder.cydns.validation import validate_reverse_name
 from cyder.cydns.domain.utils import name_to_domain, is_name_descendant_of
 
 
+# The related sets of a domain's records, other than its nameservers. See
+# :func:`Domain.has_record_set`.
+RECORD_SET_NAMES = (
+    'addressrecord_set',
+    'cname_set',
+    'mx_set',
+    'srv_set',
+    'sshfp_set',
+    'staticinterface_set',
+    'txt_set',
+    'reverse_ptr_set',
+)
+
+
 class Domain(BaseModel, ObjectUrlMixin):
     """A Domain is used as a foreign key for most DNS records.
 
@@ -281,16 +295,7 @@ class Domain(BaseModel, ObjectUrlMixin):
         return ranges
 
     def has_record_set(self, view=None, exclude_ns=False):
-        object_sets = [
-            self.addressrecord_set,
-            self.cname_set,
-            self.mx_set,
-            self.srv_set,
-            self.sshfp_set,
-            self.staticinterface_set,
-            self.txt_set,
-            self.reverse_ptr_set
-        ]
+        object_sets = [getattr(self, name) for name in RECORD_SET_NAMES]
         if not view:
             for object_set in object_sets:
                 if object_set.exists():
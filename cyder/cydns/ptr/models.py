@@ -202,31 +202,31 @@ class PTR(BaseModel, BasePTR, Ip, ViewMixin, DisplayMixin, ObjectUrlMixin):
 
     @transaction_atomic
     def save(self, *args, **kwargs):
+        from cyder.cydhcp.range.counters import address_changed, get_ip_key
+
         self.full_clean()
 
         update_range_usage = kwargs.pop('update_range_usage', True)
-        old_range = None
+        old_ip_key = None
         if self.id is not None:
-            old_ip = PTR.objects.get(id=self.id).ip_str
-            old_range = find_range(old_ip)
+            old_ip_key = get_ip_key(PTR.objects.get(id=self.id))
 
         super(PTR, self).save(*args, **kwargs)
         self.schedule_zone_rebuild()
-        rng = self.range
-        if rng and update_range_usage:
-            rng.save(commit=False)
-            if old_range:
-                old_range.save(commit=False)
+        if update_range_usage:
+            address_changed(self, old_ip_key, get_ip_key(self))
 
     @transaction_atomic
     def delete(self, *args, **kwargs):
+        from cyder.cydhcp.range.counters import address_changed, get_ip_key
+
         update_range_usage = kwargs.pop('update_range_usage', True)
         if self.reverse_domain.soa:
             self.reverse_domain.soa.schedule_rebuild()
-        rng = find_range(self.ip_str)
+        ip_key = get_ip_key(self)
         super(PTR, self).delete(*args, **kwargs)
-        if rng and update_range_usage:
-            rng.save(commit=False)
+        if update_range_usage:
+            address_changed(self, old_ip_key=ip_key)
 
     def clean(self):
         super(PTR, self).clean()
@@ -164,8 +164,24 @@ class SOA(BaseModel, ObjectUrlMixin, DisplayMixin):
         reassign_reverse_records(root_domain, None)
 
     def has_record_set(self, view=None, exclude_ns=False):
-        for domain in self.domain_set.all():
-            if domain.has_record_set(view=view, exclude_ns=exclude_ns):
+        """
+        Return whether any domain in this zone has records (in `view`, if
+        it's given). Each kind of record is looked for in the whole zone at
+        once, so this makes at most one query per kind of record no matter
+        how many domains the zone has.
+        """
+        from cyder.cydns.domain.models import Domain, RECORD_SET_NAMES
+
+        names = RECORD_SET_NAMES
+        if not exclude_ns:
+            names += ('nameserver_set',)
+        for name in names:
+            related = getattr(Domain, name).related
+            records = related.model.objects.filter(
+                **{related.field.name + '__soa': self})
+            if view:
+                records = records.filter(views=view)
+            if records.exists():
                 return True
         return False
 
@@ -1,8 +1,12 @@
 from django.core.exceptions import ValidationError
 
 from cyder.base.tests import ModelTestMixin, TestCase
+from cyder.core.ctnr.models import Ctnr
 from cyder.cydns.soa.models import SOA
 from cyder.cydns.domain.models import Domain
+from cyder.cydns.tests.utils import create_zone
+from cyder.cydns.txt.models import TXT
+from cyder.cydns.view.models import View
 
 
 class SOATests(TestCase, ModelTestMixin):
@@ -120,3 +124,23 @@ class SOATests(TestCase, ModelTestMixin):
         self.assertEqual(Domain.objects.get(name='y').soa, None)
         for name in ('x.y', 'p.x.y', 'q.x.y', 'a.q.x.y', 'b.q.x.y', 'c.q.x.y'):
             self.assertEqual(Domain.objects.get(name=name).soa, soa_x_y)
+
+    def test_has_record_set(self):
+        Domain.objects.create(name='com')
+        soa = create_zone('foo.com').soa
+        bar = Domain.objects.create(name='bar.foo.com')
+        ctnr = Ctnr.objects.create(name='test_ctnr')
+        ctnr.domains.add(bar)
+        public, _ = View.objects.get_or_create(name='public')
+
+        # The nameserver at the root of the zone counts unless it's excluded.
+        self.assertTrue(soa.has_record_set())
+        self.assertFalse(soa.has_record_set(exclude_ns=True))
+
+        txt = TXT.objects.create(
+            label='baz', domain=bar, ctnr=ctnr, txt_data='hi')
+        self.assertTrue(soa.has_record_set(exclude_ns=True))
+        self.assertFalse(soa.has_record_set(exclude_ns=True, view=public))
+
+        txt.views.add(public)
+        self.assertTrue(soa.has_record_set(exclude_ns=True, view=public))
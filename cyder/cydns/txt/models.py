@@ -8,6 +8,39 @@ from cyder.cydns.models import CydnsRecord, LabelDomainMixin
 from cyder.cydns.validation import validate_txt_data
 
 
+TXT_LINE_LENGTH = 120
+
+
+def escape_txt_data(txt_data):
+    return txt_data.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def format_txt_data(txt_data):
+    """
+    Return `txt_data` escaped, quoted, and split into lines the way it's
+    written in a zone file.
+    """
+    def length_format(line):
+        if len(line) <= TXT_LINE_LENGTH:
+            return '"{0}"'.format(line)
+        return (('"%s"' % line[:TXT_LINE_LENGTH]) + "\n"
+                + length_format(line[TXT_LINE_LENGTH:]))
+
+    escaped_txt_data = escape_txt_data(txt_data)
+    txt_lines = escaped_txt_data.split('\n')
+    txt_data = ""
+    if len(txt_lines) > 1:
+        for line in txt_lines:
+            txt_data += length_format(line) + "\n"
+    else:
+        txt_data = length_format(escaped_txt_data)
+
+    txt_data = txt_data.strip('\n')
+    if '\n' in txt_data:
+        txt_data = '(\n{0})'.format(txt_data).replace('\n', '\n    ')
+    return txt_data
+
+
 class TXT(LabelDomainMixin, CydnsRecord):
     """
     >>> TXT(label=label, domain=domain, txt_data=txt_data)
@@ -61,41 +94,21 @@ class TXT(LabelDomainMixin, CydnsRecord):
 
     @property
     def escaped_txt_data(self):
-        return self.txt_data.replace('\\', '\\\\').replace('"', '\\"')
+        return escape_txt_data(self.txt_data)
 
     @property
     def rdtype(self):
         return 'TXT'
 
     def bind_render_record(self, pk=False):
-        TXT_LINE_LENGTH = 120
-
-        def length_format(line):
-            if len(line) <= TXT_LINE_LENGTH:
-                return '"{0}"'.format(line)
-            return (('"%s"' % line[:TXT_LINE_LENGTH]) + "\n"
-                    + length_format(line[TXT_LINE_LENGTH:]))
-
         template = Template(self.template).substitute(**self.justs)
         bind_name = self.fqdn + "."
         if not self.ttl:
             self.ttl = 3600
 
-        txt_lines = self.escaped_txt_data.split('\n')
-        txt_data = ""
-        if len(txt_lines) > 1:
-            for line in txt_lines:
-                txt_data += length_format(line) + "\n"
-        else:
-            txt_data = length_format(self.escaped_txt_data)
-
-        txt_data = txt_data.strip('\n')
-        if '\n' in txt_data:
-            txt_data = '(\n{0})'.format(txt_data).replace('\n', '\n    ')
-
         return template.format(
             bind_name=bind_name, ttl=self.ttl, rdtype=self.rdtype,
-            rdclass='IN', txt_data=txt_data
+            rdclass='IN', txt_data=format_txt_data(self.txt_data)
         )
 
     @transaction_atomic
@@ -35,6 +35,11 @@ class Command(BaseCommand):
                     action='store_false',
                     default=True,
                     help="Don't run the diff sanity check."),
+        make_option('-j', '--jobs',
+                    dest='jobs',
+                    type='int',
+                    default=None,
+                    help='Build this many zones at the same time.'),
     )
 
     def handle(self, *args, **options):
@@ -48,6 +53,11 @@ class Command(BaseCommand):
         builder_opts['quiet'] = verbosity == 0
         builder_opts['verbose'] = verbosity >= 2
 
+        if options['jobs'] is not None:
+            if options['jobs'] < 1:
+                raise CommandError('--jobs must be at least 1')
+            builder_opts['jobs'] = options['jobs']
+
         with DNSBuilder(**builder_opts) as b:
             b.build(force=options['force_build'])
             if options['push']:
@@ -0,0 +1,236 @@
+import syslog
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries
+from django.db.models import Count, Max
+
+from cyder.base.utils import LockHeld, StopFileExists
+from cyder.core.task.models import Task
+from cyder.cydhcp.build.builder import DHCPBuilder
+from cyder.cydns.cybind.builder import DNSBuilder
+
+
+class BuildTrigger(object):
+    """
+    Decides when to build, given a fingerprint of what there is to build.
+
+    A build is due once the fingerprint has stopped changing for `debounce`
+    seconds, so a burst of edits leads to one build, or once a change has
+    been waiting for `max_delay` seconds, so a steady trickle of edits can't
+    put the build off forever.
+    """
+
+    def __init__(self, debounce, max_delay):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.fingerprint = None
+        self.first_change = None
+        self.last_change = None
+        self.retry_time = None
+
+    def update(self, fingerprint, pending=True, now=None):
+        if now is None:
+            now = time.time()
+        if fingerprint != self.fingerprint:
+            self.fingerprint = fingerprint
+            self.last_change = now
+            if pending and self.first_change is None:
+                self.first_change = now
+        if not pending:
+            self.first_change = None
+
+    def is_due(self, now=None):
+        if self.first_change is None:
+            return False
+        if now is None:
+            now = time.time()
+        if self.retry_time is not None and now < self.retry_time:
+            return False
+        return (now - self.last_change >= self.debounce or
+                now - self.first_change >= self.max_delay)
+
+    def built(self):
+        self.first_change = self.retry_time = None
+
+    def failed(self, now=None):
+        # Try again once `max_delay` has passed rather than on every poll.
+        if now is None:
+            now = time.time()
+        self.retry_time = now + self.max_delay
+
+
+def get_fingerprint(tasks):
+    """
+    Return whether there are `tasks` waiting to be built and a value that
+    changes whenever one is scheduled.
+
+    Claimed tasks count as waiting too: a build deletes its tasks once it's
+    pushed, so if it fails they're left behind and it has to be retried.
+    """
+    fingerprint = tasks.aggregate(count=Count('pk'), last=Max('pk'))
+    return fingerprint['count'] > 0, (fingerprint['count'],
+                                      fingerprint['last'])
+
+
+def get_dns_fingerprint():
+    """See :func:`get_fingerprint`. DNS tasks are zones to rebuild."""
+    return get_fingerprint(Task.dns)
+
+
+def get_dhcp_fingerprint():
+    """
+    See :func:`get_fingerprint`. DHCP tasks are sections of the config to
+    rebuild.
+    """
+    return get_fingerprint(Task.dhcp)
+
+
+class Command(BaseCommand):
+    help = ('Watch for changes and run DNS and DHCP builds shortly after '
+            'they happen.')
+
+    option_list = BaseCommand.option_list + (
+        ### action options ###
+        make_option('-p', '--push',
+                    dest='push',
+                    action='store_true',
+                    default=False,
+                    help='Check files into vcs and push upstream.'),
+        make_option('--no-dns',
+                    dest='dns',
+                    action='store_false',
+                    default=True,
+                    help="Don't run DNS builds."),
+        make_option('--no-dhcp',
+                    dest='dhcp',
+                    action='store_false',
+                    default=True,
+                    help="Don't run DHCP builds."),
+        ### logging/debug options ###
+        make_option('-l', '--syslog',
+                    dest='to_syslog',
+                    action='store_true',
+                    help='Log to syslog.'),
+        make_option('-L', '--no-syslog',
+                    dest='to_syslog',
+                    action='store_false',
+                    help="Don't log to syslog."),
+        ### timing options ###
+        make_option('-i', '--interval',
+                    dest='interval',
+                    type='float',
+                    default=2,
+                    help='Check for changes every this many seconds.'),
+        make_option('-d', '--debounce',
+                    dest='debounce',
+                    type='float',
+                    default=5,
+                    help='Build once nothing has changed for this many '
+                         'seconds.'),
+        make_option('-m', '--max-delay',
+                    dest='max_delay',
+                    type='float',
+                    default=60,
+                    help="Build once a change has waited this many seconds, "
+                         "even if things are still changing."),
+        ### miscellaneous ###
+        make_option('-C', '--no-sanity-check',
+                    dest='sanity_check',
+                    action='store_false',
+                    default=True,
+                    help="Don't run the diff sanity check."),
+        make_option('-j', '--jobs',
+                    dest='jobs',
+                    type='int',
+                    default=None,
+                    help='Build this many zones at the same time.'),
+    )
+
+    def handle(self, *args, **options):
+        # A manual build that's running will be done soon, so that's not
+        # worth reporting. See `run_build`.
+        self.builder_opts = {'report_lock_failure': False}
+
+        if options['to_syslog']:
+            syslog.openlog('builder_daemon', facility=syslog.LOG_LOCAL6)
+            self.builder_opts['to_syslog'] = True
+
+        verbosity = int(options['verbosity'])
+        self.builder_opts['quiet'] = verbosity == 0
+        self.builder_opts['verbose'] = verbosity >= 2
+
+        for name in ('interval', 'debounce', 'max_delay'):
+            if options[name] < 0:
+                raise CommandError('--{0} must not be negative'.format(
+                    name.replace('_', '-')))
+        if options['jobs'] is not None:
+            if options['jobs'] < 1:
+                raise CommandError('--jobs must be at least 1')
+
+        self.options = options
+        dns_trigger = BuildTrigger(options['debounce'], options['max_delay'])
+        dhcp_trigger = BuildTrigger(options['debounce'],
+                                    options['max_delay'])
+
+        while True:
+            # Start each round with a fresh connection so that the polls see
+            # what's been committed since the last one, and so that a
+            # long-running process doesn't keep every query it makes.
+            connection.close()
+            reset_queries()
+
+            if options['dns']:
+                pending, fingerprint = get_dns_fingerprint()
+                dns_trigger.update(fingerprint, pending=pending)
+                if dns_trigger.is_due():
+                    self.run_build(dns_trigger, self.build_dns)
+
+            if options['dhcp']:
+                pending, fingerprint = get_dhcp_fingerprint()
+                dhcp_trigger.update(fingerprint, pending=pending)
+                if dhcp_trigger.is_due():
+                    self.run_build(dhcp_trigger, self.build_dhcp)
+
+            time.sleep(options['interval'])
+
+    def log(self, msg, log_level=syslog.LOG_ERR):
+        if self.builder_opts.get('to_syslog'):
+            syslog.syslog(log_level, msg)
+        if not self.builder_opts['quiet']:
+            self.stderr.write(msg + '\n')
+
+    def run_build(self, trigger, build):
+        # The builders mail and log their own failures, so all that's left
+        # to do is keep going.
+        try:
+            build()
+        except LockHeld as e:
+            # Another build (e.g. a manual one) is running. The build is
+            # still due, so it's tried again on the next poll.
+            self.log('{0} is locked; trying again shortly'.format(e),
+                     log_level=syslog.LOG_INFO)
+        except StopFileExists:
+            trigger.failed()
+        except Exception as e:
+            self.log('Build failed: {0}'.format(e))
+            trigger.failed()
+        else:
+            trigger.built()
+
+    def build_dns(self):
+        builder_opts = dict(self.builder_opts)
+        if self.options['jobs'] is not None:
+            builder_opts['jobs'] = self.options['jobs']
+
+        with DNSBuilder(**builder_opts) as b:
+            b.build()
+            if self.options['push']:
+                b.push(sanity_check=self.options['sanity_check'])
+
+    def build_dhcp(self):
+        with DHCPBuilder(**self.builder_opts) as b:
+            b.build()
+            if self.options['push']:
+                b.push(sanity_check=self.options['sanity_check'])
@@ -24,6 +24,11 @@ class Command(BaseCommand):
                     action='store_false',
                     help="Do not log to syslog."),
         ### miscellaneous ###
+        make_option('-f', '--force-build',
+                    dest='force_build',
+                    action='store_true',
+                    default=False,
+                    help="Rebuild the config even if nothing has changed."),
         make_option('-C', '--no-sanity-check',
                     dest='sanity_check',
                     action='store_false',
@@ -43,6 +48,6 @@ class Command(BaseCommand):
         builder_opts['verbose'] = verbosity >= 2
 
         with DHCPBuilder(**builder_opts) as b:
-            b.build()
+            b.build(force=options['force_build'])
             if options['push']:
                 b.push(sanity_check=options['sanity_check'])
@@ -0,0 +1,29 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from cyder.base.utils import transaction_atomic
+from cyder.cydhcp.range.counters import rebuild_range_usage
+
+
+class Command(BaseCommand):
+    help = "Recount every range's used addresses and fix any that are off."
+
+    option_list = BaseCommand.option_list + (
+        make_option('-n', '--dry-run',
+                    dest='dry_run',
+                    action='store_true',
+                    default=False,
+                    help="Only report the ranges that are off."),
+    )
+
+    @transaction_atomic
+    def handle(self, *args, **options):
+        fixed = rebuild_range_usage(dry_run=options['dry_run'])
+        if int(options['verbosity']) == 0:
+            return
+        for rng, old_count, new_count in fixed:
+            self.stdout.write(u'{0}: {1} -> {2}\n'.format(
+                rng, old_count, new_count))
+        self.stdout.write('{0} range(s) {1}.\n'.format(
+            len(fixed), 'off' if options['dry_run'] else 'fixed'))
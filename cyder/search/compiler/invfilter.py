@@ -1,4 +1,3 @@
-import operator
 import ipaddr
 import re
 
@@ -291,19 +290,17 @@ def build_zone_qsets(zone):
     if not root_domain.soa:
         raise BadDirective("'{0}' part of a valid zone.".format(zone))
 
-    def _get_zone_domains(domain):
-        domains = [domain]
-        for sub_domain in domain.domain_set.filter(soa=domain.soa):
-            domains += _get_zone_domains(sub_domain)
-        return domains
-
-    zone_domains = _get_zone_domains(root_domain)
-
-    domains = [Q(domain=domain) for domain in zone_domains]
-    reverse_domains = [Q(reverse_domain=domain) for domain in zone_domains]
-
-    zone_query = reduce(operator.or_, domains, Q())
-    reverse_zone_query = reduce(operator.or_, reverse_domains, Q())
+    # Domain.soa maps every domain to its zone, so there's no need to walk
+    # the domain tree. If the domain isn't the zone's root, only its part of
+    # the zone is wanted.
+    zone_query = Q(domain__soa=root_domain.soa)
+    reverse_zone_query = Q(reverse_domain__soa=root_domain.soa)
+    if root_domain.soa.root_domain_id != root_domain.pk:
+        zone_query &= (Q(domain=root_domain) |
+                       Q(domain__name__endswith='.' + root_domain.name))
+        reverse_zone_query &= (
+            Q(reverse_domain=root_domain) |
+            Q(reverse_domain__name__endswith='.' + root_domain.name))
 
     result = []
     for name, Klass in searchables:
@@ -518,6 +518,46 @@ BINDBUILD = {
     'named_checkconf': 'named-checkconf',
     'named_checkzone_opts': '',
 
+    # jobs: How many zones to render and check at the same time. Each job
+    # runs in its own process with its own database connection.
+    'jobs': 1,
+
+    # render_cache_file: Where to remember how records were rendered so
+    # unchanged records aren't rendered again in the next build. Only the
+    # builder should be able to write here. None means don't remember.
+    'render_cache_file': cy_path(path.join(BUILD_PATH,
+                                           'dns_render_cache.json')),
+
+    # check_jobs: How many named-checkzone and named-checkconf processes to
+    # run at the same time. They run in the background while other files are
+    # being built.
+    'check_jobs': 4,
+
+    # check_cache_file: Where to remember the files that passed their checks
+    # so unchanged files aren't checked again in the next build. Only the
+    # builder should be able to write here. None means don't remember.
+    'check_cache_file': cy_path(path.join(BUILD_PATH,
+                                          'dns_check_cache.json')),
+
+    # ixfr_journal_length: How many changes to keep in each zone file's IXFR
+    # journal (under ixfr/ in the repo) so secondaries can be sent deltas
+    # instead of whole zones. 0 means don't write journals.
+    'ixfr_journal_length': 0,
+
+    # shard_reverse_zones: Whether to split each IPv4 reverse zone bigger
+    # than a /24 into a file per /24 (in <zone file>.d/), which the zone file
+    # $INCLUDEs, so a change to one address only rewrites and commits one
+    # small file.
+    'shard_reverse_zones': False,
+
+    # profile_file: Where to write a JSON report of how long each zone, view
+    # file, check and git command took, along with its SQL queries and size.
+    # None means don't write one.
+    'profile_file': None,
+
+    # profile_build_run: Whether to also store the report in a DNSBuildRun.
+    'profile_build_run': False,
+
     # None means no limit
     'line_decrease_limit': 500,
     'line_increase_limit': 500,
@@ -567,6 +607,34 @@ DHCPBUILD = {
     'stop_file': '/tmp/cyder_dhcp.stop',
     'stop_file_email_interval': 1800,  # 30 minutes
 
+    # profile_file: Where to write a JSON report of how long each part of the
+    # config took to build, along with its SQL queries and size. None means
+    # don't write one.
+    'profile_file': None,
+
+    # section_cache_file: Where to remember how each network, workgroup, etc.
+    # was rendered so only the ones that changed are rendered in the next
+    # build. Only the builder should be able to write here. None means don't
+    # remember.
+    'section_cache_file': cy_path(path.join(BUILD_PATH,
+                                            'dhcp_section_cache.json')),
+
+    # split_config: Whether to write each container's classes, VRF class,
+    # subnet and workgroup to a file of its own (in <target file>.d/), which
+    # the target file includes, so a change to one network only rewrites and
+    # commits one small file.
+    'split_config': False,
+
+    # include_dir: Where the DHCP servers read prod_dir's files from. Split
+    # target files include their fragments by their paths under here.
+    'include_dir': '/etc/dhcp',
+
+    # jobs: How many of the config files (v4 and v6) to build at the same
+    # time. Each job runs in its own process with its own database
+    # connection. Either way, each file's syntax check overlaps with building
+    # the other.
+    'jobs': 2,
+
     'log_syslog': False,
 }
 
@@ -2,6 +2,8 @@ from django.dispatch import receiver
 from django.db.models.signals import post_syncdb
 from south.signals import post_migrate
 
+from cyder.cydhcp.build.changes import connect_signals
+
 
 # South doesn't automatically load custom SQL like Django does, and regardless,
 # the filename isn't what Django would expect.
@@ -34,3 +36,6 @@ def _post_syncdb(**kwargs):
 def _post_migrate(**kwargs):
     _load_custom_sql()
     _load_fixtures()
+
+
+connect_signals()